@@ -0,0 +1,92 @@
+import numpy as np
+
+class ActorsPrediction:
+    '''
+    Predicted trajectories of the actors converted to arrays when they are received.
+    Stage k of the prediction refers to time + k * dt, the trajectories are resampled
+    on the time grid of the controller
+    '''
+    def __init__(self, time, positions, velocities, dt):
+        # Time of the first stage [s]
+        self.time = time
+        # Positions and velocities of shape (n_actors, n_stages, 2)
+        self.positions = positions
+        self.velocities = velocities
+        self.dt = dt
+        # Workspace of aligned, the prediction is aligned once per control cycle
+        self.buffers = None
+
+    @property
+    def size(self):
+        return self.positions.shape[0]
+
+    @staticmethod
+    def from_message(crowd_motion_prediction_stamped_msg, dt):
+        motion_predictions = crowd_motion_prediction_stamped_msg.crowd_motion_prediction.motion_predictions
+        n_stages = len(motion_predictions[0].positions) if len(motion_predictions) > 0 else 0
+        positions = np.empty((len(motion_predictions), n_stages, 2))
+        velocities = np.empty((len(motion_predictions), n_stages, 2))
+        for i, motion_prediction in enumerate(motion_predictions):
+            for k in range(n_stages):
+                positions[i, k] = (motion_prediction.positions[k].x, motion_prediction.positions[k].y)
+                velocities[i, k] = (motion_prediction.velocities[k].x, motion_prediction.velocities[k].y)
+        return ActorsPrediction(crowd_motion_prediction_stamped_msg.header.stamp.to_sec(),
+                                positions,
+                                velocities,
+                                dt)
+
+    def age(self, now):
+        return now - self.time
+
+    def workspace(self, n_times):
+        """
+        Buffers of aligned for n_times times, allocated by the first call
+        """
+        if self.buffers is None or self.buffers[0].shape[0] != n_times:
+            self.buffers = (np.empty(n_times),
+                            np.empty(n_times),
+                            np.empty(n_times, dtype=int),
+                            np.empty(n_times, dtype=int),
+                            np.empty((self.positions.shape[0], n_times, 2)))
+        return self.buffers
+
+    def aligned(self, times, out=None):
+        """
+        States [x, y, vx, vy] of the actors at the given times, shape (n_actors, len(times), 4),
+        written in place in out if given.
+        The stages are interpolated linearly, before the first and after the last stage
+        the positions are extrapolated with the velocity of the closest stage
+        """
+        n_stages = self.positions.shape[1]
+        s, w, k0, k1, stage = self.workspace(len(times))
+        if out is None:
+            out = np.empty((self.positions.shape[0], len(times), 4))
+        # Stage index of each time, clipped to the predicted stages in w
+        np.subtract(times, self.time, out=s)
+        s /= self.dt
+        np.clip(s, 0.0, n_stages - 1, out=w)
+        # Stages enclosing each time
+        np.floor(w, out=k0, casting='unsafe')
+        np.minimum(k0, max(n_stages - 2, 0), out=k0)
+        np.add(k0, 1, out=k1)
+        np.minimum(k1, n_stages - 1, out=k1)
+        # Time beyond the predicted stages and weight of the second stage
+        s -= w
+        s *= self.dt
+        w -= k0
+
+        positions = out[..., :2]
+        velocities = out[..., 2:]
+        np.take(self.velocities, k0, axis=1, out=velocities, mode='clip')
+        np.take(self.velocities, k1, axis=1, out=stage, mode='clip')
+        stage -= velocities
+        stage *= w[:, np.newaxis]
+        velocities += stage
+        np.take(self.positions, k0, axis=1, out=positions, mode='clip')
+        np.take(self.positions, k1, axis=1, out=stage, mode='clip')
+        stage -= positions
+        stage *= w[:, np.newaxis]
+        positions += stage
+        np.multiply(velocities, s[:, np.newaxis], out=stage)
+        positions += stage
+        return out
@@ -0,0 +1,166 @@
+import numpy as np
+import os
+import csv
+import argparse
+from multiprocessing import Pool
+
+from tiago_obst_avoidance.Geometry import AdmittedRegion
+from tiago_obst_avoidance.LogReader import LogReader, find_runs, CONTROLLER_SUFFIX, PREDICTOR_SUFFIX
+
+# Columns of the comparison table: KPI name -> format
+KPI_COLUMNS = {
+    'duration': '{:.2f}',
+    'time_to_goal': '{:.2f}',
+    'path_length': '{:.3f}',
+    'min_actor_clearance': '{:.3f}',
+    'actor_clearance_margin': '{:+.3f}',
+    'min_boundary_clearance': '{:.3f}',
+    'boundary_clearance_margin': '{:+.3f}',
+    'deadline_miss_rate': '{:.2%}',
+    'cpu_time_p50': '{:.4f}',
+    'cpu_time_p99': '{:.4f}',
+    'predictor_cpu_time_p99': '{:.4f}',
+    'solver_failures': '{:.0f}'
+}
+
+def path_length(positions):
+    return float(np.sum(np.linalg.norm(np.diff(positions, axis=0), axis=1)))
+
+def time_to_goal(positions, targets, times, error_tol):
+    """
+    Time from the instant the last target is set to the first instant the robot is
+    within error_tol from it, nan if it is never reached
+    """
+    if times.shape[0] == 0:
+        return np.nan
+    changed = np.nonzero(np.any(targets != targets[-1], axis=1))[0]
+    t_set = 0 if changed.shape[0] == 0 else changed[-1] + 1
+    reached = np.nonzero(np.linalg.norm(positions[t_set:] - targets[-1], axis=1) < error_tol)[0]
+    if reached.shape[0] == 0:
+        return np.nan
+    return float(times[t_set + reached[0]] - times[t_set])
+
+def actor_clearances(positions, actors_positions):
+    """
+    Distance of each position from the closest actor, nan if no actor is present.
+    Actors at the origin are not detected
+    """
+    distances = np.linalg.norm(actors_positions - positions[:, np.newaxis, :], axis=2)
+    distances[np.all(actors_positions == 0.0, axis=2)] = np.nan
+    clearances = np.full(positions.shape[0], np.nan)
+    detected = ~np.all(np.isnan(distances), axis=1)
+    clearances[detected] = np.nanmin(distances[detected], axis=1)
+    return clearances
+
+def logged_actors_positions(controller_log, window=(None, None)):
+    """
+    Ground truth of the actors when available, otherwise their estimated positions
+    """
+    if controller_log.has_channel('actors_gt'):
+        return controller_log.read('actors_gt', *window)[0]
+    return controller_log.read('actors_predictions', *window)[0][:, :, :, 0]
+
+def nanmin(values):
+    return float(np.nanmin(values)) if np.any(~np.isnan(values)) else np.nan
+
+def run_kpis(controller_log, predictor_log=None, window=(None, None)):
+    """
+    KPIs of a run as a dictionary with the keys of KPI_COLUMNS
+    """
+    states, times = controller_log.read('states', *window)
+    targets, _ = controller_log.read('targets', *window)
+    cpu_time, _ = controller_log.read('cpu_time', *window)
+    # Channels of a log still written may differ by one row
+    n = min(states.shape[0], targets.shape[0], cpu_time.shape[0])
+    positions = states[:n, :2]
+    times = times[:n]
+    rho_cbf = controller_log['rho_cbf']
+    ds_cbf = controller_log['ds_cbf']
+
+    kpis = dict.fromkeys(KPI_COLUMNS, np.nan)
+    if n == 0:
+        return kpis
+    kpis['duration'] = float(times[-1] - times[0])
+    kpis['path_length'] = path_length(positions)
+    # Old logs do not store the tolerance, use the one of the real robot
+    kpis['time_to_goal'] = time_to_goal(positions, targets[:n], times, controller_log.metadata.get('error_tol', 0.05))
+
+    # Distance of each position from the boundary of the admitted region, negative outside
+    boundary = AdmittedRegion.from_vertexes(controller_log['boundary_vertexes']).signed_distances(positions)
+    kpis['min_boundary_clearance'] = float(np.min(boundary))
+    kpis['boundary_clearance_margin'] = kpis['min_boundary_clearance'] - rho_cbf
+
+    if controller_log['n_actors'] > 0:
+        actors_positions = logged_actors_positions(controller_log, window)
+        m = min(n, actors_positions.shape[0])
+        kpis['min_actor_clearance'] = nanmin(actor_clearances(positions[:m], actors_positions[:m]))
+        kpis['actor_clearance_margin'] = kpis['min_actor_clearance'] - (rho_cbf + ds_cbf)
+
+    cpu_time = cpu_time[:n]
+    if controller_log.has_channel('deadline_miss'):
+        deadline_miss, _ = controller_log.read('deadline_miss', *window)
+        kpis['deadline_miss_rate'] = float(np.mean(deadline_miss[:n])) if deadline_miss.shape[0] > 0 else np.nan
+    else:
+        # Older logs: iterations longer than the period
+        kpis['deadline_miss_rate'] = float(np.mean(cpu_time > 1 / controller_log['frequency']))
+    kpis['cpu_time_p50'], kpis['cpu_time_p99'] = np.percentile(cpu_time, [50, 99]).tolist()
+    if predictor_log is not None:
+        predictor_cpu_time, _ = predictor_log.read('cpu_time', *window)
+        if predictor_cpu_time.shape[0] > 0:
+            kpis['predictor_cpu_time_p99'] = float(np.percentile(predictor_cpu_time, 99))
+    if controller_log.has_channel('solver_status'):
+        solver_status, _ = controller_log.read('solver_status', *window)
+        kpis['solver_failures'] = int(np.count_nonzero(solver_status > 0))
+    return kpis
+
+def open_run(log_dir, filename):
+    controller_log = LogReader(os.path.join(log_dir, filename + CONTROLLER_SUFFIX))
+    predictor_path = os.path.join(log_dir, filename + PREDICTOR_SUFFIX)
+    predictor_log = LogReader(predictor_path) if os.path.isdir(predictor_path) else None
+    return controller_log, predictor_log
+
+def run_task(task):
+    log_dir, filename = task
+    try:
+        return filename, run_kpis(*open_run(log_dir, filename)), None
+    except Exception as e:
+        return filename, None, e
+
+def format_table(rows):
+    """
+    Text table of the KPIs of the runs, rows is a list of (filename, kpis)
+    """
+    header = ['run'] + list(KPI_COLUMNS)
+    lines = [header]
+    for filename, kpis in rows:
+        lines.append([filename] + ['-' if np.isnan(kpis[key]) else fmt.format(kpis[key])
+                                   for key, fmt in KPI_COLUMNS.items()])
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(line, widths)) for line in lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the KPIs of logged runs')
+    parser.add_argument('paths', nargs='*', default=['/tmp/tiago_obst_avoidance/data'],
+                        help='log directories or glob patterns of controller logs')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of runs analysed in parallel')
+    parser.add_argument('--csv', default=None,
+                        help='also write the table to this .csv file')
+    args = parser.parse_args()
+
+    tasks = find_runs(args.paths)
+    rows = []
+    with Pool(max(1, min(args.jobs, len(tasks)))) as pool:
+        for filename, kpis, error in pool.imap(run_task, tasks):
+            if error is None:
+                rows.append((filename, kpis))
+            else:
+                print(f"Failed to analyse {filename}: {error}")
+
+    print(format_table(rows))
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['run'] + list(KPI_COLUMNS))
+            for filename, kpis in rows:
+                writer.writerow([filename] + [kpis[key] for key in KPI_COLUMNS])
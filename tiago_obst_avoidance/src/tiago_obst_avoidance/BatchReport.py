@@ -0,0 +1,76 @@
+import os
+import argparse
+from multiprocessing import Pool
+
+# Reports are rendered off-screen, the backend must be set before pyplot is imported
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from tiago_obst_avoidance.LogReader import find_runs, CONTROLLER_SUFFIX, PREDICTOR_SUFFIX
+from tiago_obst_avoidance.Plotter import open_logs, plot_time, plot_configuration
+
+def report_paths(filename, output_dir):
+    return [os.path.join(output_dir, filename + '_time.png'),
+            os.path.join(output_dir, filename + '_configuration.png')]
+
+def last_modified(log_path):
+    if not os.path.isdir(log_path):
+        return 0.0
+    return max((os.path.getmtime(os.path.join(log_path, entry)) for entry in os.listdir(log_path)), default=0.0)
+
+def is_up_to_date(log_dir, filename, output_dir):
+    """
+    True if all the figures of the run are newer than its logs
+    """
+    log_mtime = max(last_modified(os.path.join(log_dir, filename + CONTROLLER_SUFFIX)),
+                    last_modified(os.path.join(log_dir, filename + PREDICTOR_SUFFIX)))
+    return all(os.path.exists(path) and os.path.getmtime(path) >= log_mtime
+               for path in report_paths(filename, output_dir))
+
+def render_report(task):
+    """
+    Render the timing and configuration figures of a run, in a worker process
+    """
+    log_dir, filename, output_dir = task
+    try:
+        controller_log, predictor_log = open_logs(filename, log_dir)
+        time_savepath, configuration_savepath = report_paths(filename, output_dir)
+        time_fig = plot_time(controller_log, predictor_log)
+        time_fig.savefig(time_savepath)
+        plt.close(time_fig)
+        config_fig = plot_configuration(controller_log)
+        config_fig.savefig(configuration_savepath)
+        plt.close(config_fig)
+        return filename, None
+    except Exception as e:
+        return filename, e
+
+def main():
+    parser = argparse.ArgumentParser(description='Render the timing and configuration figures of logged runs')
+    parser.add_argument('paths', nargs='*', default=['/tmp/tiago_obst_avoidance/data'],
+                        help='log directories or glob patterns of controller logs')
+    parser.add_argument('-o', '--output-dir', default='/tmp/tiago_obst_avoidance/plots',
+                        help='directory of the figures')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of parallel reports')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='render also the runs whose figures are up to date')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    tasks = []
+    for log_dir, filename in find_runs(args.paths):
+        if args.force or not is_up_to_date(log_dir, filename, args.output_dir):
+            tasks.append((log_dir, filename, args.output_dir))
+        else:
+            print(f"Skipping {filename}, figures up to date")
+
+    with Pool(max(1, min(args.jobs, len(tasks)))) as pool:
+        for filename, error in pool.imap_unordered(render_report, tasks):
+            if error is None:
+                print(f"Rendered {filename}")
+            else:
+                print(f"Failed to render {filename}: {error}")
@@ -0,0 +1,67 @@
+import numpy as np
+import time
+import threading
+import rospy
+
+from tiago_obst_avoidance.Hparams import Hparams
+
+class CommandInterpolator:
+    '''
+    Publishes the velocity commands at command_frequency, between the solves of the NMPC.
+    The wheels accelerations of the current plan are integrated from the latest measured velocities
+    '''
+    def __init__(self,
+                 hparams : Hparams,
+                 current_plan,
+                 measured_velocities,
+                 publish_velocities):
+        # current_plan() -> (start time, inputs (N, nu)) of the plan to follow, None to stop
+        # measured_velocities() -> (v, omega, time of the measurement)
+        # publish_velocities(v, omega) publishes the command
+        self.hparams = hparams
+        self.current_plan = current_plan
+        self.measured_velocities = measured_velocities
+        self.publish_velocities = publish_velocities
+        self.frequency = hparams.command_frequency
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def command(self, now):
+        """
+        Velocities reached at the next tick applying the plan from the measured velocities
+        """
+        plan = self.current_plan()
+        if plan is None:
+            return 0.0, 0.0
+        plan_time, plan_inputs = plan
+        dt = self.hparams.dt
+        # The plan is over, stop as the controller does without a plan
+        if now >= plan_time + dt * plan_inputs.shape[0]:
+            return 0.0, 0.0
+        v, omega, measurement_time = self.measured_velocities()
+
+        # Driving and steering accelerations of each stage, constant over the stage
+        alpha_r = plan_inputs[:, self.hparams.r_wheel_idx]
+        alpha_l = plan_inputs[:, self.hparams.l_wheel_idx]
+        v_dot = self.hparams.wheel_radius * 0.5 * (alpha_r + alpha_l)
+        omega_dot = (self.hparams.wheel_radius / self.hparams.wheel_separation) * (alpha_r - alpha_l)
+
+        # Time spent in each stage between the measurement and the next tick
+        stages_start = plan_time + dt * np.arange(plan_inputs.shape[0])
+        durations = np.clip(np.minimum(stages_start + dt, now + 1 / self.frequency) -
+                            np.maximum(stages_start, measurement_time), 0.0, None)
+        return float(v + np.dot(durations, v_dot)), float(omega + np.dot(durations, omega_dot))
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+
+    def run(self):
+        rate = rospy.Rate(self.frequency)
+        while not rospy.is_shutdown() and not self.closed:
+            v, omega = self.command(time.time())
+            self.publish_velocities(v, omega)
+            rate.sleep()
@@ -1,23 +1,77 @@
 import time
-import json
 import threading
 import math
 import os
 import rospy
-import tf2_ros
 
 import gazebo_msgs.msg
 import geometry_msgs.msg
 import sensor_msgs.msg
 
-from numpy.linalg import *
+import numpy as np
+from numpy.linalg import norm
 
-from tiago_obst_avoidance.Hparams import *
-from tiago_obst_avoidance.NMPC import *
-from tiago_obst_avoidance.RobotStatus import *
-from tiago_obst_avoidance.utils import *
+from tiago_obst_avoidance.Hparams import Hparams
+from tiago_obst_avoidance.RobotStatus import RobotStatus
+from tiago_obst_avoidance.utils import State, plan_input
+from tiago_obst_avoidance.ActorsPrediction import ActorsPrediction
+from tiago_obst_avoidance.PoseTracker import PoseTracker
+from tiago_obst_avoidance.TopicIngestion import JointVelocities, ModelPoses
+from tiago_obst_avoidance.Profiling import StartupProfiler, AllocationTracer
+from tiago_obst_avoidance.CommandInterpolator import CommandInterpolator
+from tiago_obst_avoidance.Logger import Logger, LogRing
 
 import tiago_msgs.srv
+from dynamic_reconfigure.server import Server as ReconfigureServer
+from tiago_obst_avoidance.cfg import ControllerTuningConfig
+
+class DeadlineWatchdog:
+    '''
+    Calls on_miss from its own thread when the deadline of the current cycle
+    passes before the cycle is completed
+    '''
+    def __init__(self, on_miss):
+        self.on_miss = on_miss
+        self.condition = threading.Condition()
+        self.deadline = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    def arm(self, deadline):
+        with self.condition:
+            self.deadline = deadline
+            self.condition.notify()
+
+    def disarm(self):
+        """
+        Complete the cycle, return False if the deadline has been missed
+        """
+        with self.condition:
+            in_time = self.deadline is not None
+            self.deadline = None
+            self.condition.notify()
+            return in_time
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def watch(self):
+        with self.condition:
+            while not self.closed:
+                if self.deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = self.deadline - time.time()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                # Still holding the lock: the cycle cannot complete while on_miss runs
+                self.deadline = None
+                self.on_miss()
 
 class ControllerManager:
     def __init__(self):
@@ -34,24 +88,43 @@ class ControllerManager:
         self.status = RobotStatus.WAITING
         
         self.sensing = False
-
-        # counter for the angle unwrapping
-        self.k = 0
-        self.previous_theta = 0.0
+        # acados status of the current iteration, -1 if the NMPC has not been solved
+        self.solver_status = -1
+        # Start time and inputs of the last successful solve, None if there is no plan to follow
+        self.plan = None
+        # Commands published when a cycle misses its deadline
+        self.deadline_misses = 0
+        self.last_command = (0.0, 0.0)
 
         # NMPC:
+        # acados and casadi are only imported when the solver is built,
+        # the latency compensation imports casadi through the kinematic model
+        from tiago_obst_avoidance.NMPC import NMPC
+        from tiago_obst_avoidance.LatencyCompensation import LatencyCompensation
         self.nmpc_controller = NMPC(self.hparams)
 
+        self.init_workspaces()
+
         self.state = State(0.0, 0.0, 0.0, 0.0, 0.0)
+        # Time at which the pose of the state has been measured
+        self.state_time = time.time()
+        self.latency_compensation = LatencyCompensation(self.hparams) if self.hparams.latency_compensation else None
+        # Wheels velocities used by the current iteration
         self.wheels_vel = np.zeros(2) # [w_r, w_l]
+        # Latest wheels velocities, written in place by the joint_states subscriber
+        self.wheels_velocities = JointVelocities(self.hparams.wheel_joints, self.hparams.wheel_joints_fallback)
+        # Ground truth of the actors in simulation, [x, y, theta] written in place by the model_states subscriber
+        self.actors_poses = None
         if self.hparams.simulation and not self.hparams.fake_sensing:
-            self.actors_configuration = np.zeros(self.hparams.n_actors, dtype=Configuration)
-            self.actors_name = ['cylinder_{}'.format(i) for i in range(self.hparams.n_actors)]
-        self.crowd_motion_prediction_stamped = CrowdMotionPredictionStamped(rospy.Time.now(),
-                                                                            'map',
-                                                                            CrowdMotionPrediction())
+            self.actors_poses = ModelPoses(['cylinder_{}'.format(i) for i in range(self.hparams.n_actors)],
+                                           self.hparams.model_states_rate)
+        # Latest actors prediction, None until a prediction of the actors is received
+        self.actors_prediction = None
         # Set real-time prediction:
-        self.crowd_motion_prediction_stamped_rt = self.crowd_motion_prediction_stamped
+        self.actors_prediction_rt = self.actors_prediction
+        # Age of the prediction used by the current iteration and whether it is older than prediction_max_age
+        self.prediction_age = 0.0
+        self.prediction_stale = False
 
         # Setup publisher for wheel velocity commands:
         # cmd_vel_topic = '/mobile_base_controller/cmd_vel'
@@ -66,9 +139,8 @@ class ControllerManager:
         self.map_frame = 'map'
         self.base_footprint_frame = 'base_footprint'
 
-        # Setup TF listener:
-        self.tf_buffer = tf2_ros.Buffer()
-        self.tf_listener = tf2_ros.TransformListener(self.tf_buffer)        
+        # Setup the pose source, updated by the TF messages, with theta unwrapped:
+        self.pose_tracker = PoseTracker(self.map_frame, self.base_footprint_frame)
 
         # Setup ROS Service to set target position:
         self.set_desired_target_position_srv = rospy.Service(
@@ -77,12 +149,43 @@ class ControllerManager:
             self.set_desired_target_position_request
         )
 
+        # Tuning requested while running, applied by the control loop between two iterations
+        self.tuning_lock = threading.Lock()
+        self.pending_hparams = None
+        self.retunings = []
+
+        # Setup ROS Service and dynamic reconfigure server to change the tunable parameters:
+        self.set_controller_tuning_srv = rospy.Service(
+            'SetControllerTuning',
+            tiago_msgs.srv.SetControllerTuning,
+            self.set_controller_tuning_request
+        )
+        # The reconfigure server starts from the current values, not from the defaults of the .cfg
+        for name in self.hparams.tunable:
+            rospy.set_param('~' + name, getattr(self.hparams, name))
+        self.reconfigure_server = ReconfigureServer(ControllerTuningConfig, self.reconfigure_callback)
+
+        # Setup ROS Service to change the admitted region and latched publisher of the region in use:
+        self.set_admitted_region_srv = rospy.Service(
+            'SetAdmittedRegion',
+            tiago_msgs.srv.SetAdmittedRegion,
+            self.set_admitted_region_request
+        )
+        admitted_region_topic = 'admitted_region'
+        self.admitted_region_publisher = rospy.Publisher(
+            admitted_region_topic,
+            geometry_msgs.msg.Polygon,
+            queue_size=1,
+            latch=True
+        )
+        self.publish_admitted_region()
+
         # Setup subscriber for joint_states topic
         state_topic = '/joint_states'
         rospy.Subscriber(
             state_topic,
             sensor_msgs.msg.JointState,
-            self.joint_states_callback
+            self.wheels_velocities.callback
         )
         
         # Setup subscriber for crowd motion prediction:
@@ -94,24 +197,55 @@ class ControllerManager:
         )
 
         # Setup subscriber for model_states topic
-        model_states_topic = "/gazebo/model_states"
-        rospy.Subscriber(
-            model_states_topic,
-            gazebo_msgs.msg.ModelStates,
-            self.gazebo_model_states_callback
-        )
-        # Set variables to store data
+        if self.actors_poses is not None:
+            model_states_topic = "/gazebo/model_states"
+            rospy.Subscriber(
+                model_states_topic,
+                gazebo_msgs.msg.ModelStates,
+                self.actors_poses.callback
+            )
+        # Set the logger to store data
         if self.hparams.log:
-            self.state_history = []
-            self.robot_prediction_history = []
-            self.wheels_vel_history = []
-            self.wheels_acc_history = []
-            self.commands_history = []
-            self.target_history = []
-            self.actors_prediction_history = []
-            self.actors_gt_history = []
-            self.time_history = []
-            self.boundary_vertexes = []
+            log_dir = '/tmp/tiago_obst_avoidance/data'
+            self.logger = Logger(os.path.join(log_dir, self.hparams.controller_file))
+            self.init_log()
+            # Slots filled by the control loop, converted and written by the logging worker
+            N = self.hparams.N_horizon
+            nq = self.nmpc_controller.nq
+            fields = {
+                'start_time': ((), np.float64),
+                'states': ((nq,), np.float64),
+                'robot_predictions': ((nq, N + 1), np.float64),
+                'wheels_velocities': ((2,), np.float64),
+                'wheels_accelerations': ((2,), np.float64),
+                'commanded_velocities': ((2,), np.float64),
+                'targets': ((2,), np.float64),
+                'solver_status': ((), np.int32),
+                'deadline_miss': ((), np.uint8),
+                'prediction_age': ((), np.float64),
+                'cpu_time': ((), np.float64)
+            }
+            if self.actors_poses is not None:
+                fields['actors_gt'] = ((self.hparams.n_actors, 2), np.float64)
+            self.log_ring = LogRing(fields, self.write_log_slot)
+
+    def init_workspaces(self):
+        """
+        Workspaces of the control cycle, filled in place at each iteration
+        """
+        N = self.hparams.N_horizon
+        self.q_ref = np.zeros((self.nmpc_controller.nq, N + 1))
+        self.u_ref = np.zeros((self.nmpc_controller.nu, N))
+        self.error = np.zeros(4)
+        self.state_vector = np.zeros(self.nmpc_controller.nq)
+        self.solve_state = State(0.0, 0.0, 0.0, 0.0, 0.0)
+        self.stages_offset = self.hparams.dt * np.arange(N)
+        self.stages_time = np.zeros(N)
+        self.actors_states = np.zeros((self.hparams.n_clusters, N, self.nmpc_controller.actor_state_size))
+        # Input of the iterations without a plan, never written
+        self.zero_input = np.zeros(self.nmpc_controller.nu)
+        # Predicted trajectories of the actors, converted by the logging worker
+        self.predicted_trajectory = np.zeros((self.hparams.n_clusters, 2, N))
 
     def init(self):
         # Initialize target position to the current position
@@ -133,18 +267,18 @@ class ControllerManager:
 
         return v, omega
 
-    def publish_command(self):
+    def publish_command(self, control_input):
         """
         The NMPC solver returns wheels accelerations as control input
         Transform it into the avilable robot control input: driving and steering velocities
         """
-        if all(input == 0.0 for input in self.control_input):
+        if all(input == 0.0 for input in control_input):
             v = 0.0
             omega = 0.0
         else:
             dt = 1 / self.hparams.controller_frequency
-            alpha_r = self.control_input[self.hparams.r_wheel_idx]
-            alpha_l = self.control_input[self.hparams.l_wheel_idx]
+            alpha_r = control_input[self.hparams.r_wheel_idx]
+            alpha_l = control_input[self.hparams.l_wheel_idx]
             wheel_radius = self.hparams.wheel_radius
             wheel_separation = self.hparams.wheel_separation
 
@@ -157,6 +291,9 @@ class ControllerManager:
             omega = self.state.omega + omega_dot * dt
             # v, omega = self.saturate_velocities(v, omega)
 
+        return self.publish_velocities(v, omega)
+
+    def publish_velocities(self, v, omega):
         # Create a twist ROS message:
         cmd_vel_msg = geometry_msgs.msg.Twist()
         cmd_vel_msg.linear.x = v
@@ -171,83 +308,98 @@ class ControllerManager:
 
         # Publish wheel velocity commands
         self.cmd_vel_publisher.publish(cmd_vel_msg)
+        self.last_command = (v, omega)
         return v, omega
-    
-    def joint_states_callback(self, msg):
-        self.wheels_vel = np.array([msg.velocity[13], msg.velocity[12]])
 
-    def crowd_motion_prediction_stamped_callback(self, msg):
-        crowd_motion_prediction_stamped = CrowdMotionPredictionStamped.from_message(msg)
-        self.data_lock.acquire()
-        self.crowd_motion_prediction_stamped = crowd_motion_prediction_stamped
-        self.data_lock.release()
-        if len(self.crowd_motion_prediction_stamped.crowd_motion_prediction.motion_predictions) != 0:
-            self.sensing = True
-        else:
-            self.sensing = False
+    def fallback_input(self, now):
+        """
+        Input of the last valid plan at the current time, zeros if there is no plan to follow
+        """
+        u = plan_input(self.current_plan(), now, self.hparams.dt)
+        return self.zero_input if u is None else u
 
-    def gazebo_model_states_callback(self, msg):
-        if self.hparams.simulation and not self.hparams.fake_sensing:
-            actors_configuration = np.empty(self.hparams.n_actors, dtype=Configuration)
-            idx = 0
-            for actor_name in self.actors_name:
-                if actor_name in msg.name:
-                    actor_idx = msg.name.index(actor_name)
-                    p = msg.pose[actor_idx].position
-                    q = msg.pose[actor_idx].orientation
-                    actor_configuration = Configuration(
-                        p.x,
-                        p.y,
-                        math.atan2(2.0 * (q.w * q.z + q.x * q.y),
-                                   1.0 - 2.0 * (q.y**2 + q.z**2))
-                    )
-                    actors_configuration[idx] = actor_configuration
-                idx = idx + 1
+    def current_plan(self):
+        """
+        Start time and inputs of the plan to follow, None if the robot must stop.
+        The inputs are a buffer of the NMPC that is written again two solves later:
+        use them within the current control period, copy them to keep them longer
+        """
+        plan = self.plan
+        if self.status != RobotStatus.MOVING:
+            return None
+        return plan
 
-            self.data_lock.acquire()
-            self.actors_configuration = actors_configuration
+    def measured_velocities(self):
+        """
+        Driving and steering velocities of the latest wheels velocities, with their time
+        """
+        wheels_vel, measurement_time = self.wheels_velocities.latest()
+        v = self.hparams.wheel_radius * 0.5 * \
+            (wheels_vel[self.hparams.r_wheel_idx] + wheels_vel[self.hparams.l_wheel_idx])
+        omega = (self.hparams.wheel_radius / self.hparams.wheel_separation) * \
+            (wheels_vel[self.hparams.r_wheel_idx] - wheels_vel[self.hparams.l_wheel_idx])
+        return v, omega, measurement_time
+
+    def publish_fallback_command(self):
+        """
+        Called by the watchdog when the current iteration misses its deadline
+        """
+        self.data_lock.acquire()
+        try:
+            self.publish_command(self.fallback_input(time.time()))
+        finally:
             self.data_lock.release()
+    
+    def crowd_motion_prediction_stamped_callback(self, msg):
+        # Converted once here, the control loop only resamples the arrays
+        actors_prediction = ActorsPrediction.from_message(msg, self.hparams.dt)
+        if actors_prediction.size == 0:
+            actors_prediction = None
+        self.data_lock.acquire()
+        self.actors_prediction = actors_prediction
+        self.data_lock.release()
+        self.sensing = actors_prediction is not None
 
-    def set_from_tf_transform(self, transform):
-        q = transform.transform.rotation
-        theta = math.atan2(
-            2.0 * (q.w * q.z + q.x * q.y),
-            1.0 - 2.0 * (q.y * q.y + q.z * q.z)
-        )
-        
-        product = self.previous_theta * theta
-        if product < - 8:
-            # passing through pi [rad]
-            if theta > 0.0:
-                # from negative angle to positive angle
-                self.k -= 1
-            elif theta < 0.0:
-                # from positive angle to negative angle
-                self.k += 1
-        self.previous_theta = theta
-        self.state.theta = theta + self.k * 2 * math.pi
-        self.state.x = transform.transform.translation.x + self.hparams.b * math.cos(self.state.theta)
-        self.state.y = transform.transform.translation.y + self.hparams.b * math.sin(self.state.theta)
+    def aligned_actors_states(self, plan_time):
+        """
+        States of the actors at the stages of the plan starting at plan_time, from the
+        prediction stamped with its own start time. Flag the prediction if it is stale
+        """
+        if self.actors_prediction_rt is None:
+            self.actors_states.fill(0.0)
+            return self.actors_states
+        self.prediction_age = self.actors_prediction_rt.age(self.cycle_start)
+        self.prediction_stale = self.prediction_age > self.hparams.prediction_max_age
+        if self.prediction_stale:
+            rospy.logwarn_throttle(1.0, f"The actors prediction is stale, received {self.prediction_age:.3f} s ago")
+        np.add(self.stages_offset, plan_time, out=self.stages_time)
+        return self.actors_prediction_rt.aligned(self.stages_time, out=self.actors_states)
+
+    def set_from_pose(self, pose):
+        x, y, theta = pose
+        self.state.theta = theta
+        self.state.x = x + self.hparams.b * math.cos(theta)
+        self.state.y = y + self.hparams.b * math.sin(theta)
 
     def update_state(self):
-        try:
-            # Update [x, y, theta]
-            transform = self.tf_buffer.lookup_transform(
-                self.map_frame, self.base_footprint_frame, rospy.Time()
-            )
-            self.set_from_tf_transform(transform)
-            # Update [v, omega]
-            self.state.v = self.hparams.wheel_radius * 0.5 * \
-                (self.wheels_vel[self.hparams.r_wheel_idx] + self.wheels_vel[self.hparams.l_wheel_idx])
-            
-            self.state.omega = (self.hparams.wheel_radius / self.hparams.wheel_separation) * \
-                (self.wheels_vel[self.hparams.r_wheel_idx] - self.wheels_vel[self.hparams.l_wheel_idx])
-            return True
-        except(tf2_ros.LookupException,
-               tf2_ros.ConnectivityException,
-               tf2_ros.ExtrapolationException):
+        # Update [x, y, theta]
+        latest = self.pose_tracker.latest()
+        if latest is None:
             rospy.logwarn("Missing current state")
             return False
+        pose, stamp = latest
+        self.set_from_pose(pose)
+        # Age of the pose, in wall time as the other times of the loop
+        age = rospy.Time.now().to_sec() - stamp
+        self.state_time = time.time() - max(0.0, age)
+        # Update [v, omega]
+        self.wheels_vel[:] = self.wheels_velocities.latest()[0]
+        self.state.v = self.hparams.wheel_radius * 0.5 * \
+            (self.wheels_vel[self.hparams.r_wheel_idx] + self.wheels_vel[self.hparams.l_wheel_idx])
+        
+        self.state.omega = (self.hparams.wheel_radius / self.hparams.wheel_separation) * \
+            (self.wheels_vel[self.hparams.r_wheel_idx] - self.wheels_vel[self.hparams.l_wheel_idx])
+        return True
 
     def set_desired_target_position_request(self, request):
         if self.status == RobotStatus.WAITING:
@@ -263,73 +415,204 @@ class ControllerManager:
                 rospy.loginfo(f"Desired target position successfully changed: {self.target_position}")
             return tiago_msgs.srv.SetDesiredTargetPositionResponse(True)
         
-    def log_values(self):
-        output_dict = {}
-        output_dict['states'] = self.state_history
-        output_dict['robot_predictions'] = self.robot_prediction_history
-        output_dict['wheels_velocities'] = self.wheels_vel_history
-        output_dict['wheels_accelerations'] = self.wheels_acc_history
-        output_dict['commanded_velocities'] = self.commands_history
-        output_dict['targets'] = self.target_history
-        output_dict['cpu_time'] = self.time_history
-
-        output_dict['n_actors'] = self.hparams.n_actors
-        output_dict['n_clusters'] = self.hparams.n_clusters
-        output_dict['simulation'] = self.hparams.simulation
-        if self.hparams.n_actors > 0:        
-            output_dict['actors_predictions'] = self.actors_prediction_history
-            output_dict['fake_sensing'] = self.hparams.fake_sensing
+    def request_tuning(self, changes):
+        """
+        Validate the changes of the tunable parameters and queue them for the control loop.
+        Return True if they are valid
+        """
+        with self.tuning_lock:
+            # Requests not applied yet are merged
+            hparams = self.pending_hparams if self.pending_hparams is not None else self.hparams
+            changes = {name: value for name, value in changes.items()
+                       if not np.array_equal(getattr(hparams, name, None), value)}
+            if not changes:
+                return True
+            try:
+                self.pending_hparams = hparams.retuned(changes)
+            except Exception as e:
+                rospy.logwarn(f"Tuning rejected: {e}")
+                return False
+        rospy.loginfo(f"Tuning requested: {changes}")
+        return True
+
+    def apply_tuning(self):
+        """
+        Set the parameters requested since the last iteration in the controller and in the solver
+        """
+        with self.tuning_lock:
+            hparams, self.pending_hparams = self.pending_hparams, None
+        if hparams is None:
+            return
+        changes = {name: np.asarray(getattr(hparams, name)).tolist() for name in self.hparams.tunable + ('vertexes',)
+                   if not np.array_equal(getattr(hparams, name), getattr(self.hparams, name))}
+        self.hparams = hparams
+        self.nmpc_controller.set_tuning(hparams)
+        rospy.loginfo(f"Tuning applied: {changes}")
+        if 'vertexes' in changes:
+            self.publish_admitted_region()
+        if self.hparams.log:
+            self.retunings.append({'time': time.time(), 'changes': changes})
+            self.logger.set_metadata(retunings=self.retunings)
+
+    def set_controller_tuning_request(self, request):
+        if len(request.names) != len(request.values):
+            rospy.logwarn("Tuning rejected: names and values must have the same length")
+            return tiago_msgs.srv.SetControllerTuningResponse(False)
+        success = self.request_tuning(dict(zip(request.names, request.values)))
+        return tiago_msgs.srv.SetControllerTuningResponse(success)
+
+    def set_admitted_region_request(self, request):
+        success = self.request_tuning({'vertexes': [[point.x, point.y] for point in request.region.points]})
+        return tiago_msgs.srv.SetAdmittedRegionResponse(success)
+
+    def publish_admitted_region(self):
+        region_msg = geometry_msgs.msg.Polygon(
+            [geometry_msgs.msg.Point32(x, y, 0.0) for x, y in self.hparams.vertexes]
+        )
+        self.admitted_region_publisher.publish(region_msg)
+
+    def reconfigure_callback(self, config, level):
+        changes = {name: config[name] for name in self.hparams.tunable}
+        if not self.request_tuning(changes):
+            # Show the values in use
+            hparams = self.pending_hparams if self.pending_hparams is not None else self.hparams
+            for name in self.hparams.tunable:
+                config[name] = getattr(hparams, name)
+        return config
+
+    def init_log(self):
+        N = self.hparams.N_horizon
+        self.logger.add_channel('states', (self.nmpc_controller.nq,))
+        self.logger.add_channel('robot_predictions', (self.nmpc_controller.nq, N + 1))
+        self.logger.add_channel('wheels_velocities', (2,))
+        self.logger.add_channel('wheels_accelerations', (2,))
+        self.logger.add_channel('commanded_velocities', (2,))
+        self.logger.add_channel('targets', (2,))
+        self.logger.add_channel('solver_status', (), np.int32)
+        self.logger.add_channel('deadline_miss', (), np.uint8)
+        self.logger.add_channel('prediction_age')
+        self.logger.add_channel('cpu_time')
+
+        metadata = {}
+        metadata['n_actors'] = self.hparams.n_actors
+        metadata['n_clusters'] = self.hparams.n_clusters
+        metadata['simulation'] = self.hparams.simulation
+        metadata['hparams_fingerprint'] = self.hparams.fingerprint
+        if self.hparams.n_actors > 0:
+            self.logger.add_channel('actors_predictions', (self.hparams.n_clusters, 2, N))
+            metadata['fake_sensing'] = self.hparams.fake_sensing
             if self.hparams.simulation and not self.hparams.fake_sensing:
-                output_dict['actors_gt'] = self.actors_gt_history
-
-        for i in range(self.hparams.n_points):
-            self.boundary_vertexes.append(self.hparams.vertexes[i].tolist())
-        output_dict['n_edges'] = self.hparams.n_points
-        output_dict['boundary_vertexes'] = self.boundary_vertexes   
-        output_dict['input_bounds'] = [self.hparams.alpha_min, self.hparams.alpha_max]
-        output_dict['v_bounds'] = [self.hparams.driving_vel_min, self.hparams.driving_vel_max]
-        output_dict['omega_bounds'] = [self.hparams.steering_vel_max_neg, self.hparams.steering_vel_max]
-        output_dict['wheels_vel_bounds'] = [self.hparams.w_max_neg, self.hparams.w_max]
-        output_dict['vdot_bounds'] = [self.hparams.driving_acc_min, self.hparams.driving_acc_max]
-        output_dict['omegadot_bounds'] = [self.hparams.steering_acc_max_neg, self.hparams.steering_acc_max]
-
-        output_dict['rho_cbf'] = self.hparams.rho_cbf
-        output_dict['ds_cbf'] = self.hparams.ds_cbf
-        output_dict['gamma_bound'] = self.hparams.gamma_bound
-        output_dict['gamma_actor'] = self.hparams.gamma_actor
-        output_dict['frequency'] = self.hparams.controller_frequency
-        output_dict['dt'] = self.hparams.dt
-        output_dict['N_horizon'] = self.hparams.N_horizon
-        output_dict['position_weight'] = self.hparams.p_weight
-        output_dict['v_weight'] = self.hparams.v_weight
-        output_dict['omega_weight'] = self.hparams.omega_weight
-        output_dict['input_weight'] = self.hparams.u_weight
-        output_dict['terminal_factor_p'] = self.hparams.terminal_factor_p
-        output_dict['terminal_factor_v'] = self.hparams.terminal_factor_v
-        output_dict['offset_b'] = self.hparams.b
-        output_dict['base_radius'] = self.hparams.base_radius
-        output_dict['wheel_radius'] = self.hparams.wheel_radius
-        output_dict['wheel_separation'] = self.hparams.wheel_separation
-
-        # log the data in a .json file
-        log_dir = '/tmp/tiago_obst_avoidance/data'
-        filename = self.hparams.controller_file
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-        log_path = os.path.join(log_dir, filename)
-        with open(log_path, 'w') as file:
-            json.dump(output_dict, file)
+                self.logger.add_channel('actors_gt', (self.hparams.n_actors, 2))
+
+        metadata['n_edges'] = self.hparams.n_points
+        metadata['boundary_vertexes'] = self.hparams.vertexes.tolist()
+        metadata['input_bounds'] = [self.hparams.alpha_min, self.hparams.alpha_max]
+        metadata['v_bounds'] = [self.hparams.driving_vel_min, self.hparams.driving_vel_max]
+        metadata['omega_bounds'] = [self.hparams.steering_vel_max_neg, self.hparams.steering_vel_max]
+        metadata['wheels_vel_bounds'] = [self.hparams.w_max_neg, self.hparams.w_max]
+        metadata['vdot_bounds'] = [self.hparams.driving_acc_min, self.hparams.driving_acc_max]
+        metadata['omegadot_bounds'] = [self.hparams.steering_acc_max_neg, self.hparams.steering_acc_max]
+
+        metadata['rho_cbf'] = self.hparams.rho_cbf
+        metadata['ds_cbf'] = self.hparams.ds_cbf
+        metadata['gamma_bound'] = self.hparams.gamma_bound
+        metadata['gamma_actor'] = self.hparams.gamma_actor
+        metadata['frequency'] = self.hparams.controller_frequency
+        metadata['deadline'] = self.hparams.deadline
+        metadata['latency_compensation'] = self.hparams.latency_compensation
+        metadata['prediction_max_age'] = self.hparams.prediction_max_age
+        metadata['error_tol'] = self.hparams.error_tol
+        metadata['dt'] = self.hparams.dt
+        metadata['N_horizon'] = self.hparams.N_horizon
+        metadata['position_weight'] = self.hparams.p_weight
+        metadata['v_weight'] = self.hparams.v_weight
+        metadata['omega_weight'] = self.hparams.omega_weight
+        metadata['input_weight'] = self.hparams.u_weight
+        metadata['terminal_factor_p'] = self.hparams.terminal_factor_p
+        metadata['terminal_factor_v'] = self.hparams.terminal_factor_v
+        metadata['offset_b'] = self.hparams.b
+        metadata['base_radius'] = self.hparams.base_radius
+        metadata['wheel_radius'] = self.hparams.wheel_radius
+        metadata['wheel_separation'] = self.hparams.wheel_separation
+        self.logger.set_metadata(**metadata)
+
+    def capture_log_slot(self, start_time, v_cmd, omega_cmd):
+        """
+        Copy the raw values of the current iteration into a preallocated slot.
+        Return the slot index, None if no slot is available
+        """
+        idx = self.log_ring.acquire()
+        if idx is None:
+            return None
+        slot = self.log_ring.slots[idx]
+        slot['start_time'][...] = start_time
+        slot['states'][...] = (self.state.x, self.state.y, self.state.theta, self.state.v, self.state.omega)
+        slot['wheels_velocities'][...] = (self.wheels_vel[self.hparams.r_wheel_idx],
+                                          self.wheels_vel[self.hparams.l_wheel_idx])
+        slot['wheels_accelerations'][...] = (self.control_input[self.hparams.r_wheel_idx],
+                                             self.control_input[self.hparams.l_wheel_idx])
+        slot['commanded_velocities'][...] = (v_cmd, omega_cmd)
+        slot['targets'][...] = (self.target_position[self.hparams.x_idx],
+                                self.target_position[self.hparams.y_idx])
+        slot['solver_status'][...] = self.solver_status
+        slot['prediction_age'][...] = self.prediction_age
+        robot_predictions = slot['robot_predictions']
+        for i in range(self.hparams.N_horizon + 1):
+            robot_predictions[:, i] = self.nmpc_controller.acados_ocp_solver.get(i, 'x')
+
+        if self.actors_poses is not None:
+            slot['actors_gt'][...] = self.actors_poses.latest()[0][:, :2]
+
+        # The received messages are never modified, keep a reference and convert them later
+        if self.hparams.n_actors > 0:
+            objects = self.log_ring.objects[idx]
+            objects['actors_prediction'] = self.actors_prediction_rt
+        return idx
+
+    def write_log_slot(self, slot, objects):
+        start_time = float(slot['start_time'])
+        self.logger.log('states', slot['states'], start_time)
+        self.logger.log('wheels_velocities', slot['wheels_velocities'], start_time)
+        self.logger.log('wheels_accelerations', slot['wheels_accelerations'], start_time)
+        self.logger.log('commanded_velocities', slot['commanded_velocities'], start_time)
+        self.logger.log('targets', slot['targets'], start_time)
+        self.logger.log('solver_status', slot['solver_status'], start_time)
+        self.logger.log('deadline_miss', slot['deadline_miss'], start_time)
+        self.logger.log('prediction_age', slot['prediction_age'], start_time)
+        self.logger.log('robot_predictions', slot['robot_predictions'], start_time)
+
+        if self.hparams.n_actors > 0:
+            actors_prediction = objects['actors_prediction']
+            predicted_trajectory = self.predicted_trajectory
+            if actors_prediction is not None:
+                # The prediction as received, on its own time grid
+                predicted_trajectory[...] = actors_prediction.positions.transpose(0, 2, 1)
+            else:
+                predicted_trajectory.fill(0.0)
+            self.logger.log('actors_predictions', predicted_trajectory, start_time)
+
+            if self.actors_poses is not None:
+                self.logger.log('actors_gt', slot['actors_gt'], start_time)
+
+        self.logger.log('cpu_time', slot['cpu_time'], start_time)
+
+    def log_values(self):
+        # Let the worker empty the ring, then write the pending chunks and close the log files
+        self.log_ring.close()
+        self.logger.close()
+        if self.log_ring.dropped_slots > 0:
+            rospy.logwarn(f"{self.log_ring.dropped_slots} log samples have been dropped")
+        if self.logger.dropped_chunks > 0:
+            rospy.logwarn(f"{self.logger.dropped_chunks} log chunks have been dropped")
 
     def update(self):
-        q_ref = np.zeros((self.nmpc_controller.nq, self.hparams.N_horizon+1))
-        for k in range(self.hparams.N_horizon):
-            q_ref[:self.hparams.y_idx + 1, k] = self.target_position
-        u_ref = np.zeros((self.nmpc_controller.nu, self.hparams.N_horizon))
-        q_ref[:self.hparams.y_idx + 1, self.hparams.N_horizon] = self.target_position
+        # The references only change with the target position
+        self.q_ref[:self.hparams.y_idx + 1] = self.target_position[:, np.newaxis]
+        self.solver_status = -1
         
         if self.hparams.n_actors > 0:
             if self.data_lock.acquire(False):
-                self.crowd_motion_prediction_stamped_rt = self.crowd_motion_prediction_stamped
+                self.actors_prediction_rt = self.actors_prediction
                 self.data_lock.release()
 
         self.data_lock.acquire()
@@ -338,36 +621,56 @@ class ControllerManager:
 
         if flag and (self.sensing or self.hparams.n_actors == 0) and self.status == RobotStatus.MOVING:
             # Compute the position and velocity error
-            error = np.array([self.target_position[self.hparams.x_idx] - self.state.x, 
-                              self.target_position[self.hparams.y_idx] - self.state.y,
-                              0.0 - self.state.v,
-                              0.0 - self.state.omega])
+            error = self.error
+            error[0] = self.target_position[self.hparams.x_idx] - self.state.x
+            error[1] = self.target_position[self.hparams.y_idx] - self.state.y
+            error[2] = 0.0 - self.state.v
+            error[3] = 0.0 - self.state.omega
             
             if norm(error) < self.hparams.error_tol:
-                self.control_input = np.zeros((self.nmpc_controller.nu))
+                self.control_input = self.zero_input
+                self.plan = None
                 print("Stop state ###############################")
                 print(self.state)
                 print("##########################################")
                 self.status = RobotStatus.READY
             else:
+                # The plan starts from the state at the end of the solve
+                solve_state = self.state
+                plan_time = self.cycle_start
+                if self.latency_compensation is not None:
+                    q, plan_time = self.latency_compensation.predict(self.state.get_state(out=self.state_vector),
+                                                                     self.state_time,
+                                                                     time.time(),
+                                                                     self.current_plan())
+                    self.solve_state.set_state(q)
+                    solve_state = self.solve_state
                 try:
+                    solve_start = time.time()
                     self.nmpc_controller.update(
-                        self.state,
-                        q_ref,
-                        u_ref,
-                        self.crowd_motion_prediction_stamped_rt.crowd_motion_prediction
+                        solve_state,
+                        self.q_ref,
+                        self.u_ref,
+                        self.aligned_actors_states(plan_time)
                     )
                     self.control_input = self.nmpc_controller.get_command()
+                    self.solver_status = self.nmpc_controller.status
+                    self.plan = (plan_time, self.nmpc_controller.plan_inputs)
+                    if self.latency_compensation is not None:
+                        self.latency_compensation.update_latency(time.time() - solve_start)
                 except Exception as e:
-                    rospy.logwarn("NMPC solver failed")
+                    self.solver_status = self.nmpc_controller.status
+                    rospy.logwarn("NMPC solver failed, following the previous plan")
                     rospy.logwarn('{}'.format(e))
-                    self.control_input = np.zeros((self.nmpc_controller.nu))
+                    # Keep moving along the last valid plan instead of stopping abruptly
+                    self.control_input = self.fallback_input(time.time())
                     print("Failure state ############################")
                     print(self.state)
                     print("##########################################")
                 
         else:
-            self.control_input = np.zeros((self.nmpc_controller.nu))
+            self.control_input = self.zero_input
+            self.plan = None
             if not(self.sensing) and self.hparams.n_actors > 0:
                 rospy.logwarn("Missing sensing info")
             if self.status == RobotStatus.MOVING:
@@ -380,13 +683,28 @@ class ControllerManager:
                                                  self.state.y])
                 self.status = RobotStatus.READY
             
-    def run(self):
+    def run(self, startup_profiler=None):
         rate = rospy.Rate(self.hparams.controller_frequency)
         if self.hparams.log:
             rospy.on_shutdown(self.log_values)
+        # With the interpolation the commands are published by the interpolator, which keeps
+        # following the previous plan while the solve is late
+        command_interpolator = None
+        if self.hparams.command_frequency > 0:
+            command_interpolator = CommandInterpolator(self.hparams,
+                                                       self.current_plan,
+                                                       self.measured_velocities,
+                                                       self.publish_velocities)
+            deadline_watchdog = DeadlineWatchdog(lambda: None)
+        else:
+            deadline_watchdog = DeadlineWatchdog(self.publish_fallback_command)
+        # Memory retained by the cycles of the moving robot, once warmed up
+        allocation_tracer = AllocationTracer() if self.hparams.trace_allocations else None
 
         while not(rospy.is_shutdown()):
             start_time = time.time()
+            self.cycle_start = start_time
+            self.apply_tuning()
 
             if self.status == RobotStatus.WAITING:
                 if self.update_state():
@@ -395,75 +713,65 @@ class ControllerManager:
                     print("Initial state ****************************")
                     print(self.state)
                     print("******************************************")
+                    if startup_profiler is not None:
+                        startup_profiler.mark('initial_state')
+                        startup_profiler.report()
+                    if command_interpolator is not None:
+                        command_interpolator.start()
                 else:
                     rate.sleep()
                     continue
 
+            deadline_watchdog.arm(start_time + self.hparams.deadline)
             self.update()
-            v_cmd, omega_cmd = self.publish_command()
+            if deadline_watchdog.disarm():
+                deadline_miss = False
+                if command_interpolator is None:
+                    v_cmd, omega_cmd = self.publish_command(self.control_input)
+                else:
+                    v_cmd, omega_cmd = self.last_command
+            else:
+                # The input of the previous plan has already been published
+                deadline_miss = True
+                self.deadline_misses += 1
+                v_cmd, omega_cmd = self.last_command
             
             # Saving data for plots
             if self.hparams.log and (self.sensing or self.hparams.n_actors == 0):
-                self.state_history.append([
-                    self.state.x,
-                    self.state.y,
-                    self.state.theta,
-                    self.state.v,
-                    self.state.omega,
-                    start_time
-                ])
-                self.wheels_vel_history.append([
-                    self.wheels_vel[self.hparams.r_wheel_idx],
-                    self.wheels_vel[self.hparams.l_wheel_idx],
-                    start_time
-                ])
-                self.wheels_acc_history.append([
-                    self.control_input[self.hparams.r_wheel_idx],
-                    self.control_input[self.hparams.l_wheel_idx],
-                    start_time
-                ])
-                self.commands_history.append([v_cmd, omega_cmd, start_time])
-                self.target_history.append([
-                    self.target_position[self.hparams.x_idx],
-                    self.target_position[self.hparams.y_idx],
-                    start_time
-                ])
-                predicted_trajectory = np.zeros((self.nmpc_controller.nq, self.hparams.N_horizon+1))
-                for i in range(self.hparams.N_horizon):
-                    predicted_trajectory[:, i] = self.nmpc_controller.acados_ocp_solver.get(i,'x')
-                predicted_trajectory[:, self.hparams.N_horizon] = \
-                    self.nmpc_controller.acados_ocp_solver.get(self.hparams.N_horizon, 'x')
-                self.robot_prediction_history.append(predicted_trajectory.tolist())
-
-                if self.hparams.n_actors > 0:
-                    predicted_trajectory = np.zeros((self.hparams.n_clusters, 2, self.hparams.N_horizon))
-                    if len(self.crowd_motion_prediction_stamped_rt.crowd_motion_prediction.motion_predictions) != 0:
-                        for i in range(self.hparams.n_clusters):
-                            motion_prediction = self.crowd_motion_prediction_stamped_rt.crowd_motion_prediction.motion_predictions[i]
-                            for j in range(self.hparams.N_horizon):
-                                predicted_trajectory[i, 0, j] = motion_prediction.positions[j].x
-                                predicted_trajectory[i, 1, j] = motion_prediction.positions[j].y
-                    self.actors_prediction_history.append(predicted_trajectory.tolist())
-
-                    if self.hparams.simulation and not self.hparams.fake_sensing:
-                        gt_trajectory = np.zeros((self.hparams.n_actors, 2))
-                        for i in range(self.hparams.n_actors):
-                            gt_trajectory[i, 0] = self.actors_configuration[i].x
-                            gt_trajectory[i, 1] = self.actors_configuration[i].y
-                        self.actors_gt_history.append(gt_trajectory.tolist())
+                idx = self.capture_log_slot(start_time, v_cmd, omega_cmd)
 
                 end_time = time.time()        
                 deltat = end_time - start_time
-                self.time_history.append([deltat, start_time])
+                if idx is not None:
+                    self.log_ring.slots[idx]['deadline_miss'][...] = deadline_miss
+                    self.log_ring.slots[idx]['cpu_time'][...] = deltat
+                    self.log_ring.commit(idx)
                 if deltat > 1 / (2 * self.hparams.controller_frequency):
                     print(f"Iteration time {deltat} at instant {start_time}")
 
+            if allocation_tracer is not None and self.status == RobotStatus.MOVING:
+                allocation_tracer.tick()
+
             rate.sleep()
 
+        deadline_watchdog.close()
+        if command_interpolator is not None and command_interpolator.thread.is_alive():
+            command_interpolator.close()
+        if self.deadline_misses > 0:
+            rospy.logwarn(f"{self.deadline_misses} iterations have missed their deadline")
+
 def main():
+    startup_profiler = StartupProfiler()
     rospy.init_node('tiago_nmpc_controller', log_level=rospy.INFO)
     rospy.loginfo('TIAGo control module [OK]')
+    startup_profiler.mark('init_node')
+
+    # Both modules must run with the same parameters
+    Hparams.load()
+    Hparams.publish_fingerprint()
+    startup_profiler.mark('load_hparams')
 
     # Build and run controller manager
     controller_manager = ControllerManager()
-    controller_manager.run()
+    startup_profiler.mark('setup')
+    controller_manager.run(startup_profiler)
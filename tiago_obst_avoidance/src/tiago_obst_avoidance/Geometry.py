@@ -0,0 +1,187 @@
+import numpy as np
+
+# Tolerance of the collinearity and containment tests of the edges [m]
+EPSILON = 1e-9
+
+def segment_distances(points, starts, directions):
+    """
+    Distances of the points from each segment starts + t * directions, t in [0, 1], shape (..., n_segments)
+    """
+    relative = np.asarray(points, dtype=float)[..., np.newaxis, :] - starts
+    projections = np.clip(np.einsum('...ej,ej->...e', relative, directions) / np.einsum('ej,ej->e', directions, directions),
+                          0.0, 1.0)
+    return np.linalg.norm(relative - projections[..., np.newaxis] * directions, axis=-1)
+
+class ConvexRegion:
+    '''
+    Convex polygon, vertices defined COUNTER CLOCK-WISE.
+    The edges data are computed once, the queries take points of shape (..., 2)
+    '''
+    def __init__(self, vertexes):
+        self.vertexes = np.array(vertexes, dtype=float)
+        if self.vertexes.ndim != 2 or self.vertexes.shape[0] < 3 or self.vertexes.shape[1] != 2:
+            raise Exception(
+                "A region needs at least 3 [x, y] vertexes"
+            )
+        self.n_edges = self.vertexes.shape[0]
+        # Edge i goes from vertex i to vertex i + 1
+        self.directions = np.roll(self.vertexes, -1, axis=0) - self.vertexes
+        self.lengths = np.linalg.norm(self.directions, axis=1)
+        if np.any(self.lengths == 0.0):
+            raise Exception(
+                "A region cannot have coincident consecutive vertexes"
+            )
+        # Unit normals pointing inside and offsets of the edge lines: normal . p = offset on the edge
+        self.normals = np.stack((-self.directions[:, 1], self.directions[:, 0]), axis=1) / self.lengths[:, np.newaxis]
+        self.offsets = np.einsum('ej,ej->e', self.normals, self.vertexes)
+        # Turning left at every vertex
+        turns = self.directions[:, 0] * np.roll(self.directions[:, 1], -1) - \
+            self.directions[:, 1] * np.roll(self.directions[:, 0], -1)
+        if np.any(turns < 0.0):
+            raise Exception(
+                "A region must be convex with vertexes defined counter clock-wise"
+            )
+
+    def half_plane_distances(self, points):
+        """
+        Signed distances of the points from the line of each edge, shape (..., n_edges), positive inside
+        """
+        return np.asarray(points, dtype=float) @ self.normals.T - self.offsets
+
+    def edge_distances(self, points):
+        """
+        Distances of the points from each edge segment, shape (..., n_edges)
+        """
+        return segment_distances(points, self.vertexes, self.directions)
+
+    def covered_interval(self, start, direction, normal):
+        """
+        Interval [t0, t1] of the segment start + t * direction, t in [0, 1], inside the region or on an edge
+        shared with the region (collinear with an opposite normal), None if there is none
+        """
+        # normal_k . (start + t * direction) - offset_k >= 0 for every edge k of the region
+        a = self.normals @ start - self.offsets
+        b = self.normals @ direction
+        t0, t1 = 0.0, 1.0
+        for k in range(self.n_edges):
+            if abs(b[k]) <= EPSILON:
+                if a[k] < -EPSILON:
+                    return None
+                # On the line of edge k: an outer edge if the two regions are on the same side of it
+                if abs(a[k]) <= EPSILON and self.normals[k] @ normal > 0.0:
+                    return None
+            elif b[k] > 0.0:
+                t0 = max(t0, -a[k] / b[k])
+            else:
+                t1 = min(t1, -a[k] / b[k])
+        return (t0, t1) if t1 - t0 > EPSILON else None
+
+    def contains(self, points):
+        return np.all(self.half_plane_distances(points) >= 0.0, axis=-1)
+
+    def signed_distances(self, points):
+        """
+        Distance of the points from the boundary, positive inside and negative outside
+        """
+        inside = np.min(self.half_plane_distances(points), axis=-1)
+        outside = - np.min(self.edge_distances(points), axis=-1)
+        return np.where(inside >= 0.0, inside, outside)
+
+    def nearest_edges(self, points):
+        """
+        Index of the edge closest to each point
+        """
+        return np.argmin(self.edge_distances(points), axis=-1)
+
+class AdmittedRegion:
+    '''
+    Region where the robot is allowed to move: the union of convex parts,
+    a non-convex room is given decomposed in convex parts
+    '''
+    def __init__(self, parts):
+        self.parts = [part if isinstance(part, ConvexRegion) else ConvexRegion(part) for part in parts]
+        if len(self.parts) == 0:
+            raise Exception(
+                "An admitted region needs at least one part"
+            )
+        self.boundary_starts, self.boundary_directions = self.boundary_segments()
+
+    def boundary_segments(self):
+        """
+        Start and direction of the segments of the boundary of the union: the edges of the parts without
+        the pieces inside another part or shared with it
+        """
+        starts = []
+        directions = []
+        for i, part in enumerate(self.parts):
+            for start, direction, normal in zip(part.vertexes, part.directions, part.normals):
+                covered = []
+                for j, other in enumerate(self.parts):
+                    if j != i:
+                        interval = other.covered_interval(start, direction, normal)
+                        if interval is not None:
+                            covered.append(interval)
+                t = 0.0
+                for t0, t1 in sorted(covered) + [(1.0, 1.0)]:
+                    if t0 - t > EPSILON:
+                        starts.append(start + t * direction)
+                        directions.append((t0 - t) * direction)
+                    t = max(t, t1)
+        return np.array(starts).reshape(-1, 2), np.array(directions).reshape(-1, 2)
+
+    @classmethod
+    def from_vertexes(cls, vertexes):
+        return cls([vertexes])
+
+    def single_part(self):
+        """
+        The only part of the region, the edges of a region of several parts are not defined
+        """
+        if len(self.parts) != 1:
+            raise Exception(
+                "The edges are defined for a region of a single convex part"
+            )
+        return self.parts[0]
+
+    @property
+    def vertexes(self):
+        return self.single_part().vertexes
+
+    @property
+    def normals(self):
+        return self.single_part().normals
+
+    @property
+    def offsets(self):
+        return self.single_part().offsets
+
+    def contains(self, points):
+        return np.any([part.contains(points) for part in self.parts], axis=0)
+
+    def part_distances(self, points):
+        """
+        Signed distances of the points from the boundary of each part, shape (n_parts, ...)
+        """
+        return np.stack([part.signed_distances(points) for part in self.parts])
+
+    def signed_distances(self, points):
+        """
+        Distance of the points from the boundary of the union of the parts, positive inside and negative outside.
+        The edges shared by the parts are not part of the boundary: it is the clearance from the walls
+        """
+        if len(self.parts) == 1:
+            return self.parts[0].signed_distances(points)
+        distances = np.min(segment_distances(points, self.boundary_starts, self.boundary_directions), axis=-1)
+        return np.where(self.contains(points), distances, -distances)
+
+    def nearest_edges(self, points):
+        """
+        Part and edge index of the closest edge of the deepest part containing each point,
+        of the closest part for the points outside
+        """
+        part_idx = np.argmax(self.part_distances(points), axis=0)
+        edge_idx = np.zeros_like(part_idx)
+        for i, part in enumerate(self.parts):
+            selected = part_idx == i
+            edge_idx[selected] = part.nearest_edges(np.asarray(points, dtype=float)[selected])
+        return part_idx, edge_idx
@@ -1,12 +1,20 @@
 import numpy as np
+import json
+import hashlib
 
-from tiago_obst_avoidance.utils import *
+from tiago_obst_avoidance.Geometry import AdmittedRegion
+
+# Namespace of the parameters on the ROS parameter server (loaded from config/hparams.yaml by the launch files)
+PARAM_NAMESPACE = '/tiago_obst_avoidance/hparams'
+# Private parameter of each node with the fingerprint of its configuration
+FINGERPRINT_PARAM = 'hparams_fingerprint'
 
 class Hparams:
 
-    ### ~~~~~~~~~ CHANGEBLE PARAMETERS 
+    ### ~~~~~~~~~ CHANGEBLE PARAMETERS
+    # Defaults of the parameters, they can be overridden by Hparams.load
 
-    # True if Gazebo is used. False if the real robot is used 
+    # True if Gazebo is used. False if the real robot is used
     simulation = False
 
     # True if GPU not available, the simulation uses the ground trought of the robot
@@ -14,27 +22,8 @@ class Hparams:
 
     # True if you want to save the videos. Default falder = /tmp/tiago_obst_avoidance
     save_video = False
-
-    # Define the admitted region. 
-    if simulation:
-        #  ->  vertices must be defined COUNTER CLOCK-WISE
-        vertexes = np.array([[-10.0, 10.0],
-                             [-10.0, -10.0],
-                             [10.0, -10.0],
-                             [10.0, 10.0]])
-    else:
-        #  ->  vertices must be defined COUNTER CLOCK-WISE
-        vertexes = np.array([[-1.03, -1.15],
-                            [2.85, -1.8],
-                            [3.33, 1.14],
-                            [-1.02, 1.3]])
-    n_points = vertexes.shape[0]
-
-    # Tolerance on the position error (useful on the real robot)
-    if simulation:
-        error_tol = 1e-3
-    else:
-        error_tol = 0.05
+    # Number of processes rendering the videos, None to use all the cores
+    video_jobs = None
 
     # safety clearance around obstacles
     ds_cbf = 0.2
@@ -43,100 +32,303 @@ class Hparams:
     dbscan_eps = 0.2
     dbscan_samples = 5
 
-    # Cost function weights
-    if simulation:
-        p_weight = 1e2 # position weights
-        v_weight = 8e1 # driving velocity weight
-        omega_weight = 1e-5 # steering velocity weight
-        u_weight = 1e1 # input weights
-        terminal_factor_p = 8e0 # factor for the terminal position weights
-        terminal_factor_v = 8e1 # factor for the terminal velocities (v and omega) weights
-    else:
-        p_weight = 1e2 # position weights
-        v_weight = 5e0 # driving velocity weight
-        omega_weight = 1e-5 # steering velocity weight
-        u_weight = 1e1 # input weights
-        terminal_factor_p = 1e1 # factor for the terminal position weights
-        terminal_factor_v = 8e1 # factor for the terminal velocities (v and omega) weights
-    
     n_actors = 3 # number of actors
-    if n_actors == 0 or fake_sensing:
-        n_clusters = n_actors
-    else:
-        n_clusters = n_actors
 
-    # Specify whether to save data for plots and .json filename
+    # Specify whether to save data for plots and log name
     log = True
-    if log:
-        filename = 'test'
-        controller_file = filename + '_controller.json'
-        prediction_file = filename + '_predictor.json'
+    filename = 'test'
+    # Report the memory retained by the control cycles in steady state (slows down the cycles while tracing)
+    trace_allocations = False
 
+    # Parameters whose default depends on simulation:
+    #   vertexes: the admitted region, vertices must be defined COUNTER CLOCK-WISE
+    #   error_tol: tolerance on the position error (useful on the real robot)
+    #   p_weight: position weights
+    #   v_weight: driving velocity weight
+    #   omega_weight: steering velocity weight
+    #   u_weight: input weights
+    #   terminal_factor_p: factor for the terminal position weights
+    #   terminal_factor_v: factor for the terminal velocities (v and omega) weights
+    #   offset: number of laser ranges discarded at each end of the scan
+    simulation_defaults = {
+        'vertexes': [[-10.0, 10.0],
+                     [-10.0, -10.0],
+                     [10.0, -10.0],
+                     [10.0, 10.0]],
+        'error_tol': 1e-3,
+        'p_weight': 1e2,
+        'v_weight': 8e1,
+        'omega_weight': 1e-5,
+        'u_weight': 1e1,
+        'terminal_factor_p': 8e0,
+        'terminal_factor_v': 8e1,
+        'offset': 20
+    }
+    real_robot_defaults = {
+        'vertexes': [[-1.03, -1.15],
+                     [2.85, -1.8],
+                     [3.33, 1.14],
+                     [-1.02, 1.3]],
+        'error_tol': 0.05,
+        'p_weight': 1e2,
+        'v_weight': 5e0,
+        'omega_weight': 1e-5,
+        'u_weight': 1e1,
+        'terminal_factor_p': 1e1,
+        'terminal_factor_v': 8e1,
+        'offset': 10
+    }
 
-    ### ~~~~~~~~~ FIXED PARAMETERS 
+    ### ~~~~~~~~~ FIXED PARAMETERS
+    # They can be overridden by Hparams.load as well, the defaults describe TIAGo
 
     # Kinematic parameters
     base_radius = 0.27 # [m]
     wheel_radius = 0.0985 # [m]
     wheel_separation = 0.4044 # [m]
     b = 0.1 # [m]
-    relative_laser_pos = np.array([0.2012 - b, -0.0009])
+    laser_pos = [0.2012, -0.0009] # [m] laser position in the frame of the wheels axis
+    # Right and left wheel joints in the joint_states messages, with their indices if the names are missing
+    wheel_joints = ['wheel_right_joint', 'wheel_left_joint']
+    wheel_joints_fallback = [13, 12]
 
     # NMPC parameters
     controller_frequency = 18.0 # [Hz]
-    # controller_frequency = 50.0 # [Hz]
-    dt = 2.0 / controller_frequency # [s]
     N_horizon = 10
+    # Maximum number of edges of the admitted region, the edges are parameters of the solver
+    max_edges = 8
+    # Fraction of the control period within which the command must be published,
+    # otherwise the input of the previous plan is published
+    deadline_fraction = 0.8
+    # Rate of the velocity commands interpolated between the solves, 0 to publish once per solve
+    command_frequency = 50.0 # [Hz]
+    # Solve from the state predicted over the measurement age and the expected solve latency
+    latency_compensation = True
+    # Weight of the last solve latency in its moving average
+    latency_smoothing = 0.1
+    # Age beyond which the actors predictions are flagged as stale
+    prediction_max_age = 0.5 # [s]
+    # Highest rate at which the gazebo model states are read, 0 to read every message
+    model_states_rate = 50.0 # [Hz]
 
     # Driving and steering acceleration limits
     driving_acc_max = 0.5 # [m/s^2]
-    driving_acc_min = - driving_acc_max
     steering_acc_max = 1.05 # [rad/s^2]
-    steering_acc_max_neg = - steering_acc_max
-
-    # Wheels acceleration limits
-    alpha_max = driving_acc_max / wheel_radius # [rad/s^2], 5.0761
-    alpha_min = - alpha_max
 
     # Velocity bounds reduction in case of real_robot
     driving_bound_factor = 1.0
     steering_bound_factor = 1.0
-    
-    # Driving and steering velocity limits
-    driving_vel_max = 1 * driving_bound_factor # [m/s]
+
+    # Driving and steering velocity limits, before the reduction
+    driving_vel_nominal = 1.0 # [m/s]
     driving_vel_min = - 0.2 # [m/s]
-    steering_vel_max = 1.05 * steering_bound_factor # [rad/s]
-    steering_vel_max_neg = - steering_vel_max
-    
-    # Wheels velocity limits
-    w_max = 1.05 * driving_vel_max / wheel_radius # [rad/s], 10.1523
-    w_max_neg = - w_max
-        
-    normals = np.zeros((n_points, 2))
-    for i in range(n_points - 1):
-        normals[i] = compute_normal_vector(vertexes[i], vertexes[i + 1])
-    normals[n_points - 1] = compute_normal_vector(vertexes[n_points - 1], vertexes[0])
-    
+    steering_vel_nominal = 1.05 # [rad/s]
+
+    # Parameters for the CBF
+    gamma_actor = 0.1                   # in (0,1], hyperparameter for the h function associated to actor
+    gamma_bound = 0.1                   # in (0,1], hyperparameter for the h function associated to bounds
+
+    ### ~~~~~~~~~ CONSTANTS
+
     # State indices:
     x_idx = 0
     y_idx = 1
     theta_idx = 2
     v_idx = 3
     omega_idx = 4
-    
+
     # Control input indices
     r_wheel_idx = 0
     l_wheel_idx = 1
 
-    # Parameters for the CBF
-    rho_cbf = base_radius + b/2         # the radius of the circle around the robot center
-    gamma_actor = 0.1                   # in (0,1], hyperparameter for the h function associated to actor
-    gamma_bound = 0.1                   # in (0,1], hyperparameter for the h function associated to bounds
+    # Directory of the solvers generated by acados, one per fingerprint
+    solver_cache_dir = '/tmp/tiago_obst_avoidance/solvers'
+
+    # Parameters that do not change the behaviour of the nodes, left out of the fingerprint
+    unfingerprinted = ('save_video', 'video_jobs', 'log', 'filename', 'solver_cache_dir', 'trace_allocations')
+
+    # Parameters that can be changed while the controller runs (cost weights and limits),
+    # they are set in the solver at runtime and do not select the generated solver.
+    # The admitted region (vertexes) can be changed at runtime as well
+    tunable = ('p_weight', 'v_weight', 'omega_weight', 'u_weight', 'terminal_factor_p', 'terminal_factor_v',
+               'driving_acc_max', 'steering_acc_max', 'driving_vel_min', 'driving_bound_factor',
+               'steering_bound_factor', 'error_tol')
+
+    # Parameters the generated solver is built from (model, horizon, CBFs, sizes of the parameters),
+    # only they select the solver: the others are read by the nodes or set in the solver at runtime
+    solver_parameters = ('N_horizon', 'controller_frequency', 'n_actors', 'max_edges', 'b', 'base_radius',
+                         'wheel_radius', 'wheel_separation', 'ds_cbf', 'gamma_actor', 'gamma_bound')
+
+    @classmethod
+    def parameter_names(cls):
+        return list(cls.defaults) + list(cls.simulation_defaults)
 
-    # Parameters for the crowd prediction
-    if n_actors > 0:
-        nullstate = np.array([-30, -30, 0.0, 0.0])
-        if simulation:
-            offset = 20
+    @classmethod
+    def configure(cls, parameters={}):
+        """
+        Set the given parameters, the others take their default value,
+        then validate them and compute the derived quantities
+        """
+        unknown = set(parameters) - set(cls.parameter_names())
+        if unknown:
+            raise Exception(
+                f"Unknown parameters: {sorted(unknown)}"
+            )
+
+        # The defaults depending on simulation follow the configured value of simulation
+        values = dict(cls.defaults)
+        values.update(cls.simulation_defaults if parameters.get('simulation', values['simulation'])
+                      else cls.real_robot_defaults)
+        values.update(parameters)
+        for name, value in values.items():
+            setattr(cls, name, value)
+        cls.validate()
+        cls.derive()
+        cls.values = values
+
+        cls.fingerprint = cls.hash_values(values, cls.unfingerprinted)
+        cls.solver_fingerprint = cls.hash_values({name: values[name] for name in cls.solver_parameters}, ())
+
+    @staticmethod
+    def hash_values(values, excluded):
+        # Stable across runs and nodes: canonical json of the values
+        hashed = {name: np.asarray(value).tolist() if isinstance(value, (list, tuple, np.ndarray)) else value
+                  for name, value in values.items() if name not in excluded}
+        return hashlib.sha256(json.dumps(hashed, sort_keys=True).encode()).hexdigest()[:16]
+
+    @classmethod
+    def retuned(cls, changes):
+        """
+        Parameters with the given tunable parameters or admitted region changed, validated.
+        The parameters of the class are left untouched
+        """
+        untunable = set(changes) - set(cls.tunable) - {'vertexes'}
+        if untunable:
+            raise Exception(
+                f"Parameters cannot be changed at runtime: {sorted(untunable)}"
+            )
+        retuned = type(cls.__name__, (cls,), {})
+        retuned.configure({**cls.values, **changes})
+        return retuned()
+
+    @classmethod
+    def validate(cls):
+        errors = []
+        for name in ('command_frequency', 'model_states_rate'):
+            if not getattr(cls, name) >= 0:
+                errors.append(f"{name} must be non negative")
+        if len(cls.wheel_joints) != 2 or len(cls.wheel_joints_fallback) != 2:
+            errors.append("wheel_joints and wheel_joints_fallback must list the right and left wheels")
+        # The CBFs of the boundary keep the robot inside every edge: the region must be convex
+        try:
+            AdmittedRegion.from_vertexes(cls.vertexes)
+        except Exception as e:
+            errors.append(f"vertexes: {e}")
+        else:
+            if len(cls.vertexes) > cls.max_edges:
+                errors.append(f"the admitted region has more than max_edges = {cls.max_edges} edges")
+        for name in ('controller_frequency', 'base_radius', 'wheel_radius', 'wheel_separation', 'error_tol',
+                     'driving_acc_max', 'steering_acc_max', 'driving_vel_nominal', 'steering_vel_nominal',
+                     'driving_bound_factor', 'steering_bound_factor', 'dbscan_eps', 'prediction_max_age'):
+            if not getattr(cls, name) > 0:
+                errors.append(f"{name} must be positive")
+        for name in ('ds_cbf', 'b', 'p_weight', 'v_weight', 'omega_weight', 'u_weight',
+                     'terminal_factor_p', 'terminal_factor_v'):
+            if not getattr(cls, name) >= 0:
+                errors.append(f"{name} must be non negative")
+        for name in ('gamma_actor', 'gamma_bound', 'deadline_fraction', 'latency_smoothing'):
+            if not 0 < getattr(cls, name) <= 1:
+                errors.append(f"{name} must be in (0, 1]")
+        for name in ('N_horizon', 'n_actors', 'dbscan_samples', 'offset', 'max_edges'):
+            value = getattr(cls, name)
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                errors.append(f"{name} must be a non negative integer")
+        if cls.N_horizon == 0:
+            errors.append("N_horizon must be positive")
+        if cls.driving_vel_min > 0:
+            errors.append("driving_vel_min must be non positive")
+        if errors:
+            raise Exception(
+                "Invalid parameters: " + "; ".join(errors)
+            )
+
+    @classmethod
+    def derive(cls):
+        """
+        Quantities computed once from the parameters
+        """
+        cls.admitted_region = AdmittedRegion.from_vertexes(cls.vertexes)
+        cls.vertexes = cls.admitted_region.vertexes
+        cls.n_points = cls.vertexes.shape[0]
+        cls.normals = cls.admitted_region.normals
+
+        cls.n_clusters = cls.n_actors
+        cls.controller_file = cls.filename + '_controller'
+        cls.prediction_file = cls.filename + '_predictor'
+
+        # Laser position with respect to the controlled point
+        cls.relative_laser_pos = np.array([cls.laser_pos[0] - cls.b, cls.laser_pos[1]])
+        cls.dt = 2.0 / cls.controller_frequency # [s]
+        cls.deadline = cls.deadline_fraction / cls.controller_frequency # [s]
+
+        cls.driving_acc_min = - cls.driving_acc_max
+        cls.steering_acc_max_neg = - cls.steering_acc_max
+
+        # Wheels acceleration limits
+        cls.alpha_max = cls.driving_acc_max / cls.wheel_radius # [rad/s^2], 5.0761
+        cls.alpha_min = - cls.alpha_max
+
+        # Driving and steering velocity limits
+        cls.driving_vel_max = cls.driving_vel_nominal * cls.driving_bound_factor # [m/s]
+        cls.steering_vel_max = cls.steering_vel_nominal * cls.steering_bound_factor # [rad/s]
+        cls.steering_vel_max_neg = - cls.steering_vel_max
+
+        # Wheels velocity limits
+        cls.w_max = 1.05 * cls.driving_vel_max / cls.wheel_radius # [rad/s], 10.1523
+        cls.w_max_neg = - cls.w_max
+
+        # the radius of the circle around the robot center
+        cls.rho_cbf = cls.base_radius + cls.b/2
+
+        # Parameters for the crowd prediction
+        cls.nullstate = np.array([-30, -30, 0.0, 0.0])
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Configure the parameters from a YAML file if given, otherwise from
+        the ROS parameter server if the node is initialized and they are set
+        """
+        if path is not None:
+            import yaml
+            with open(path, 'r') as file:
+                parameters = yaml.safe_load(file) or {}
         else:
-            offset = 10
+            import rospy
+            parameters = {}
+            if rospy.core.is_initialized() and rospy.has_param(PARAM_NAMESPACE):
+                parameters = rospy.get_param(PARAM_NAMESPACE)
+        cls.configure(parameters)
+        return cls
+
+    @classmethod
+    def publish_fingerprint(cls):
+        """
+        Publish the fingerprint of the parameters of this node and compare it
+        with the ones published by the other nodes
+        """
+        import rospy
+        rospy.set_param('~' + FINGERPRINT_PARAM, cls.fingerprint)
+        own_param = rospy.resolve_name('~' + FINGERPRINT_PARAM)
+        for param in rospy.get_param_names():
+            if param.endswith('/' + FINGERPRINT_PARAM) and param != own_param:
+                fingerprint = rospy.get_param(param)
+                if fingerprint != cls.fingerprint:
+                    rospy.logerr(f"Parameters fingerprint {cls.fingerprint} differs from {fingerprint} ({param}), "
+                                 "the nodes are running with different parameters")
+
+# Parameters with a default independent of simulation
+Hparams.defaults = {name: value for name, value in vars(Hparams).items()
+                    if not name.startswith('_') and not name.endswith('_idx')
+                    and not isinstance(value, (classmethod, staticmethod, dict, tuple))}
+Hparams.configure()
@@ -1,5 +1,6 @@
+import numpy as np
 import casadi
-from tiago_obst_avoidance.Hparams import *
+from tiago_obst_avoidance.Hparams import Hparams
 
 class KinematicModel:
     nq = 5
@@ -23,8 +24,14 @@ class KinematicModel:
         wheel_radius = self.hparams.wheel_radius
         wheel_separation = self.hparams.wheel_separation
 
-        xdot = v * casadi.cos(theta) - omega * b * casadi.sin(theta)
-        ydot = v * casadi.sin(theta) + omega * b * casadi.cos(theta)
+        # Symbolic in the solver, numeric in the predictions
+        if isinstance(theta, (casadi.SX, casadi.MX)):
+            cos, sin = casadi.cos, casadi.sin
+        else:
+            cos, sin = np.cos, np.sin
+
+        xdot = v * cos(theta) - omega * b * sin(theta)
+        ydot = v * sin(theta) + omega * b * cos(theta)
         thetadot = omega
         vdot = wheel_radius * 0.5 * (alpha_r + alpha_l)
         omegadot = (wheel_radius / wheel_separation) * (alpha_r - alpha_l)
@@ -0,0 +1,50 @@
+import numpy as np
+import math
+
+from tiago_obst_avoidance.Hparams import Hparams
+from tiago_obst_avoidance.KinematicModel import KinematicModel
+from tiago_obst_avoidance.utils import RK4, plan_input
+
+class LatencyCompensation:
+    '''
+    Predicts the state from which the next plan is applied: the measured state is
+    integrated over its age and the expected solve latency with the inputs being applied
+    '''
+    def __init__(self,
+                 hparams : Hparams,
+                 max_step=0.01):
+        self.hparams = hparams
+        self.kinematic_model = KinematicModel()
+        # Longest integration step [s]
+        self.max_step = max_step
+        # Exponential moving average of the solve latency [s]
+        self.solve_latency = None
+
+    def update_latency(self, latency):
+        if self.solve_latency is None:
+            self.solve_latency = latency
+        else:
+            self.solve_latency += self.hparams.latency_smoothing * (latency - self.solve_latency)
+
+    def applied_input(self, plan, t):
+        """
+        Input of the plan (start time, inputs) applied at time t, zeros without a plan or after its end
+        """
+        u = plan_input(plan, t, self.hparams.dt)
+        return np.zeros(KinematicModel.nu) if u is None else u
+
+    def predict(self, q, measurement_time, now, plan):
+        """
+        State q measured at measurement_time predicted at now plus the expected solve latency.
+        Return the predicted state and its time
+        """
+        target_time = now + (self.solve_latency or 0.0)
+        horizon = target_time - measurement_time
+        if horizon <= 0.0:
+            return q, measurement_time
+        n_steps = int(math.ceil(horizon / self.max_step))
+        step = horizon / n_steps
+        for i in range(n_steps):
+            u = self.applied_input(plan, measurement_time + (i + 0.5) * step)
+            q = RK4(self.kinematic_model, q, u, step)
+        return q, target_time
@@ -0,0 +1,230 @@
+import numpy as np
+import os
+import json
+import glob
+import shutil
+import argparse
+from multiprocessing import Pool
+
+from tiago_obst_avoidance.Logger import Logger, METADATA_FILE
+
+# Channels of the legacy .json logs: name -> (row shape, dtype, ragged, timestamp in the last column)
+# Rows without a timestamp take the one of the reference channel of the log
+CONTROLLER_CHANNELS = {
+    'states': ((5,), np.float64, False, True),
+    'wheels_velocities': ((2,), np.float64, False, True),
+    'wheels_accelerations': ((2,), np.float64, False, True),
+    'commanded_velocities': ((2,), np.float64, False, True),
+    'targets': ((2,), np.float64, False, True),
+    'cpu_time': ((), np.float64, False, True),
+    'robot_predictions': (None, np.float64, False, False),
+    'actors_predictions': (None, np.float64, False, False),
+    'actors_gt': (None, np.float64, False, False)
+}
+PREDICTOR_CHANNELS = {
+    'robot_states': ((5,), np.float64, False, True),
+    'cpu_time': ((), np.float64, False, True),
+    'actors_position': (None, np.float64, False, False),
+    'laser_scans': ((2,), np.float32, True, False)
+}
+
+def converted_path(json_path, output_dir=None):
+    log_dir, name = os.path.split(json_path)
+    return os.path.join(output_dir or log_dir, os.path.splitext(name)[0])
+
+def is_converted(json_path, log_path):
+    metadata_path = os.path.join(log_path, METADATA_FILE)
+    return os.path.exists(metadata_path) and \
+        os.path.getmtime(metadata_path) >= os.path.getmtime(json_path)
+
+class JsonStream:
+    '''
+    Incremental reader of a json file: values are decoded one at a time from a buffer
+    refilled by chunks, so that the arrays of a large log are never loaded whole
+    '''
+    def __init__(self, file, chunk_size=1 << 20):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        """
+        Append the next chunk to the unread part of the buffer, False at the end of the file
+        """
+        chunk = self.file.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return len(chunk) > 0
+
+    def peek(self):
+        """
+        Next character that is not a whitespace, empty at the end of the file
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, characters):
+        character = self.peek()
+        if character == '' or character not in characters:
+            raise ValueError(f"Expected one of {characters!r} in the json log, found {character!r}")
+        self.pos += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # The value continues in the next chunk
+                if not self.fill():
+                    raise
+                continue
+            # A number cut by the end of the buffer is decoded up to the cut, it continues in the next chunk
+            if (end == len(self.buffer) or self.buffer[end] in '0123456789.eE+-') and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def keys(self):
+        """
+        Keys of an object, the value of each key must be read before the next one
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        """
+        Elements of an array, decoded one at a time
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+def convert_log(json_path, log_path):
+    """
+    Convert a legacy .json log to a Logger directory, the channels are streamed row by row
+    """
+    channels = {**CONTROLLER_CHANNELS, **PREDICTOR_CHANNELS}
+    references = ('states', 'robot_states')
+
+    # The log is written in a partial directory moved in place once complete:
+    # an interrupted conversion never leaves a log that looks converted
+    partial_path = log_path + '.partial'
+    if os.path.exists(partial_path):
+        shutil.rmtree(partial_path)
+    logger = Logger(partial_path, chunk_size=4096, flush_period=np.inf, blocking=True)
+    metadata = {}
+    # Timestamps of the reference channel, once it has been read
+    reference_times = None
+    # Rows without a timestamp read before the reference channel, dated once it is read
+    pending = {}
+
+    with open(json_path, 'r') as file:
+        stream = JsonStream(file)
+        for name in stream.keys():
+            if name not in channels:
+                metadata[name] = stream.value()
+                continue
+            shape, dtype, ragged, timestamped = channels[name]
+            times = [] if name in references else reference_times
+            n_rows = 0
+            for row in stream.elements():
+                if timestamped:
+                    row = np.asarray(row, dtype=np.float64).reshape(-1)
+                    stamp = row[-1]
+                    row = row[:-1].reshape(shape)
+                    if name in references:
+                        times.append(stamp)
+                elif not ragged:
+                    row = np.asarray(row, dtype=dtype)
+                if name not in logger.channels:
+                    logger.add_channel(name, row.shape if shape is None else shape, dtype, ragged)
+                if timestamped:
+                    logger.log(name, row, stamp)
+                elif times is None:
+                    pending.setdefault(name, []).append(row)
+                # Rows after the last timestamp of the reference channel cannot be dated
+                elif n_rows < len(times):
+                    logger.log(name, row, times[n_rows])
+                n_rows += 1
+            if name not in logger.channels:
+                logger.add_channel(name, () if shape is None else shape, dtype, ragged)
+            if name in references:
+                reference_times = times
+                for pending_name, rows in pending.items():
+                    for row, stamp in zip(rows, reference_times):
+                        logger.log(pending_name, row, stamp)
+                pending.clear()
+
+    logger.set_metadata(**metadata)
+    logger.close()
+    if os.path.exists(log_path):
+        shutil.rmtree(log_path)
+    os.replace(partial_path, log_path)
+    return log_path
+
+def convert_task(task):
+    json_path, log_path = task
+    try:
+        convert_log(json_path, log_path)
+        return json_path, None
+    except Exception as e:
+        return json_path, e
+
+def find_logs(paths):
+    json_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            json_paths.extend(sorted(glob.glob(os.path.join(path, '*_controller.json'))))
+            json_paths.extend(sorted(glob.glob(os.path.join(path, '*_predictor.json'))))
+        else:
+            json_paths.extend(sorted(glob.glob(path)))
+    return json_paths
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert legacy .json logs to the columnar log format')
+    parser.add_argument('paths', nargs='*', default=['/tmp/tiago_obst_avoidance/data'],
+                        help='log directories, .json files or glob patterns')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='directory of the converted logs (default: next to the .json files)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of parallel conversions')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='convert also the logs already converted')
+    args = parser.parse_args()
+
+    tasks = []
+    for json_path in find_logs(args.paths):
+        log_path = converted_path(json_path, args.output_dir)
+        if args.force or not is_converted(json_path, log_path):
+            tasks.append((json_path, log_path))
+        else:
+            print(f"Skipping {json_path}, already converted")
+
+    with Pool(max(1, min(args.jobs, len(tasks)))) as pool:
+        for json_path, error in pool.imap_unordered(convert_task, tasks):
+            if error is None:
+                print(f"Converted {json_path}")
+            else:
+                print(f"Failed to convert {json_path}: {error}")
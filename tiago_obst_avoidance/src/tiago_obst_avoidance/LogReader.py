@@ -0,0 +1,179 @@
+import numpy as np
+import os
+import json
+import glob
+
+from tiago_obst_avoidance.Logger import METADATA_FILE, DATA_EXT, TIME_EXT, LENGTH_EXT
+
+CONTROLLER_SUFFIX = '_controller'
+PREDICTOR_SUFFIX = '_predictor'
+
+def find_runs(paths):
+    """
+    Return (log_dir, filename) of the runs whose controller log is in the given
+    directories or matches the given glob patterns
+    """
+    controller_paths = []
+    for path in paths:
+        if os.path.isdir(path) and not path.rstrip('/').endswith(CONTROLLER_SUFFIX):
+            controller_paths.extend(sorted(glob.glob(os.path.join(path, '*' + CONTROLLER_SUFFIX))))
+        else:
+            controller_paths.extend(sorted(glob.glob(path.rstrip('/'))))
+
+    runs = []
+    for controller_path in controller_paths:
+        if os.path.exists(os.path.join(controller_path, METADATA_FILE)):
+            log_dir, name = os.path.split(controller_path)
+            runs.append((log_dir, name[:-len(CONTROLLER_SUFFIX)]))
+    return runs
+
+class RaggedRows:
+    '''
+    Rows of variable length stored in one contiguous array of points:
+    row i is the view points[offsets[i]:offsets[i + 1]]
+    '''
+    def __init__(self, points, offsets):
+        self.points = points
+        self.offsets = offsets
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise IndexError("RaggedRows only supports contiguous slices")
+            stop = max(start, stop)
+            return RaggedRows(self.points[self.offsets[start]:self.offsets[stop]],
+                              self.offsets[start:stop + 1] - self.offsets[start])
+        if key < 0:
+            key += len(self)
+        return self.points[self.offsets[key]:self.offsets[key + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class LogReader:
+    '''
+    Read the channels of a log directory written by Logger.
+    Channel files are memory-mapped: only the requested channels and
+    time window are actually paged in
+    '''
+    def __init__(self, log_path):
+        self.log_path = log_path
+        metadata_path = os.path.join(log_path, METADATA_FILE)
+        if not os.path.exists(metadata_path):
+            raise Exception(
+                f"Specified log not found: {log_path}"
+            )
+        with open(metadata_path, 'r') as file:
+            log_dict = json.load(file)
+        self.channels = log_dict['channels']
+        self.metadata = log_dict['metadata']
+
+    def __getitem__(self, key):
+        return self.metadata[key]
+
+    def __contains__(self, key):
+        return key in self.metadata
+
+    def has_channel(self, name):
+        return name in self.channels
+
+    def map(self, name, ext, dtype):
+        path = os.path.join(self.log_path, name + ext)
+        # np.memmap does not accept empty files
+        if not os.path.exists(path) or os.path.getsize(path) < np.dtype(dtype).itemsize:
+            return np.empty(0, dtype=dtype)
+        n_items = os.path.getsize(path) // np.dtype(dtype).itemsize
+        return np.memmap(path, dtype=dtype, mode='r', shape=(n_items,))
+
+    def times(self, name):
+        """
+        Timestamps of the complete rows of a channel
+        """
+        times = self.map(name, TIME_EXT, '<f8')
+        if self.channels[name]['ragged']:
+            n_rows = self.map(name, LENGTH_EXT, '<u4').shape[0]
+        else:
+            row_size = max(int(np.prod(self.channels[name]['shape'])), 1)
+            n_rows = self.map(name, DATA_EXT, self.channels[name]['dtype']).shape[0] // row_size
+        return times[:min(times.shape[0], n_rows)]
+
+    def window(self, times, t_start=None, t_end=None):
+        """
+        Range of rows with t_start <= time <= t_end (timestamps are increasing)
+        """
+        start = 0 if t_start is None else int(np.searchsorted(times, t_start, side='left'))
+        end = times.shape[0] if t_end is None else int(np.searchsorted(times, t_end, side='right'))
+        return start, end
+
+    def read(self, name, t_start=None, t_end=None):
+        """
+        Return the rows of a channel in the time window and their timestamps,
+        as read-only views on the mapped files.
+        Rows of ragged channels are returned as RaggedRows
+        """
+        schema = self.channels[name]
+        shape = tuple(schema['shape'])
+        row_size = int(np.prod(shape))
+        data = self.map(name, DATA_EXT, schema['dtype'])
+        times = self.times(name)
+        start, end = self.window(times, t_start, t_end)
+
+        if schema['ragged']:
+            offsets = self.offsets(name)
+            points = data[offsets[start] * row_size:offsets[end] * row_size].reshape((-1,) + shape)
+            rows = RaggedRows(points, offsets[start:end + 1] - offsets[start])
+        else:
+            rows = data[start * row_size:end * row_size].reshape((end - start,) + shape)
+
+        return rows, times[start:end]
+
+    def offsets(self, name):
+        """
+        Offsets of the rows of a ragged channel in its flat array of points
+        """
+        lengths = self.map(name, LENGTH_EXT, '<u4')[:self.times(name).shape[0]]
+        return np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+
+    def read_scans(self, t_start=None, t_end=None):
+        """
+        Return the absolute [x, y] points of the filtered laser beams of each frame,
+        as RaggedRows, and the frame timestamps.
+        Points are reconstructed from the logged ranges, beam mask and the pose of the robot
+        at the scan stamp, or the robot states of the iteration for the logs without it
+        """
+        if self.has_channel('laser_scans'):
+            # Absolute points logged directly
+            return self.read('laser_scans', t_start, t_end)
+
+        ranges, times = self.read('laser_ranges', t_start, t_end)
+        mask_bits, _ = self.read('laser_mask', t_start, t_end)
+        robot_states, _ = self.read('scan_poses' if self.has_channel('scan_poses') else 'robot_states',
+                                    t_start, t_end)
+        # While logging, the channels may not have been written up to the same frame
+        n_frames = min(ranges.shape[0], mask_bits.shape[0], robot_states.shape[0])
+        ranges = ranges[:n_frames]
+        times = times[:n_frames]
+        n_beams = ranges.shape[1]
+        mask = np.unpackbits(mask_bits[:n_frames], axis=1, count=n_beams).astype(bool)
+
+        # Beams are ordered by frame, then by angle
+        frame_idx, beam_idx = np.nonzero(mask)
+        distances = ranges[frame_idx, beam_idx] * self['laser_ranges_scale']
+        angles = self['angle_min'] + beam_idx * self['angle_inc']
+        laser_position = self['laser_relative_pos']
+        x_relative = distances * np.cos(angles) + laser_position[0]
+        y_relative = distances * np.sin(angles) + laser_position[1]
+        theta = robot_states[frame_idx, 2]
+        cos_theta = np.cos(theta)
+        sin_theta = np.sin(theta)
+        points = np.stack((robot_states[frame_idx, 0] + cos_theta * x_relative - sin_theta * y_relative,
+                           robot_states[frame_idx, 1] + sin_theta * x_relative + cos_theta * y_relative),
+                          axis=1)
+
+        offsets = np.concatenate(([0], np.cumsum(np.sum(mask, axis=1))))
+        return RaggedRows(points, offsets), times
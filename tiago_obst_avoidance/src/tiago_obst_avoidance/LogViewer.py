@@ -0,0 +1,174 @@
+import numpy as np
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib.pyplot as plt
+import matplotlib.gridspec as gridspec
+from matplotlib.widgets import Slider, Button
+
+from tiago_obst_avoidance.Plotter import open_logs, world_frames, scans_frames, setup_world_axes, WorldView, ScansView
+from tiago_obst_avoidance.Analysis import actor_clearances, logged_actors_positions
+from tiago_obst_avoidance.Geometry import AdmittedRegion
+
+def event_times(controller_log):
+    """
+    Times at which a solver failure or a clearance violation starts
+    """
+    states, times = controller_log.read('states')
+    positions = states[:, :2]
+    rho_cbf = controller_log['rho_cbf']
+    region = AdmittedRegion.from_vertexes(controller_log['boundary_vertexes'])
+    events = region.signed_distances(positions) < rho_cbf
+    if controller_log.has_channel('solver_status'):
+        solver_status, _ = controller_log.read('solver_status')
+        n = min(events.shape[0], solver_status.shape[0])
+        events[:n] |= solver_status[:n] > 0
+    if controller_log['n_actors'] > 0:
+        actors_positions = logged_actors_positions(controller_log)
+        n = min(events.shape[0], actors_positions.shape[0])
+        clearances = actor_clearances(positions[:n], actors_positions[:n])
+        events[:n] |= clearances < rho_cbf + controller_log['ds_cbf']
+    # Only the first frame of consecutive events
+    starts = events & ~np.concatenate(([False], events[:-1]))
+    return times[starts]
+
+class FrameCache:
+    '''
+    Frames of an animation loaded by blocks of consecutive frames.
+    The blocks around the requested one are loaded in background, the farthest are evicted
+    '''
+    def __init__(self, load_frames, times, block_size=256, n_blocks=8):
+        # load_frames(window) returns the frames dictionary of the time window
+        self.load_frames = load_frames
+        self.times = times
+        self.block_size = block_size
+        self.n_blocks = n_blocks
+        self.blocks = OrderedDict()
+        self.loader = ThreadPoolExecutor(max_workers=1)
+
+    def load_block(self, block):
+        start = block * self.block_size
+        end = min(start + self.block_size, self.times.shape[0])
+        return self.load_frames((self.times[start], self.times[end - 1]))
+
+    def request(self, block):
+        if 0 <= block * self.block_size < self.times.shape[0] and block not in self.blocks:
+            self.blocks[block] = self.loader.submit(self.load_block, block)
+
+    def get(self, frame):
+        """
+        Frames dictionary of the block containing the frame and the index of the frame in it
+        """
+        block = frame // self.block_size
+        for neighbour in (block, block + 1, block - 1):
+            self.request(neighbour)
+        self.blocks.move_to_end(block)
+        while len(self.blocks) > self.n_blocks:
+            farthest = max(self.blocks, key=lambda key: abs(key - block))
+            self.blocks.pop(farthest).cancel()
+        return self.blocks[block].result(), frame - block * self.block_size
+
+    def close(self):
+        for future in self.blocks.values():
+            future.cancel()
+        self.loader.shutdown(wait=False)
+
+class LogViewer:
+    '''
+    Interactive viewer of a logged run: a time slider, step buttons and jumps
+    to the next solver failure or clearance violation
+    '''
+    def __init__(self, controller_log, predictor_log, block_size=256):
+        self.controller_log = controller_log
+        self.caches = {'world': FrameCache(
+            lambda window: world_frames(controller_log, predictor_log, window),
+            controller_log.times('states'), block_size)}
+        if predictor_log is not None and not controller_log['fake_sensing']:
+            self.caches['scans'] = FrameCache(
+                lambda window: scans_frames(controller_log, predictor_log, window),
+                predictor_log.times('robot_states'), block_size)
+        # The whole trajectory is light, the blocks only hold the frames around the cursor
+        states, _ = controller_log.read('states')
+        self.trajectory = states[:, :2]
+        world_times = self.caches['world'].times
+        self.t0 = world_times[0]
+        self.period = 1 / controller_log['frequency']
+        self.events = event_times(controller_log) - self.t0
+
+        self.fig = plt.figure(figsize=(8 * len(self.caches), 9))
+        gs = gridspec.GridSpec(2, len(self.caches), height_ratios=[20, 1])
+        region = AdmittedRegion.from_vertexes(controller_log['boundary_vertexes'])
+        self.views = {}
+        for i, (name, cache) in enumerate(self.caches.items()):
+            ax = self.fig.add_subplot(gs[0, i])
+            setup_world_axes(ax, 'TIAGo World' if name == 'world' else 'TIAGo Scans', region)
+            frames, _ = cache.get(0)
+            self.views[name] = (WorldView if name == 'world' else ScansView)(ax, controller_log, frames)
+
+        self.fig.subplots_adjust(bottom=0.12)
+        self.slider = Slider(self.fig.add_axes([0.1, 0.06, 0.8, 0.03]), '$t \\quad [s]$',
+                             0.0, max(world_times[-1] - self.t0, self.period), valinit=0.0)
+        self.slider.on_changed(self.show)
+        self.buttons = []
+        for i, (label, callback) in enumerate([('<< event', self.previous_event),
+                                               ('<', lambda _: self.step(-1)),
+                                               ('>', lambda _: self.step(1)),
+                                               ('event >>', self.next_event)]):
+            button = Button(self.fig.add_axes([0.3 + 0.1 * i, 0.01, 0.09, 0.04]), label)
+            button.on_clicked(callback)
+            self.buttons.append(button)
+        self.fig.canvas.mpl_connect('key_press_event', self.on_key)
+        self.fig.canvas.mpl_connect('close_event', lambda _: self.close())
+        self.show(0.0)
+
+    def show(self, t):
+        for name, cache in self.caches.items():
+            # Last frame at or before t
+            frame = int(np.clip(np.searchsorted(cache.times, self.t0 + t, side='right') - 1,
+                                0, cache.times.shape[0] - 1))
+            frames, idx = cache.get(frame)
+            n_frames = frames['configurations'].shape[0]
+            if n_frames == 0:
+                continue
+            view = self.views[name]
+            view.update(frames, min(idx, n_frames - 1))
+            if name == 'world':
+                view.traj_line.set_data(self.trajectory[:frame + 1, 0], self.trajectory[:frame + 1, 1])
+        self.fig.canvas.draw_idle()
+
+    def step(self, n_frames):
+        self.slider.set_val(np.clip(self.slider.val + n_frames * self.period, self.slider.valmin, self.slider.valmax))
+
+    def previous_event(self, _):
+        previous = self.events[self.events < self.slider.val - self.period / 2]
+        if previous.shape[0] > 0:
+            self.slider.set_val(previous[-1])
+
+    def next_event(self, _):
+        following = self.events[self.events > self.slider.val + self.period / 2]
+        if following.shape[0] > 0:
+            self.slider.set_val(following[0])
+
+    def on_key(self, event):
+        if event.key == 'right':
+            self.step(1)
+        elif event.key == 'left':
+            self.step(-1)
+
+    def close(self):
+        for cache in self.caches.values():
+            cache.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Browse a logged run')
+    parser.add_argument('filename', help='name of the run, without the _controller/_predictor suffix')
+    parser.add_argument('--log-dir', default='/tmp/tiago_obst_avoidance/data',
+                        help='directory of the logs')
+    parser.add_argument('--block-size', type=int, default=256,
+                        help='number of frames loaded at once')
+    args = parser.parse_args()
+
+    controller_log, predictor_log = open_logs(args.filename, args.log_dir)
+    # The widgets stop responding if the viewer is garbage collected
+    viewer = LogViewer(controller_log, predictor_log, args.block_size)
+    plt.show()
@@ -0,0 +1,232 @@
+import numpy as np
+import os
+import json
+import time
+import queue
+import threading
+
+# Layout of a log directory:
+#   metadata.json      -> run metadata and channel schema
+#   <channel>.bin      -> rows of the channel, raw little-endian values appended chunk by chunk
+#   <channel>.time     -> float64 timestamp of each row
+#   <channel>.len      -> uint32 number of points of each row (ragged channels only)
+METADATA_FILE = 'metadata.json'
+DATA_EXT = '.bin'
+TIME_EXT = '.time'
+LENGTH_EXT = '.len'
+FORMAT_VERSION = 1
+
+class Channel:
+    def __init__(self, name, shape, dtype, ragged, chunk_size):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.ragged = ragged
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.times = np.empty(self.chunk_size, dtype='<f8')
+        if self.ragged:
+            self.rows = []
+        else:
+            self.rows = np.empty((self.chunk_size,) + self.shape, dtype=self.dtype)
+
+    def append(self, values, stamp):
+        if self.ragged:
+            self.rows.append(np.array(values, dtype=self.dtype).reshape((-1,) + self.shape))
+        else:
+            self.rows[self.count] = values
+        self.times[self.count] = stamp
+        self.count += 1
+        return self.count == self.chunk_size
+
+    def take(self):
+        """
+        Detach the rows collected so far as a chunk and start a new one
+        """
+        chunk = (self.name, self.rows[:self.count], self.times[:self.count])
+        self.reset()
+        return chunk
+
+    def schema(self):
+        return {'dtype': self.dtype.str, 'shape': list(self.shape), 'ragged': self.ragged}
+
+class Logger:
+    '''
+    Append-only columnar logger: rows are collected in fixed-size chunks
+    and written to disk by a background thread
+    '''
+    def __init__(self, log_path, chunk_size=256, flush_period=1.0, max_pending_chunks=64, blocking=False):
+        self.log_path = log_path
+        self.chunk_size = chunk_size
+        self.flush_period = flush_period
+        # Offline writers can wait for the writer thread instead of dropping chunks
+        self.blocking = blocking
+        self.channels = {}
+        self.metadata = {}
+        self.dropped_chunks = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+        if not os.path.exists(log_path):
+            os.makedirs(log_path)
+        # Start from an empty log
+        for entry in os.listdir(log_path):
+            if entry == METADATA_FILE or entry.endswith((DATA_EXT, TIME_EXT, LENGTH_EXT)):
+                os.remove(os.path.join(log_path, entry))
+
+        self.files = {}
+        self.chunks = queue.Queue(maxsize=max_pending_chunks)
+        self.last_flush = time.monotonic()
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+    def add_channel(self, name, shape=(), dtype=np.float64, ragged=False):
+        """
+        Declare a channel, every row has the given shape.
+        Ragged channels store a variable number of rows of the given shape per sample
+        """
+        self.channels[name] = Channel(name, shape, dtype, ragged, self.chunk_size)
+        self.write_metadata()
+
+    def set_metadata(self, **metadata):
+        self.metadata.update(metadata)
+        self.write_metadata()
+
+    def write_metadata(self):
+        output_dict = {
+            'version': FORMAT_VERSION,
+            'channels': {name: channel.schema() for name, channel in self.channels.items()},
+            'metadata': self.metadata
+        }
+        # Atomic replace, so that the file can be read while logging
+        tmp_path = os.path.join(self.log_path, METADATA_FILE + '.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(output_dict, file)
+        os.replace(tmp_path, os.path.join(self.log_path, METADATA_FILE))
+
+    def log(self, name, values, stamp):
+        with self.lock:
+            if self.closed:
+                return
+            if self.channels[name].append(values, stamp):
+                self.submit(self.channels[name].take())
+            if time.monotonic() - self.last_flush > self.flush_period:
+                self.flush_chunks()
+
+    def flush(self):
+        with self.lock:
+            self.flush_chunks()
+
+    def flush_chunks(self):
+        self.last_flush = time.monotonic()
+        for channel in self.channels.values():
+            if channel.count > 0:
+                self.submit(channel.take())
+
+    def submit(self, chunk):
+        try:
+            self.chunks.put(chunk, block=self.blocking)
+        except queue.Full:
+            # Never block the caller, memory stays bounded
+            self.dropped_chunks += 1
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.flush_chunks()
+        self.chunks.put(None)
+        self.writer.join()
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+    def open(self, name, ext):
+        key = name + ext
+        if key not in self.files:
+            self.files[key] = open(os.path.join(self.log_path, key), 'ab')
+        return self.files[key]
+
+    def write_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            name, rows, times = chunk
+            # Data is written before the timestamps: a row is complete once its time is on disk
+            data_file = self.open(name, DATA_EXT)
+            if isinstance(rows, list):
+                lengths = np.array([row.shape[0] for row in rows], dtype='<u4')
+                if len(rows) > 0:
+                    data_file.write(np.concatenate(rows).tobytes())
+                data_file.flush()
+                length_file = self.open(name, LENGTH_EXT)
+                length_file.write(lengths.tobytes())
+                length_file.flush()
+            else:
+                data_file.write(np.ascontiguousarray(rows).tobytes())
+                data_file.flush()
+            time_file = self.open(name, TIME_EXT)
+            time_file.write(times.tobytes())
+            time_file.flush()
+
+class LogRing:
+    '''
+    Preallocated slots filled by a real-time loop and handed to a logging worker.
+    The loop only copies raw values into a free slot, the worker converts and logs them
+    '''
+    def __init__(self, fields, consumer, n_slots=64):
+        # fields: name -> (shape, dtype) of the arrays stored in each slot
+        self.arrays = {name: np.zeros((n_slots,) + tuple(shape), dtype=dtype)
+                       for name, (shape, dtype) in fields.items()}
+        # Views on each slot, built once: the loop writes them in place with view[...] = value
+        self.slots = [{name: array[i, ...] for name, array in self.arrays.items()}
+                      for i in range(n_slots)]
+        # References to objects whose conversion is left to the worker
+        self.objects = [{} for _ in range(n_slots)]
+        self.consumer = consumer
+        self.dropped_slots = 0
+
+        self.free = queue.Queue()
+        for i in range(n_slots):
+            self.free.put(i)
+        self.ready = queue.Queue()
+        self.worker = threading.Thread(target=self.consume_slots, daemon=True)
+        self.worker.start()
+
+    def acquire(self):
+        """
+        Return the index of a free slot, None if the worker is lagging behind
+        """
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            self.dropped_slots += 1
+            return None
+
+    def commit(self, idx):
+        self.ready.put(idx)
+
+    def close(self):
+        self.ready.put(None)
+        self.worker.join()
+
+    def consume_slots(self):
+        while True:
+            idx = self.ready.get()
+            if idx is None:
+                return
+            try:
+                self.consumer(self.slots[idx], self.objects[idx])
+            except Exception as e:
+                # A sample that cannot be logged is lost, the worker goes on with the next ones.
+                # Only the nodes use the ring, the offline tools import this module without ROS
+                import rospy
+                rospy.logerr_throttle(1.0, f"Log sample dropped: {e!r}")
+            finally:
+                self.objects[idx].clear()
+                self.free.put(idx)
@@ -1,14 +1,32 @@
 import numpy as np
+import os
+import sys
+import hashlib
+import importlib.metadata
 import scipy.linalg
 
 from acados_template import AcadosModel, AcadosOcp, AcadosOcpConstraints, AcadosOcpCost, AcadosOcpOptions, AcadosOcpSolver
-from numpy.linalg import *
 
 import casadi
 
-from tiago_obst_avoidance.Hparams import *
-from tiago_obst_avoidance.utils import *
-from tiago_obst_avoidance.KinematicModel import *
+from tiago_obst_avoidance.Hparams import Hparams
+from tiago_obst_avoidance.utils import State
+from tiago_obst_avoidance.KinematicModel import KinematicModel
+
+def solver_sources_hash():
+    """
+    Hash of the sources generating the OCP and of the acados_template version
+    """
+    sha = hashlib.sha256()
+    for module in (__name__, KinematicModel.__module__, Hparams.__module__):
+        with open(sys.modules[module].__file__, 'rb') as source:
+            sha.update(source.read())
+    try:
+        version = importlib.metadata.version('acados_template')
+    except importlib.metadata.PackageNotFoundError:
+        version = 'unknown'
+    sha.update(version.encode())
+    return sha.hexdigest()[:16]
 
 class NMPC:
     def __init__(self,
@@ -33,14 +51,43 @@ class NMPC:
         # Setup kinematic model
         self.kinematic_model = KinematicModel()
 
-        self.n_edges = self.hparams.n_points
-        self.vertexes = self.hparams.vertexes
-        self.normals = self.hparams.normals
         self.n_actors = self.hparams.n_actors
         self.n_clusters = self.hparams.n_clusters
 
+        # The boundary CBFs have a slot for each possible edge of the admitted region,
+        # whose normal and offset are parameters: the region can change without a new solver
+        self.n_edges = self.hparams.max_edges
+        # Parameters: [actors states, edges normals (n_edges x 2), edges offsets (n_edges)]
+        self.n_actors_parameters = self.n_clusters * self.actor_state_size
+        self.parameters = np.zeros(self.n_actors_parameters + 3 * self.n_edges)
+        # View of the actors states in the parameters, one row per actor
+        self.actors_parameters = self.parameters[:self.n_actors_parameters].reshape(self.n_clusters,
+                                                                                    self.actor_state_size)
+        self.set_admitted_region(self.hparams.admitted_region)
+
         # Setup solver:
         self.acados_ocp_solver = self.__create_acados_ocp_solver(self.N,self.T)
+        # A cached solver holds the weights and bounds it was generated with
+        self.set_tuning(self.hparams)
+        # acados status of the last solve, -1 if the last update did not reach the solver
+        self.status = -1
+        # Inputs of the last successful solve, None before the first one
+        self.plan_inputs = None
+
+        # Workspaces of update, filled in place at each solve
+        self.x0 = np.zeros(self.nq)
+        self.y_ref = np.zeros((self.N, self.nq + self.nu))
+        self.y_ref_e = np.zeros(self.nq)
+        # The plan is still read by the other threads after the next solve:
+        # the inputs are written in turn in a ring of buffers.
+        # Ownership: plan_inputs is handed out after the solve and is not written anymore; only a
+        # successful solve writes a slot, the one handed out two solves before the current plan.
+        # A reader of the current plan (command interpolator tick, deadline watchdog publish, latency
+        # prediction) has therefore at least one control period to use it, it must not keep it longer:
+        # what is kept across control periods has to be copied
+        self.plan_slots = 3
+        self.plan_buffers = np.zeros((self.plan_slots, self.N, self.nu))
+        self.plan_idx = 0
 
     def init(self, x0: State):
         for k in range(self.N):
@@ -48,6 +95,42 @@ class NMPC:
             self.acados_ocp_solver.set(k, 'u', np.zeros(self.nu))
         self.acados_ocp_solver.set(self.N, 'x', x0.get_state())
 
+    def set_tuning(self, hparams: Hparams):
+        """
+        Set the cost weights and the bounds of the given parameters in the solver,
+        without generating it again. Call it between two solves
+        """
+        self.hparams = hparams
+        self.set_admitted_region(hparams.admitted_region)
+        W, W_e = self.__weights()
+        bounds = self.__bounds()
+        for k in range(self.N):
+            self.acados_ocp_solver.cost_set(k, 'W', W)
+            # The state bounds of the first stage are the initial state
+            if k > 0:
+                self.acados_ocp_solver.constraints_set(k, 'lbx', bounds['lbx'])
+                self.acados_ocp_solver.constraints_set(k, 'ubx', bounds['ubx'])
+            self.acados_ocp_solver.constraints_set(k, 'lbu', bounds['lbu'])
+            self.acados_ocp_solver.constraints_set(k, 'ubu', bounds['ubu'])
+            self.acados_ocp_solver.constraints_set(k, 'lg', bounds['lg'])
+            self.acados_ocp_solver.constraints_set(k, 'ug', bounds['ug'])
+        self.acados_ocp_solver.cost_set(self.N, 'W', W_e)
+        self.acados_ocp_solver.constraints_set(self.N, 'lg', bounds['lg_e'])
+        self.acados_ocp_solver.constraints_set(self.N, 'ug', bounds['ug_e'])
+
+    def set_admitted_region(self, admitted_region):
+        """
+        Set the edges of the region in the parameters, used from the next update.
+        The unused slots have a null normal and an offset giving h = 1, always satisfied
+        """
+        n_points = admitted_region.vertexes.shape[0]
+        normals = self.parameters[self.n_actors_parameters:self.n_actors_parameters + 2 * self.n_edges]
+        offsets = self.parameters[self.n_actors_parameters + 2 * self.n_edges:]
+        normals[:] = 0.0
+        normals[:2 * n_points] = admitted_region.normals.ravel()
+        offsets[:] = - self.hparams.rho_cbf - 1.0
+        offsets[:n_points] = admitted_region.offsets
+
     def __Euler(self, f, x0, u, dt):
         return x0 + f(x0,u)*dt
 
@@ -116,7 +199,7 @@ class NMPC:
         wheel_separation = self.hparams.wheel_separation
         return (wheel_radius / wheel_separation) * (alpha_r - alpha_l)
     
-    def __h(self, q, p):
+    def __h(self, q, p, region):
         x = q[self.hparams.x_idx]
         y = q[self.hparams.y_idx]
 
@@ -125,11 +208,10 @@ class NMPC:
         else:
             h = casadi.SX.zeros(self.n_edges)
 
-        # Define the safe set wrt the configuration bounds
-        robot_position = np.array([x, y])
-        for i in range(self.n_edges):
-            vertex = self.vertexes[i]
-            h[i] = np.dot(self.normals[i], robot_position - vertex) - self.hparams.rho_cbf
+        # Define the safe set wrt the configuration bounds: distance from the line of each edge
+        normals = casadi.reshape(region[:2 * self.n_edges], 2, self.n_edges).T
+        offsets = region[2 * self.n_edges:]
+        h[:self.n_edges] = casadi.mtimes(normals, casadi.vertcat(x, y)) - offsets - self.hparams.rho_cbf
         
         # Consider the robot distance from actors, if actors are present
         if self.n_actors > 0:
@@ -145,7 +227,8 @@ class NMPC:
         q = casadi.SX.sym('q', self.nq)
         qdot = casadi.SX.sym('qdot', self.nq)
         u = casadi.SX.sym('u', self.nu)
-        p = casadi.SX.sym('p', self.n_clusters * self.actor_state_size)
+        p = casadi.SX.sym('p', self.n_actors_parameters)
+        region = casadi.SX.sym('region', 3 * self.n_edges)
         f_expl = self.__f(q, u)
         f_impl = qdot - f_expl
 
@@ -164,14 +247,14 @@ class NMPC:
         if self.n_actors > 0:
             np.fill_diagonal(gamma_mat[self.n_edges:, self.n_edges:], self.hparams.gamma_actor)
 
-        h_k = self.__h(q, p)
+        h_k = self.__h(q, p, region)
         
         q_k1 = self.__integrate(self.kinematic_model, q, u)
         if self.n_actors > 0:
             p_k1 = self.__next_actor_state(p)
         else:
             p_k1 = p # just for consistency, it is not used in case of 0 actors
-        h_k1 = self.__h(q_k1, p_k1)
+        h_k1 = self.__h(q_k1, p_k1, region)
         con_h_expr = h_k1 + np.matmul(gamma_mat - id_mat, h_k)
         
         acados_model.con_h_expr = con_h_expr
@@ -180,17 +263,46 @@ class NMPC:
         acados_model.x = q
         acados_model.xdot = qdot
         acados_model.u = u
-        acados_model.p = p
+        acados_model.p = casadi.vertcat(p, region)
 
         return acados_model
     
-    def __create_acados_cost(self) -> AcadosOcpCost:
-        acados_cost = AcadosOcpCost()
-
-        # Set wheighting matrices
+    def __weights(self):
+        """
+        Weighting matrices of the stage and terminal costs
+        """
         Q_mat = np.diag([self.hparams.p_weight, self.hparams.p_weight, 0.0]) # [x, y, theta]
         R_mat = np.diag([self.hparams.v_weight, self.hparams.omega_weight]) # [v, omega]
         S_mat = np.diag([self.hparams.u_weight, self.hparams.u_weight]) # [alphar, alphal]
+        W = scipy.linalg.block_diag(Q_mat, R_mat, S_mat)
+        W_e = scipy.linalg.block_diag(self.hparams.terminal_factor_p * Q_mat,
+                                      self.hparams.terminal_factor_v * R_mat)
+        return W, W_e
+
+    def __bounds(self):
+        """
+        Bounds of the velocities (lbx, ubx), of the wheels accelerations (lbu, ubu),
+        of the wheels velocities and driving/steering accelerations (lg, ug, lg_e, ug_e)
+        """
+        bounds = {}
+        bounds['lbx'] = np.array([self.hparams.driving_vel_min, self.hparams.steering_vel_max_neg])
+        bounds['ubx'] = np.array([self.hparams.driving_vel_max, self.hparams.steering_vel_max])
+        bounds['lbu'] = np.array([self.hparams.alpha_min, self.hparams.alpha_min])
+        bounds['ubu'] = np.array([self.hparams.alpha_max, self.hparams.alpha_max])
+        bounds['lg'] = np.array([self.hparams.w_max_neg,
+                                 self.hparams.w_max_neg,
+                                 self.hparams.driving_acc_min,
+                                 self.hparams.steering_acc_max_neg])
+        bounds['ug'] = np.array([self.hparams.w_max,
+                                 self.hparams.w_max,
+                                 self.hparams.driving_acc_max,
+                                 self.hparams.steering_acc_max])
+        bounds['lg_e'] = bounds['lg'][:2]
+        bounds['ug_e'] = bounds['ug'][:2]
+        return bounds
+
+    def __create_acados_cost(self) -> AcadosOcpCost:
+        acados_cost = AcadosOcpCost()
 
         acados_cost.cost_type   = 'LINEAR_LS'
         acados_cost.cost_type_e = 'LINEAR_LS'
@@ -198,9 +310,8 @@ class NMPC:
         ny = self.nq + self.nu
         ny_e = self.nq
 
-        acados_cost.W_e = scipy.linalg.block_diag(self.hparams.terminal_factor_p * Q_mat,
-                                                  self.hparams.terminal_factor_v * R_mat)
-        acados_cost.W = scipy.linalg.block_diag(Q_mat, R_mat, S_mat)
+        # Set wheighting matrices
+        acados_cost.W, acados_cost.W_e = self.__weights()
 
         Vx = np.zeros((ny, self.nq))
         Vx[:self.nq, :self.nq] = np.eye(self.nq)
@@ -220,17 +331,18 @@ class NMPC:
     def __create_acados_constraints(self) -> AcadosOcpConstraints:
 
         acados_constraints = AcadosOcpConstraints()
+        bounds = self.__bounds()
 
         # Linear inequality constraints on the state:
         acados_constraints.idxbx = np.array([self.hparams.v_idx, self.hparams.omega_idx])
-        acados_constraints.lbx = np.array([self.hparams.driving_vel_min, self.hparams.steering_vel_max_neg])
-        acados_constraints.ubx = np.array([self.hparams.driving_vel_max, self.hparams.steering_vel_max])
+        acados_constraints.lbx = bounds['lbx']
+        acados_constraints.ubx = bounds['ubx']
         acados_constraints.x0 = np.zeros(self.nq)
 
         # Linear inequality constraints on the inputs:
         acados_constraints.idxbu = np.array([self.hparams.r_wheel_idx, self.hparams.l_wheel_idx])
-        acados_constraints.lbu = np.array([self.hparams.alpha_min, self.hparams.alpha_min])
-        acados_constraints.ubu = np.array([self.hparams.alpha_max, self.hparams.alpha_max])
+        acados_constraints.lbu = bounds['lbu']
+        acados_constraints.ubu = bounds['ubu']
 
         # Linear constraints on wheel velocities and driving/steering acceleration
         # expressed in terms of state and input
@@ -242,19 +354,11 @@ class NMPC:
         D_mat[3, :] = (self.hparams.wheel_radius / self.hparams.wheel_separation) * np.array([1, -1])
         acados_constraints.D = D_mat
         acados_constraints.C = C_mat
-        acados_constraints.lg = np.array([self.hparams.w_max_neg,
-                                          self.hparams.w_max_neg,
-                                          self.hparams.driving_acc_min,
-                                          self.hparams.steering_acc_max_neg])
-        acados_constraints.ug = np.array([self.hparams.w_max,
-                                          self.hparams.w_max,
-                                          self.hparams.driving_acc_max,
-                                          self.hparams.steering_acc_max])
+        acados_constraints.lg = bounds['lg']
+        acados_constraints.ug = bounds['ug']
         
-        acados_constraints.lg_e = np.array([self.hparams.w_max_neg,
-                                          self.hparams.w_max_neg])
-        acados_constraints.ug_e = np.array([self.hparams.w_max,
-                                          self.hparams.w_max])
+        acados_constraints.lg_e = bounds['lg_e']
+        acados_constraints.ug_e = bounds['ug_e']
         acados_constraints.C_e = C_mat[:2, :]
 
         # Nonlinear constraints (CBFs) (for both actors and configuration bounds):
@@ -283,7 +387,7 @@ class NMPC:
         acados_ocp = AcadosOcp()
         acados_ocp.model = self.__create_acados_model()
         acados_ocp.dims.N = N
-        acados_ocp.parameter_values = np.zeros((self.n_clusters * self.actor_state_size,))
+        acados_ocp.parameter_values = self.parameters.copy()
         acados_ocp.cost = self.__create_acados_cost()
         acados_ocp.constraints = self.__create_acados_constraints()
         acados_ocp.solver_options = self.__create_acados_solver_options(T)
@@ -292,34 +396,57 @@ class NMPC:
     
     def __create_acados_ocp_solver(self, N, T, use_cython=False) -> AcadosOcpSolver:
         acados_ocp = self.__create_acados_ocp(N, T)
+        # Generated code is keyed on the parameters it is built from (Hparams.solver_parameters): a solver
+        # built for the same configuration is reused, different configurations do not overwrite each other.
+        # The tunable parameters are set at runtime, they do not select the solver.
+        # A change of the model sources or of acados_template builds a new solver as well
+        acados_ocp.code_export_directory = os.path.join(self.hparams.solver_cache_dir,
+                                                        f"{self.hparams.solver_fingerprint}-{solver_sources_hash()}")
+        json_file = os.path.join(acados_ocp.code_export_directory, 'acados_ocp_nlp.json')
+        built = os.path.exists(json_file) and \
+            any(entry.startswith('libacados_ocp_solver') for entry in os.listdir(acados_ocp.code_export_directory))
         if use_cython:
-            AcadosOcpSolver.generate(acados_ocp, json_file='acados_ocp_nlp.json')
-            AcadosOcpSolver.build(acados_ocp.code_export_directory, with_cython=True)
-            return AcadosOcpSolver.create_cython_solver('acados_ocp_nlp.json')
+            if not built:
+                AcadosOcpSolver.generate(acados_ocp, json_file=json_file)
+                AcadosOcpSolver.build(acados_ocp.code_export_directory, with_cython=True)
+            return AcadosOcpSolver.create_cython_solver(json_file)
         else:
-            return AcadosOcpSolver(acados_ocp)
+            return AcadosOcpSolver(acados_ocp, json_file=json_file, generate=not built, build=not built)
 
     def update(
             self,
             state: State,
             q_ref: np.array,
             u_ref: np.array,
-            crowd_motion_prediction : CrowdMotionPrediction
+            actors_states : np.array
             ):
-        # Set parameters
+        """
+        actors_states: states [x, y, vx, vy] of the actors at each stage, shape (n_clusters, N, 4)
+        """
+        self.status = -1
+        self.y_ref[:, :self.nq] = q_ref[:, :self.N].T
+        self.y_ref[:, self.nq:] = u_ref.T
+        self.y_ref_e[:] = q_ref[:, self.N]
+        # Set parameters, the admitted region is already in place
         for k in range(self.N):
-            self.acados_ocp_solver.set(k, 'y_ref', np.concatenate((q_ref[:, k], u_ref[:, k])))
-            actors_state = np.zeros((self.hparams.n_clusters * self.actor_state_size))
-            for j in range(self.n_clusters):
-                actors_state[j*self.actor_state_size + 0] = crowd_motion_prediction.motion_predictions[j].positions[k].x
-                actors_state[j*self.actor_state_size + 1] = crowd_motion_prediction.motion_predictions[j].positions[k].y
-                actors_state[j*self.actor_state_size + 2] = crowd_motion_prediction.motion_predictions[j].velocities[k].x
-                actors_state[j*self.actor_state_size + 3] = crowd_motion_prediction.motion_predictions[j].velocities[k].y
-            self.acados_ocp_solver.set(k, 'p', actors_state)
-        self.acados_ocp_solver.set(self.N, 'y_ref', q_ref[:, self.N])
+            self.acados_ocp_solver.set(k, 'y_ref', self.y_ref[k])
+            if self.n_clusters > 0:
+                self.actors_parameters[:] = actors_states[:, k]
+            self.acados_ocp_solver.set(k, 'p', self.parameters)
+        self.acados_ocp_solver.set(self.N, 'y_ref', self.y_ref_e)
 
         # Solve NLP
-        self.u0 = self.acados_ocp_solver.solve_for_x0(state.get_state())
+        try:
+            self.u0 = self.acados_ocp_solver.solve_for_x0(state.get_state(out=self.x0))
+        finally:
+            self.status = self.acados_ocp_solver.get_status()
+        # Neither the current plan nor the previous one, which a reader may have just fetched
+        plan_inputs = self.plan_buffers[self.plan_idx]
+        for k in range(self.N):
+            plan_inputs[k] = self.acados_ocp_solver.get(k, 'u')
+        self.plan_idx = (self.plan_idx + 1) % self.plan_slots
+        # Replaced at once, it can be read by another thread
+        self.plan_inputs = plan_inputs
 
     def get_command(self):
         return self.u0
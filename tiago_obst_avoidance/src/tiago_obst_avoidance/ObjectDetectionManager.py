@@ -1,19 +1,23 @@
 import numpy as np
 import os
 import time
-import json
+import importlib
 import math
 import rospy
 import threading
-import tf2_ros
-from sklearn.cluster import DBSCAN
-from scipy.spatial.distance import cdist
 
-from tiago_obst_avoidance.utils import *
-from tiago_obst_avoidance.Hparams import *
-from tiago_obst_avoidance.RobotStatus import *
+from tiago_obst_avoidance.utils import z_rotations, State, Position, Velocity, LaserScan, MotionPrediction, \
+    CrowdMotionPrediction, CrowdMotionPredictionStamped
+from tiago_obst_avoidance.Hparams import Hparams
+from tiago_obst_avoidance.Geometry import AdmittedRegion
+from tiago_obst_avoidance.PoseTracker import PoseTracker
+from tiago_obst_avoidance.TopicIngestion import JointVelocities
+from tiago_obst_avoidance.RobotStatus import RobotStatus
+from tiago_obst_avoidance.Profiling import StartupProfiler
+from tiago_obst_avoidance.Logger import Logger
 
 import sensor_msgs.msg
+import geometry_msgs.msg
 import tiago_msgs.srv
 import tiago_msgs.msg
 
@@ -56,39 +60,33 @@ def moving_average(polar_scans):
 
     return smoothed_scans
 
-def data_preprocessing(scans, tiago_state, range_min, angle_min, angle_incr):
-    n_edges = Hparams.n_points
-    vertexes = Hparams.vertexes
-    normals = Hparams.normals
-    polar_scans = []
-    absolute_scans = []
-
+def data_preprocessing(scans, tiago_state, range_min, angle_min, angle_incr, admitted_region):
+    """
+    Absolute positions (n, 2) and polar coordinates (n, 2) as [beam index, range]
+    of the valid beams hitting inside the admitted region
+    """
     # Delete the first and last 20 laser scan ranges (wrong measurements?)
     offset = Hparams.offset
-    scans = np.delete(scans, range(offset), 0)
-    scans = np.delete(scans, range(len(scans) - offset, len(scans)), 0)
-
-    for idx, value in enumerate(scans):
-        outside = False
-        if value != np.inf and value >= range_min:
-            # print("value")
-            # print(value)
-            absolute_scan = polar2absolute((idx + offset, value), tiago_state, angle_min, angle_incr)
-            for i in range(n_edges):
-                vertex = vertexes[i]
-                # print(vertex)
-                if np.dot(normals[i], absolute_scan - vertex) < 0.0:
-                    outside = True
-                    break
-            if not outside:
-                # print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ if")
-                polar_scans.append((idx + offset, value))
-                absolute_scans.append(absolute_scan.tolist())
-
-    return absolute_scans, polar_scans
+    scans = np.asarray(scans, dtype=float)
+    idx = np.arange(offset, scans.shape[0] - offset)
+    values = scans[idx]
+    valid = (values != np.inf) & (values >= range_min)
+    idx = idx[valid]
+    values = values[valid]
+
+    # All the beams at once, as polar2absolute
+    angles = angle_min + idx * angle_incr
+    relative_scans = np.stack((values * np.cos(angles), values * np.sin(angles)), axis=1) + Hparams.relative_laser_pos
+    absolute_scans = z_rotations(tiago_state.theta, relative_scans) + np.array([tiago_state.x, tiago_state.y])
+
+    inside = admitted_region.contains(absolute_scans)
+    polar_scans = np.stack((idx[inside], values[inside]), axis=1)
+    return absolute_scans[inside], polar_scans
 
 def data_clustering(absolute_scans, polar_scans):
     if len(absolute_scans) != 0:
+        # sklearn is imported once at setup by ObjectDetectionManager, here the import is a lookup
+        from sklearn.cluster import DBSCAN
         k_means = DBSCAN(eps = 0.2, min_samples = 5)
         clusters = k_means.fit_predict(np.array(absolute_scans))
         dynamic_n_clusters = max(clusters) + 1
@@ -142,7 +140,12 @@ class ObjectDetectionMamager:
         self.robot_state = State(0.0, 0.0, 0.0, 0.0, 0.0)
         self.wheels_vel = np.zeros(2) # [w_r, w_l]
         self.hparams = Hparams()
+        # Latest wheels velocities, written in place by the joint_states subscriber
+        self.wheels_velocities = JointVelocities(self.hparams.wheel_joints, self.hparams.wheel_joints_fallback)
         self.laser_scan = None
+        # Scan used by the last detection and the robot state when it has been acquired
+        self.detected_scan = None
+        self.scan_state = None
         self.n_actors = self.hparams.n_actors
         self.n_clusters = self.hparams.n_clusters
         self.actors_position = np.zeros((self.hparams.n_clusters, 2))
@@ -151,31 +154,30 @@ class ObjectDetectionMamager:
         self.frequency = self.hparams.controller_frequency
         self.dt = self.hparams.dt
 
-        # Set variables to store data  
+        # Clustering is only needed by the real sensing: import sklearn now rather than in the loop
+        if not self.hparams.fake_sensing:
+            importlib.import_module('sklearn.cluster')
+
+        # Set the logger to store data
         if self.hparams.log:
-            self.kalman_infos = {}
-            kalman_names = ['KF_{}'.format(i + 1) for i in range(self.n_clusters)]
-            self.kalman_infos = {key: list() for key in kalman_names}
-            self.time_history = []
-            if not self.hparams.fake_sensing:
-                self.scans_history = []
-            self.actors_history = []
-            self.robot_state_history = []
+            log_dir = '/tmp/tiago_obst_avoidance/data'
+            self.logger = Logger(os.path.join(log_dir, self.hparams.prediction_file))
+            self.laser_ranges_scale = 1e-3 # ranges are logged in [mm]
+            self.init_log()
 
         # Setup reference frames:
         self.map_frame = 'map'
         self.base_footprint_frame = 'base_footprint'
 
-        # Setup TF listener:
-        self.tf_buffer = tf2_ros.Buffer()
-        self.tf_listener = tf2_ros.TransformListener(self.tf_buffer)
+        # Setup the pose source, updated by the TF messages, with theta unwrapped:
+        self.pose_tracker = PoseTracker(self.map_frame, self.base_footprint_frame)
 
         # Setup subscriber for joint_states topic
         state_topic = '/joint_states'
         rospy.Subscriber(
             state_topic,
             sensor_msgs.msg.JointState,
-            self.joint_states_callback
+            self.wheels_velocities.callback
         )
 
         # Setup subscriber to scan_raw topic
@@ -186,6 +188,15 @@ class ObjectDetectionMamager:
             self.laser_scan_callback
         )
 
+        # Setup subscriber to the admitted region in use by the controller, it can change at runtime
+        self.admitted_region = self.hparams.admitted_region
+        admitted_region_topic = 'admitted_region'
+        rospy.Subscriber(
+            admitted_region_topic,
+            geometry_msgs.msg.Polygon,
+            self.admitted_region_callback
+        )
+
         # Setup publisher for crowd motion prediction:
         crowd_prediction_topic = 'crowd_motion_prediction'
         self.crowd_motion_prediction_publisher = rospy.Publisher(
@@ -201,23 +212,23 @@ class ObjectDetectionMamager:
             self.set_actors_trajectory_request
         )
 
-    def joint_states_callback(self, msg):
-        self.wheels_vel = np.array([msg.velocity[13], msg.velocity[12]])
+    def admitted_region_callback(self, msg):
+        try:
+            self.admitted_region = AdmittedRegion.from_vertexes([[point.x, point.y] for point in msg.points])
+        except Exception as e:
+            rospy.logwarn(f"Invalid admitted region ignored: {e}")
 
     def laser_scan_callback(self, msg):
         self.data_lock.acquire()
         self.laser_scan = LaserScan.from_message(msg)
         self.data_lock.release()
 
-    def set_from_tf_transform(self, transform):
-        q = transform.transform.rotation
-        theta = math.atan2(
-            2.0 * (q.w * q.z + q.x * q.y),
-            1.0 - 2.0 * (q.y * q.y + q.z * q.z)
-        )
-        self.robot_state.theta = theta
-        self.robot_state.x = transform.transform.translation.x + self.hparams.b * math.cos(theta)
-        self.robot_state.y = transform.transform.translation.y + self.hparams.b * math.sin(theta)
+    def state_from_pose(self, pose, state):
+        x, y, theta = pose
+        state.theta = theta
+        state.x = x + self.hparams.b * math.cos(theta)
+        state.y = y + self.hparams.b * math.sin(theta)
+        return state
 
     def set_actors_trajectory_request(self, request):
         if not self.hparams.fake_sensing:
@@ -228,6 +239,15 @@ class ObjectDetectionMamager:
                 rospy.loginfo("Cannot set actors trajectory, robot is not READY")
                 return tiago_msgs.srv.SetActorsTrajectoryResponse(False)            
             elif self.status == RobotStatus.READY:
+                # One trajectory per cluster is read at each iteration
+                n_trajectories = len(request.trajectories.motion_predictions)
+                if n_trajectories != self.n_clusters:
+                    rospy.logerr(f"Cannot set actors trajectory, {n_trajectories} trajectories received "
+                                 f"while n_actors is {self.n_clusters}")
+                    return tiago_msgs.srv.SetActorsTrajectoryResponse(False)
+                if len(request.trajectories.motion_predictions[0].positions) == 0:
+                    rospy.logerr("Cannot set actors trajectory, the trajectories are empty")
+                    return tiago_msgs.srv.SetActorsTrajectoryResponse(False)
                 self.trajectories = CrowdMotionPrediction.from_message(request.trajectories)
                 self.status = RobotStatus.MOVING
                 self.current = 0
@@ -250,30 +270,38 @@ class ObjectDetectionMamager:
                 if self.current == self.trajectory_length:
                     self.current = 0
             else:
-                angle_min = self.laser_scan.angle_min
-                angle_increment = self.laser_scan.angle_increment
-                range_min = self.laser_scan.range_min
+                # The scan can be replaced by the callback meanwhile, it is kept for the log
+                laser_scan = self.laser_scan
+                self.detected_scan = laser_scan
+                angle_min = laser_scan.angle_min
+                angle_increment = laser_scan.angle_increment
+                range_min = laser_scan.range_min
+                # The scan is transformed with the pose of the robot when it has been acquired
+                scan_state = self.state_from_pose(self.pose_tracker.pose_at(laser_scan.time),
+                                                  State(0.0, 0.0, 0.0, self.robot_state.v, self.robot_state.omega))
+                self.scan_state = scan_state
 
                 # Perform data preprocessing
                 self.absolute_scans = []
                 self.polar_scans = []
-                self.absolute_scans, self.polar_scans = data_preprocessing(self.laser_scan.ranges,
-                                                                           self.robot_state,
+                self.absolute_scans, self.polar_scans = data_preprocessing(laser_scan.ranges,
+                                                                           scan_state,
                                                                            range_min,
                                                                            angle_min,
-                                                                           angle_increment)
+                                                                           angle_increment,
+                                                                           self.admitted_region)
                 # print(self.absolute_scans)
                 # print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
                 # print(self.polar_scans)
                 # print("ranges")
-                # print(self.laser_scan.ranges)
+                # print(laser_scan.ranges)
                 # Perform data clustering
                 actors_polar_position = data_clustering(self.absolute_scans,
                                                         self.polar_scans)
                 
                 for (i, dist) in enumerate(actors_polar_position):
                     actors_position[i] = polar2absolute(actors_polar_position[i],
-                                                        self.robot_state,
+                                                        scan_state,
                                                         angle_min,
                                                         angle_increment)
                     
@@ -282,24 +310,20 @@ class ObjectDetectionMamager:
             self.data_lock.release()
 
     def update_state(self):
-        try:
-            # Update [x, y, theta]
-            transform = self.tf_buffer.lookup_transform(
-                self.map_frame, self.base_footprint_frame, rospy.Time()
-            )
-            self.set_from_tf_transform(transform)
-            # Update [v, omega]
-            self.robot_state.v = self.hparams.wheel_radius * 0.5 * \
-                (self.wheels_vel[self.hparams.r_wheel_idx] + self.wheels_vel[self.hparams.l_wheel_idx])
-            
-            self.robot_state.omega = (self.hparams.wheel_radius / self.hparams.wheel_separation) * \
-                (self.wheels_vel[self.hparams.r_wheel_idx] - self.wheels_vel[self.hparams.l_wheel_idx])
-            return True
-        except(tf2_ros.LookupException,
-               tf2_ros.ConnectivityException,
-               tf2_ros.ExtrapolationException):
+        # Update [x, y, theta]
+        latest = self.pose_tracker.latest()
+        if latest is None:
             rospy.logwarn("Missing current state")
             return False
+        self.state_from_pose(latest[0], self.robot_state)
+        # Update [v, omega]
+        self.wheels_vel[:] = self.wheels_velocities.latest()[0]
+        self.robot_state.v = self.hparams.wheel_radius * 0.5 * \
+            (self.wheels_vel[self.hparams.r_wheel_idx] + self.wheels_vel[self.hparams.l_wheel_idx])
+        
+        self.robot_state.omega = (self.hparams.wheel_radius / self.hparams.wheel_separation) * \
+            (self.wheels_vel[self.hparams.r_wheel_idx] - self.wheels_vel[self.hparams.l_wheel_idx])
+        return True
 
     def propagate_state(self, state, N):
         predictions = [self.hparams.nullstate for _ in range(N)]
@@ -320,33 +344,57 @@ class ObjectDetectionMamager:
 
         return next_state
 
-    def log_values(self):
-        output_dict = {}
-        output_dict['kfs'] = self.kalman_infos
-        output_dict['robot_states'] = self.robot_state_history
-        output_dict['cpu_time'] = self.time_history
-        output_dict['actors_position'] = self.actors_history
-        if not self.hparams.fake_sensing:
-            output_dict['laser_scans'] = self.scans_history
-            output_dict['angle_min'] = self.laser_scan.angle_min
-            output_dict['angle_max'] = self.laser_scan.angle_max
-            output_dict['angle_inc'] = self.laser_scan.angle_increment
-            output_dict['laser_offset'] = self.hparams.offset
-            output_dict['range_min'] = self.laser_scan.range_min
-            output_dict['range_max'] = self.laser_scan.range_max
-            output_dict['laser_relative_pos'] = self.hparams.relative_laser_pos.tolist()
-        
-        # log the data in a .json file
-        log_dir = '/tmp/tiago_obst_avoidance/data'
-        filename = self.hparams.prediction_file
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-        log_path = os.path.join(log_dir, filename)
-        with open(log_path, 'w') as file:
-            json.dump(output_dict, file)
+    def init_log(self):
+        self.logger.add_channel('robot_states', (5,))
+        self.logger.add_channel('cpu_time')
+        self.logger.add_channel('actors_position', (self.n_clusters, 2))
+        kalman_names = ['KF_{}'.format(i + 1) for i in range(self.n_clusters)]
+        self.logger.set_metadata(kfs={key: list() for key in kalman_names},
+                                 hparams_fingerprint=self.hparams.fingerprint)
+
+    def init_scan_log(self, laser_scan):
+        """
+        Scans are logged as quantized raw ranges plus the mask of the beams kept by
+        the preprocessing and the pose [x, y, theta] the scan has been transformed with,
+        the absolute points are reconstructed on read with the scan layout
+        """
+        n_beams = len(laser_scan.ranges)
+        self.logger.add_channel('laser_ranges', (n_beams,), np.uint16)
+        self.logger.add_channel('laser_mask', ((n_beams + 7) // 8,), np.uint8)
+        self.logger.add_channel('scan_poses', (3,))
+        self.logger.set_metadata(
+            angle_min=laser_scan.angle_min,
+            angle_max=laser_scan.angle_max,
+            angle_inc=laser_scan.angle_increment,
+            laser_offset=self.hparams.offset,
+            range_min=laser_scan.range_min,
+            range_max=laser_scan.range_max,
+            laser_relative_pos=self.hparams.relative_laser_pos.tolist(),
+            laser_n_beams=n_beams,
+            laser_ranges_scale=self.laser_ranges_scale
+        )
+
+    def log_scan(self, stamp, laser_scan, polar_scans, scan_state):
+        """
+        Log the scan used by the detection with the mask of the beams it kept and the pose at the scan stamp
+        """
+        ranges = np.asarray(laser_scan.ranges, dtype=np.float64)
+        valid = np.isfinite(ranges)
+        quantized = np.zeros(ranges.shape[0], dtype=np.uint16)
+        quantized[valid] = np.clip(np.round(ranges[valid] / self.laser_ranges_scale), 0, np.iinfo(np.uint16).max)
+        mask = np.zeros(ranges.shape[0], dtype=bool)
+        mask[polar_scans[:, 0].astype(int)] = True
+        self.logger.log('laser_ranges', quantized, stamp)
+        self.logger.log('laser_mask', np.packbits(mask), stamp)
+        self.logger.log('scan_poses', (scan_state.x, scan_state.y, scan_state.theta), stamp)
 
+    def log_values(self):
+        # Write the pending chunks and close the log files
+        self.logger.close()
+        if self.logger.dropped_chunks > 0:
+            rospy.logwarn(f"{self.logger.dropped_chunks} log chunks have been dropped")
 
-    def run(self):
+    def run(self, startup_profiler=None):
         rate = rospy.Rate(self.frequency)
         if self.hparams.log:
             rospy.on_shutdown(self.log_values)
@@ -364,6 +412,9 @@ class ObjectDetectionMamager:
                     print("Initial state ****************************")
                     print(self.robot_state)
                     print("******************************************")
+                    if startup_profiler is not None:
+                        startup_profiler.mark('initial_state')
+                        startup_profiler.report()
                 else:
                     rate.sleep()
                     continue
@@ -390,17 +441,12 @@ class ObjectDetectionMamager:
             
             # Saving data for plots
             if self.hparams.log:
-                self.robot_state_history.append([
-                    self.robot_state.x,
-                    self.robot_state.y,
-                    self.robot_state.theta,
-                    self.robot_state.v,
-                    self.robot_state.omega,
-                    start_time
-                ])
-                self.actors_history.append(self.actors_position.tolist())
+                self.logger.log('robot_states', self.robot_state.get_state(), start_time)
+                self.logger.log('actors_position', self.actors_position, start_time)
                 if not self.hparams.fake_sensing:
-                    self.scans_history.append(self.absolute_scans)
+                    if 'laser_ranges' not in self.logger.channels:
+                        self.init_scan_log(self.detected_scan)
+                    self.log_scan(start_time, self.detected_scan, self.polar_scans, self.scan_state)
 
             for i in range(self.hparams.n_clusters):
                 if any(coord != 0.0 for coord in self.actors_position[i]):
@@ -431,13 +477,21 @@ class ObjectDetectionMamager:
             if self.hparams.log:
                 end_time = time.time()
                 deltat = end_time - start_time
-                self.time_history.append([deltat, start_time])
+                self.logger.log('cpu_time', deltat, start_time)
 
             rate.sleep()
 
 def main():
+    startup_profiler = StartupProfiler()
     rospy.init_node('tiago_object_detection', log_level=rospy.INFO)
     rospy.loginfo('TIAGo object detection module [OK]')
+    startup_profiler.mark('init_node')
+
+    # Both modules must run with the same parameters
+    Hparams.load()
+    Hparams.publish_fingerprint()
+    startup_profiler.mark('load_hparams')
 
     object_detection_manager = ObjectDetectionMamager()
-    object_detection_manager.run()
\ No newline at end of file
+    startup_profiler.mark('setup')
+    object_detection_manager.run(startup_profiler)
\ No newline at end of file
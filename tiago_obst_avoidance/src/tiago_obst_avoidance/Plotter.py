@@ -1,131 +1,108 @@
 import numpy as np
-import math
-import json
 import os
-import rospy
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from matplotlib.patches import Circle
 from  matplotlib.animation import FuncAnimation
 
-from tiago_obst_avoidance.utils import *
-from tiago_obst_avoidance.Hparams import *
+from tiago_obst_avoidance.utils import z_rotation, z_rotations
+from tiago_obst_avoidance.Hparams import Hparams
+from tiago_obst_avoidance.Geometry import AdmittedRegion
+from tiago_obst_avoidance.LogReader import LogReader
+from tiago_obst_avoidance.VideoExport import export_animations
 
-def plot_results(filename=None):
-    # Specify logging directory
-    log_dir = '/tmp/tiago_obst_avoidance/data'
+def open_logs(filename, log_dir='/tmp/tiago_obst_avoidance/data'):
     if not os.path.exists(log_dir):
         raise Exception(
            f"Specified directory not found"
         )
 
-    # Specify saving plots directory
-    plots_savedir = '/tmp/tiago_obst_avoidance/plots'
-    if not os.path.exists(plots_savedir):
-        os.makedirs(plots_savedir)
-
-    # Specify saving animations directory
-    animation_savedir = '/tmp/tiago_obst_avoidance/animations'
-    if not os.path.exists(animation_savedir):
-        os.makedirs(animation_savedir)
-
-    log_controller = os.path.join(log_dir, filename + '_controller.json')
-    log_predictor = os.path.join(log_dir, filename + '_predictor.json')
-    configuration_savepath = os.path.join(plots_savedir, filename + '_configuration.png')
-    time_savepath = os.path.join(plots_savedir, filename + '_time.png')
-    scans_savepath = os.path.join(animation_savedir, filename + '_scans.mp4')
-    world_savepath = os.path.join(animation_savedir, filename + '_world.mp4')
-
+    log_controller = os.path.join(log_dir, filename + '_controller')
+    log_predictor = os.path.join(log_dir, filename + '_predictor')
     print(log_controller)
 
-    # Open the controller log file
-    if os.path.exists(log_controller):
-        with open(log_controller, 'r') as file:
-            controller_dict = json.load(file)
+    # Open the controller log and, if the prediction module is present, the predictor log
+    controller_log = LogReader(log_controller)
+    if controller_log['n_actors'] > 0:
+        predictor_log = LogReader(log_predictor)
     else:
-        raise Exception(
-            f"Specified file not found"
-        )
+        predictor_log = None
+    return controller_log, predictor_log
+
+def absolute_window(controller_log, t_start=None, t_end=None):
+    """
+    Convert a time window relative to the first controller iteration to log timestamps
+    """
+    t = controller_log.times('cpu_time')
+    t0 = t[0] if t.shape[0] > 0 else 0.0
+    return (None if t_start is None else t0 + t_start,
+            None if t_end is None else t0 + t_end)
+
+def laser_fov(predictor_log):
+    """
+    Laser position and corners of the field of view in the robot frame
+    """
+    angle_inc = predictor_log['angle_inc']
+    offset = predictor_log['laser_offset']
+    angle_min = predictor_log['angle_min'] + angle_inc * offset
+    angle_max = predictor_log['angle_max'] - angle_inc * offset
+    range_min = predictor_log['range_min']
+    range_max = predictor_log['range_max']
+    laser_position = np.array(predictor_log['laser_relative_pos'])
+    p_lr = z_rotation(angle_min, np.array([range_min, 0.0]))
+    p_ur = z_rotation(angle_min, np.array([range_max, 0.0]))
+    p_ll = z_rotation(angle_max, np.array([range_min, 0.0]))
+    p_ul = z_rotation(angle_max, np.array([range_max, 0.0]))
+    return laser_position, p_lr, p_ur, p_ll, p_ul
+
+def robot_centers(configurations, b):
+    return configurations[:, :2] - b * np.stack((np.cos(configurations[:, 2]),
+                                                 np.sin(configurations[:, 2])), axis=1)
+
+def fov_segments(configurations, fov):
+    """
+    Borders of the laser field of view for each configuration: array (n_frames, 2, 2, 2)
+    indexed by [frame, border, x/y, point]
+    """
+    laser_position, p_lr, p_ur, p_ll, p_ul = fov
+    theta = configurations[:, 2]
+    laser = configurations[:, :2] + z_rotations(theta, laser_position)
+    corners = laser[:, np.newaxis, :] + z_rotations(theta[:, np.newaxis], np.stack((p_lr, p_ur, p_ll, p_ul)))
+    return corners.reshape((-1, 2, 2, 2)).transpose(0, 1, 3, 2)
+
+def decimate(t, y, n_buckets):
+    """
+    Keep the first, minimum and maximum sample of n_buckets buckets of consecutive samples,
+    so that a line drawn on about n_buckets pixels still shows every spike
+    """
+    n = t.shape[0]
+    if n <= 4 * n_buckets:
+        return t, y
+    bucket_size = -(-n // n_buckets)
+    padding = bucket_size * n_buckets - n
+    buckets = np.concatenate((y, np.full(padding, np.nan))).reshape((n_buckets, bucket_size))
+    starts = np.arange(n_buckets) * bucket_size
+    idx_min = starts + np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+    idx_max = starts + np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+    idx = np.unique(np.concatenate((starts, idx_min, idx_max, [n - 1])))
+    idx = idx[idx < n]
+    return t[idx], y[idx]
+
+def figure_buckets(fig):
+    # One bucket per horizontal pixel of the figure
+    return int(fig.get_figwidth() * fig.dpi)
+
+def plot_time(controller_log, predictor_log, window=(None, None)):
+    """
+    Figure elapsed time per iteration (controller and predictor if prediction module is present)
+    """
+    iteration_time, t = controller_log.read('cpu_time', *window)
+    frequency = controller_log['frequency']
 
-    # Extract the controller data
-    iteration_time = np.array(controller_dict['cpu_time'])
-    states = np.array(controller_dict['states'])
-    configurations = states[:, :3]
-    robot_center = np.empty((configurations.shape[0], 2))
-    b = controller_dict['offset_b']
-    for i in range(configurations.shape[0]):
-        robot_center[i, 0] = configurations[i, 0] - b * math.cos(configurations[i, 2])
-        robot_center[i, 1] = configurations[i, 1] - b * math.sin(configurations[i, 2])
-    
-    robot_predictions = np.array(controller_dict['robot_predictions'])
-    inputs = np.array(controller_dict['wheels_accelerations'])
-    commanded_vel = np.array(controller_dict['commanded_velocities'])
-    targets = np.array(controller_dict['targets'])
-    errors = targets[:, :2] - configurations[:, :2]
-    wheel_radius = controller_dict['wheel_radius']
-    wheel_separation = controller_dict['wheel_separation']
-    # driving_velocities = states[:, 3]
-    # steering_velocities = states[:, 4]
-    # wheels_velocities = np.array(controller_dict['wheels_velocities'])
-    # driving_acc = wheel_radius * 0.5 * (inputs[:, 0] + inputs[:, 1])
-    # steering_acc = (wheel_radius / wheel_separation) * (inputs[:, 0] - inputs[:, 1])
-
-    n_edges = controller_dict['n_edges']
-    boundary_vertexes = np.array(controller_dict['boundary_vertexes'])
-    input_bounds = np.array(controller_dict['input_bounds'])
-    v_bounds = np.array(controller_dict['v_bounds'])
-    # omega_bounds = np.array(controller_dict['omega_bounds'])
-    # wheels_vel_bounds = np.array(controller_dict['wheels_vel_bounds'])
-    # vdot_bounds = np.array(controller_dict['vdot_bounds'])
-    # omegadot_bounds = np.array(controller_dict['omegadot_bounds'])
-
-    n_actors = controller_dict['n_actors']
-    n_clusters = controller_dict['n_clusters']
-    simulation = controller_dict['simulation']
-    if n_actors > 0:
-        fake_sensing = controller_dict['fake_sensing']
-        actors_predictions = np.array(controller_dict['actors_predictions'])
-        if simulation and not fake_sensing:
-            actors_groundtruth = np.array(controller_dict['actors_gt'])
-        
-    rho_cbf = controller_dict['rho_cbf']
-    ds_cbf = controller_dict['ds_cbf']
-    frequency = controller_dict['frequency']
-    base_radius = controller_dict['base_radius']
-    shooting_nodes = inputs.shape[0]
-    t = inputs[:, 2]
-
-    # If the prediction module is present, open the predictor log file
-    if n_actors > 0:
-        if os.path.exists(log_predictor):
-            with open(log_predictor, 'r') as file:
-                predictor_dict = json.load(file)
-        else:
-            raise Exception(
-                f"Specified file not found"
-            )
-        # Extract the predictor data
-        predictor_time = np.array(predictor_dict['cpu_time'])
-        laser_scans = predictor_dict['laser_scans']
-        actors_position = np.array(predictor_dict['actors_position'])
-        robot_states = np.array(predictor_dict['robot_states'])
-        robot_config = robot_states[:, :3]
-        angle_inc = predictor_dict['angle_inc']
-        offset = predictor_dict['laser_offset']
-        angle_min = predictor_dict['angle_min'] + angle_inc * offset
-        angle_max = predictor_dict['angle_max'] - angle_inc * offset
-        range_min = predictor_dict['range_min']
-        range_max = predictor_dict['range_max']
-        laser_position = np.array(predictor_dict['laser_relative_pos'])
-        p_lr = z_rotation(angle_min, np.array([range_min, 0.0]))
-        p_ur = z_rotation(angle_min, np.array([range_max, 0.0]))
-        p_ll = z_rotation(angle_max, np.array([range_min, 0.0]))
-        p_ul = z_rotation(angle_max, np.array([range_max, 0.0]))        
-
-    # Figure elapsed time per iteration (controller and predictor if prediction module is present)
     fig, axs = plt.subplots(2, 1, figsize=(16, 8))
+    n_buckets = figure_buckets(fig)
     
-    axs[0].step(t, iteration_time[:, 0])
+    axs[0].step(*decimate(t, iteration_time, n_buckets))
     axs[0].set_title('Elapsed time per controller iteration')
     axs[0].set_xlabel('$t \quad [s]$')
     axs[0].set_ylabel('$iteration \quad time \quad [s]$')
@@ -133,26 +110,39 @@ def plot_results(filename=None):
     axs[0].set_xlim([t[0], t[-1]])
     axs[0].grid(True)
 
-    if n_actors > 0:
-        axs[1].step(predictor_time[:, 1], predictor_time[:, 0])
+    if predictor_log is not None:
+        predictor_iteration_time, predictor_t = predictor_log.read('cpu_time', *window)
+        axs[1].step(*decimate(predictor_t, predictor_iteration_time, n_buckets))
         axs[1].set_title('Elapsed time per predictor iteration')
         axs[1].set_xlabel('$t \quad [s]$')
         axs[1].set_ylabel('$iteration \quad time \quad [s]$')
-        axs[1].hlines(1 / frequency, predictor_time[0, 1], predictor_time[-1, 1], color='red', linestyle='--')
-        axs[1].set_xlim(predictor_time[0, 1], predictor_time[-1, 1])
+        axs[1].hlines(1 / frequency, predictor_t[0], predictor_t[-1], color='red', linestyle='--')
+        axs[1].set_xlim(predictor_t[0], predictor_t[-1])
         axs[1].grid(True)
 
     fig.tight_layout()
-    fig.savefig(time_savepath)
+    return fig
+
+def plot_configuration(controller_log, window=(None, None)):
+    """
+    Figure cartesian error, inputs, wheel accelerations
+    """
+    states, _ = controller_log.read('states', *window)
+    inputs, t = controller_log.read('wheels_accelerations', *window)
+    commanded_vel, _ = controller_log.read('commanded_velocities', *window)
+    targets, _ = controller_log.read('targets', *window)
+    errors = targets[:, :2] - states[:, :2]
+    input_bounds = np.array(controller_log['input_bounds'])
+    v_bounds = np.array(controller_log['v_bounds'])
 
-    # cartesian error, inputs, wheel accelerations
     config_fig, ax_fig = plt.subplots(3, 1, figsize=(16, 8))
+    n_buckets = figure_buckets(config_fig)
 
-    ax_fig[0].plot(t, np.linalg.norm(errors, axis = 1), label='|e|')
-    ax_fig[1].plot(t, commanded_vel[:, 0], label='v')
-    ax_fig[1].plot(t, commanded_vel[:, 1], label='$\omega$')
-    ax_fig[2].plot(t, inputs[:, 0], label='$\dot{\omega}_R$')
-    ax_fig[2].plot(t, inputs[:, 1], label='$\dot{\omega}_L$')
+    ax_fig[0].plot(*decimate(t, np.linalg.norm(errors, axis = 1), n_buckets), label='|e|')
+    ax_fig[1].plot(*decimate(t, commanded_vel[:, 0], n_buckets), label='v')
+    ax_fig[1].plot(*decimate(t, commanded_vel[:, 1], n_buckets), label='$\omega$')
+    ax_fig[2].plot(*decimate(t, inputs[:, 0], n_buckets), label='$\dot{\omega}_R$')
+    ax_fig[2].plot(*decimate(t, inputs[:, 1], n_buckets), label='$\dot{\omega}_L$')
 
     ax_fig[0].set_title('Cartesian error norm |e|')
     ax_fig[0].set_xlabel("$t \quad [s]$")
@@ -183,285 +173,281 @@ def plot_results(filename=None):
     ax_fig[2].grid(True)
 
     config_fig.tight_layout()
-    if Hparams.save_video:
-        config_fig.savefig(configuration_savepath)
-    else:
-        # doesn't continue if the plots are open
-        plt.show()
+    return config_fig
+
+def boundary_lines(ax, region):
+    lines = []
+    for part in region.parts:
+        ends = part.vertexes + part.directions
+        lines.extend(ax.plot([part.vertexes[i, 0], ends[i, 0]], [part.vertexes[i, 1], ends[i, 1]],
+                             color='red', linestyle='--')[0]
+                     for i in range(part.n_edges))
+    return lines
+
+def world_frames(controller_log, predictor_log, window=(None, None)):
+    """
+    Per-frame geometry of the world animation, computed once for all frames
+    """
+    states, _ = controller_log.read('states', *window)
+    configurations = states[:, :3]
+    frames = {
+        'configurations': configurations,
+        'robot_center': robot_centers(configurations, controller_log['offset_b']),
+        'robot_predictions': controller_log.read('robot_predictions', *window)[0],
+        'targets': controller_log.read('targets', *window)[0]
+    }
+    if controller_log['n_actors'] > 0:
+        fake_sensing = controller_log['fake_sensing']
+        actors_predictions, _ = controller_log.read('actors_predictions', *window)
+        frames['actors_predictions'] = actors_predictions
+        frames['actors_position'] = actors_predictions[:, :, :, 0]
+        if controller_log['simulation'] and not fake_sensing:
+            frames['actors_gt'] = controller_log.read('actors_gt', *window)[0]
+        if not fake_sensing:
+            frames['fov'] = fov_segments(configurations, laser_fov(predictor_log))
+    return frames
+
+def scans_frames(controller_log, predictor_log, window=(None, None)):
+    """
+    Per-frame geometry of the scans animation, computed once for all frames
+    """
+    laser_scans, _ = predictor_log.read_scans(*window)
+    robot_states, _ = predictor_log.read('robot_states', *window)
+    actors_position, _ = predictor_log.read('actors_position', *window)
+    # Frames of the channels may differ by one while the log is still written
+    n_frames = min(len(laser_scans), robot_states.shape[0], actors_position.shape[0])
+    configurations = robot_states[:n_frames, :3]
+    actors_position = actors_position[:n_frames]
+    # Actors not detected are logged at the origin
+    visible = np.any(actors_position != 0.0, axis=2)
+    return {
+        'configurations': configurations,
+        'robot_center': robot_centers(configurations, controller_log['offset_b']),
+        'fov': fov_segments(configurations, laser_fov(predictor_log)),
+        'scans': laser_scans[:n_frames],
+        'actors_position': np.where(visible[:, :, np.newaxis], actors_position, np.nan)
+    }
+
+class RobotArtists:
+    '''
+    Robot body, controlled point, clearance and label
+    '''
+    def __init__(self, ax, base_radius, rho_cbf):
+        self.body = Circle((0.0, 0.0), base_radius, facecolor='none', edgecolor='k', label='TIAGo')
+        self.clearance = Circle((0.0, 0.0), rho_cbf, facecolor='none', edgecolor='r')
+        ax.add_patch(self.body)
+        ax.add_patch(self.clearance)
+        self.point, = ax.plot([], [], marker='.', color='k', linestyle='')
+        self.label = ax.text(np.nan, np.nan, self.body.get_label(), fontsize=8, ha='left', va='bottom')
+        self.artists = [self.body, self.clearance, self.point, self.label]
+
+    def update(self, frames, frame):
+        self.body.set_center(frames['robot_center'][frame])
+        self.clearance.set_center(frames['configurations'][frame, :2])
+        self.point.set_data(frames['configurations'][frame, :1], frames['configurations'][frame, 1:2])
+        self.label.set_position(frames['robot_center'][frame])
+
+class WorldView:
+    '''
+    Artists of the world figure, created once and updated in place at every frame
+    '''
+    def __init__(self, ax, controller_log, frames):
+        ds_cbf = controller_log['ds_cbf']
+        self.robot = RobotArtists(ax, controller_log['base_radius'], controller_log['rho_cbf'])
+        self.goal, = ax.plot([], [], marker='*', markersize=9, linestyle='', label='goal', color='magenta', alpha=0.7)
+        self.goal_label = ax.text(np.nan, np.nan, self.goal.get_label(), fontsize=8, ha='left', va='bottom')
+        self.traj_line, = ax.plot([], [], color='blue', label='trajectory')
+        self.robot_pred_line, = ax.plot([], [], color='green', label='prediction')
+        self.artists = self.robot.artists + [self.goal, self.goal_label, self.traj_line, self.robot_pred_line]
+
+        self.fov = []
+        if 'fov' in frames:
+            self.fov = [ax.plot([], [], color='cyan', alpha=0.7)[0] for _ in range(2)]
+        self.actors = []
+        if 'actors_position' in frames:
+            for i in range(frames['actors_position'].shape[1]):
+                self.actors.append((
+                    ax.plot([], [], marker='.', linestyle='', label='fsm{}'.format(i+1), color='red', alpha=0.7)[0],
+                    ax.add_patch(Circle((0.0, 0.0), ds_cbf, facecolor='none', edgecolor='red')),
+                    ax.text(np.nan, np.nan, 'fsm{}'.format(i+1), fontsize=8, ha='left', va='bottom'),
+                    ax.plot([], [], color='orange', label='actor prediction')[0]
+                ))
+        self.actors_gt = []
+        if 'actors_gt' in frames:
+            for i in range(frames['actors_gt'].shape[1]):
+                self.actors_gt.append((
+                    ax.plot([], [], marker='.', linestyle='', label='actor{}'.format(i+1), color='k', alpha=0.4)[0],
+                    ax.add_patch(Circle((0.0, 0.0), ds_cbf, facecolor='none', edgecolor='k', alpha=0.4)),
+                    ax.text(np.nan, np.nan, 'actor{}'.format(i+1), fontsize=8, ha='left', va='bottom')
+                ))
+        self.artists += self.fov + [artist for actor in self.actors + self.actors_gt for artist in actor]
+
+    def update(self, frames, frame):
+        configurations = frames['configurations']
+        target = frames['targets'][frame]
+        self.robot.update(frames, frame)
+        self.goal.set_data(target[:1], target[1:2])
+        self.goal_label.set_position(target)
+        self.traj_line.set_data(configurations[:frame + 1, 0], configurations[:frame + 1, 1])
+        self.robot_pred_line.set_data(frames['robot_predictions'][frame, 0, :], frames['robot_predictions'][frame, 1, :])
+
+        if self.fov:
+            for line, segment in zip(self.fov, frames['fov'][frame]):
+                line.set_data(segment[0], segment[1])
+        for i, (point, clearance, label, pred_line) in enumerate(self.actors):
+            position = frames['actors_position'][frame, i]
+            prediction = frames['actors_predictions'][frame, i]
+            point.set_data(position[:1], position[1:2])
+            clearance.set_center(position)
+            label.set_position(position)
+            pred_line.set_data(prediction[0, :], prediction[1, :])
+        for i, (point, clearance, label) in enumerate(self.actors_gt):
+            position = frames['actors_gt'][frame, i]
+            point.set_data(position[:1], position[1:2])
+            clearance.set_center(position)
+            label.set_position(position)
+        return self.artists
+
+class ScansView:
+    '''
+    Artists of the scans figure, created once and updated in place at every frame
+    '''
+    def __init__(self, ax, controller_log, frames):
+        self.robot = RobotArtists(ax, controller_log['base_radius'], controller_log['rho_cbf'])
+        self.scans, = ax.plot([], [], color='magenta', marker='.', linestyle='', label='scans')
+        self.fov = [ax.plot([], [], color='cyan', alpha=0.7)[0] for _ in range(2)]
+        # All the cluster centers of a frame in a single artist
+        self.core_points, = ax.plot([], [], color='b', marker='.', linestyle='', label='actor')
+        self.artists = self.robot.artists + [self.scans, self.core_points] + self.fov
+
+    def update(self, frames, frame):
+        self.robot.update(frames, frame)
+        for line, segment in zip(self.fov, frames['fov'][frame]):
+            line.set_data(segment[0], segment[1])
+        current_scans = frames['scans'][frame]
+        if current_scans.shape[0] > 0:
+            self.scans.set_data(current_scans[:, 0], current_scans[:, 1])
+            self.core_points.set_data(frames['actors_position'][frame, :, 0], frames['actors_position'][frame, :, 1])
+        else:
+            self.scans.set_data([], [])
+            self.core_points.set_data([], [])
+        return self.artists
 
-    # Figure to plot world animation
-    world_fig = plt.figure(figsize=(8, 8))
+def world_axes(title, region):
+    fig = plt.figure(figsize=(8, 8))
     gs = gridspec.GridSpec(1,1)
-    ax_big = plt.subplot(gs[0, 0])
-
-    robot = Circle(np.zeros(1), np.zeros(1), facecolor='none', edgecolor='k', label='TIAGo')
-    controlled_pt = ax_big.scatter([], [], marker='.', color='k')
-    robot_label = ax_big.text(np.nan, np.nan, robot.get_label(), fontsize=8, ha='left', va='bottom')
-    robot_clearance = Circle(np.zeros(1), np.zeros(1), facecolor='none', edgecolor='r')
-    goal = ax_big.scatter([], [], s=80.0, marker='*', label='goal', color='magenta', alpha=0.7)
-    goal_label = ax_big.text(np.nan, np.nan, goal.get_label(), fontsize=8, ha='left', va='bottom')
-    if n_actors > 0:
-        fov_min, = ax_big.plot([], [], color='cyan', alpha=0.7)
-        fov_max, = ax_big.plot([], [], color='cyan', alpha=0.7)
-        actors = []
-        actors_label = []
-        actors_clearance = []
-        actors_pred_line = []
-        actors_gt = []
-        actors_gt_label = []
-        actors_gt_clearance = []
-        
-        for i in range(n_clusters):
-            actors.append(ax_big.scatter([], [], marker='.', label='fsm{}'.format(i+1), color='red', alpha=0.7))
-            actors_clearance.append(Circle(np.zeros(1), np.zeros(1), facecolor='none', edgecolor='red'))
-            actors_label.append(ax_big.text(np.nan, np.nan, actors[i].get_label(), fontsize=8, ha='left', va='bottom'))
-            actor_pred_line, = ax_big.plot([], [], color='orange', label='actor prediction')
-            actors_pred_line.append(actor_pred_line)
-
-        if simulation and not fake_sensing:
-            for i in range(n_actors):
-                actors_gt.append(ax_big.scatter([], [], marker='.', label='actor{}'.format(i+1), color='k', alpha=0.4))
-                actors_gt_clearance.append(Circle(np.zeros(1), np.zeros(1), facecolor='none', edgecolor='k', alpha=0.4))
-                actors_gt_label.append(ax_big.text(np.nan, np.nan, actors_gt[i].get_label(), fontsize=8, ha='left', va='bottom'))
-    
-    traj_line, = ax_big.plot([], [], color='blue', label='trajectory')
-    robot_pred_line, = ax_big.plot([], [], color='green', label='prediction')
-
-    boundary_line = []
-    for i in range(n_edges - 1):
-        x_values = [boundary_vertexes[i, 0], boundary_vertexes [i + 1, 0]]
-        y_values = [boundary_vertexes[i, 1], boundary_vertexes [i + 1, 1]]
-        line, = ax_big.plot(x_values, y_values, color='red', linestyle='--')
-        boundary_line.append(line)
-    x_values = [boundary_vertexes[n_edges - 1, 0], boundary_vertexes [0, 0]]
-    y_values = [boundary_vertexes[n_edges - 1, 1], boundary_vertexes [0, 1]]
-    line, = ax_big.plot(x_values, y_values, color='red', linestyle='--')
-    boundary_line.append(line)
-
-    ax_big.set_title('TIAGo World')
-    ax_big.set_xlabel("$x \quad [m]$")
-    ax_big.set_ylabel('$y \quad [m]$')
-    ax_big.set_aspect('equal', adjustable='box')
-    ax_big.grid(True)
-
-    # init and update function for the world animation
-    def init_world():
-        robot.set_center(robot_center[0])
-        robot.set_radius(base_radius)
-        ax_big.add_patch(robot)
-        controlled_pt.set_offsets(configurations[0, :2])
-        robot_clearance.set_center(configurations[0, :2])
-        robot_clearance.set_radius(rho_cbf)
-        ax_big.add_patch(robot_clearance)
-        robot_label.set_position(robot_center[0])
-
-        goal.set_offsets(targets[0, :2])
-        goal_label.set_position(targets[0])
-
-        if n_actors > 0:        
-            for i in range(n_clusters):
-                actor_position = actors_predictions[0, i, :, 0]
-                actors[i].set_offsets(actor_position)
-                actors_clearance[i].set_center(actor_position)
-                actors_clearance[i].set_radius(ds_cbf)
-                ax_big.add_patch(actors_clearance[i])
-                actors_label[i].set_position(actor_position)
-
-            if simulation and not fake_sensing:
-                for i in range(n_actors):
-                    actor_gt_position = actors_groundtruth[0, i, :]
-                    actors_gt[i].set_offsets(actor_gt_position)
-                    actors_gt_clearance[i].set_center(actor_gt_position)
-                    actors_gt_clearance[i].set_radius(ds_cbf)
-                    ax_big.add_patch(actors_gt_clearance[i])
-                    actors_gt_label[i].set_position(actor_gt_position)
-
-                return robot, robot_clearance, robot_label, goal, goal_label, \
-                       actors, actors_clearance, actors_label, \
-                       actors_gt, actors_gt_clearance, actors_gt_label
-            else:
-                return robot, robot_clearance, robot_label, goal, goal_label, \
-                       actors, actors_clearance, actors_label
-        else:
-            return robot, robot_clearance, robot_label, goal, goal_label
-
-    def update_world(frame):
-        if frame == shooting_nodes - 1:
-            world_animation.event_source.stop()
-        
-        robot_prediction = robot_predictions[frame, :, :]
-        current_target = targets[frame, :]
-
-        traj_line.set_data(configurations[:frame + 1, 0], configurations[:frame + 1, 1])
-        robot_pred_line.set_data(robot_prediction[0, :], robot_prediction[1, :])
-
-        robot.set_center(robot_center[frame])
-        controlled_pt.set_offsets(configurations[frame, :2])
-        robot_clearance.set_center(configurations[frame, :2])
-        robot_label.set_position(robot_center[frame])
-        goal.set_offsets(current_target[:2])
-        goal_label.set_position(current_target)
-
-        if n_actors > 0:
-            theta = configurations[frame, 2]
-            current_laser_pos = configurations[frame, :2] + z_rotation(theta, laser_position)
-            current_p_lr = current_laser_pos + z_rotation(theta, p_lr)
-            current_p_ur = current_laser_pos + z_rotation(theta, p_ur)
-            current_p_ll = current_laser_pos + z_rotation(theta, p_ll)
-            current_p_ul = current_laser_pos + z_rotation(theta, p_ul)
-            x_min = [current_p_lr[0], current_p_ur[0]]
-            y_min = [current_p_lr[1], current_p_ur[1]]
-            x_max = [current_p_ll[0], current_p_ul[0]]
-            y_max = [current_p_ll[1], current_p_ul[1]]
-            fov_min.set_data(x_min, y_min)
-            fov_max.set_data(x_max, y_max)
-            for i in range(n_clusters):
-                actor_prediction = actors_predictions[frame, i, :, :]
-                actor_position = actor_prediction[: , 0]
-                actors[i].set_offsets(actor_position)
-                actors_clearance[i].set_center(actor_position)
-                actors_label[i].set_position(actor_position)
-                actors_pred_line[i].set_data(actor_prediction[0, :], actor_prediction[1, :])
-
-            if simulation and not fake_sensing:
-                for i in range(n_actors):
-                    actor_gt_position = actors_groundtruth[frame, i, :]
-                    actors_gt[i].set_offsets(actor_gt_position)
-                    actors_gt_clearance[i].set_center(actor_gt_position)
-                    actors_gt_label[i].set_position(actor_gt_position)
-
-                return robot, robot_clearance, robot_label, goal, goal_label, \
-                       traj_line, robot_pred_line, fov_min, fov_max, \
-                       actors, actors_clearance, actors_label, actors_pred_line, \
-                       actors_gt, actors_gt_clearance, actors_gt_label
-            else:
-                return robot, robot_clearance, robot_label, goal, goal_label, \
-                       traj_line, robot_pred_line, fov_min, fov_max, \
-                       actors, actors_clearance, actors_label, actors_pred_line
-        else:
-            return robot, robot_clearance, robot_label, goal, goal_label, \
-                   traj_line, robot_pred_line
+    ax = plt.subplot(gs[0, 0])
+    setup_world_axes(ax, title, region)
+    return fig, ax
+
+def setup_world_axes(ax, title, region):
+    boundary_lines(ax, region)
+    ax.set_title(title)
+    ax.set_xlabel("$x \quad [m]$")
+    ax.set_ylabel('$y \quad [m]$')
+    ax.set_aspect('equal', adjustable='box')
+    ax.grid(True)
+
+def animate(fig, view, frames, interval):
+    n_frames = frames['configurations'].shape[0]
+    # Blitting redraws only the artists of the view on top of the static background
+    animation = FuncAnimation(fig, lambda frame: view.update(frames, frame),
+                              frames=n_frames,
+                              init_func=lambda: view.update(frames, 0),
+                              blit=True,
+                              interval=interval,
+                              repeat=False)
+    return animation
+
+def build_view(animation, controller_log, predictor_log, window=(None, None)):
+    """
+    Figure, view and per-frame geometry of the 'world' or 'scans' animation
+    """
+    region = AdmittedRegion.from_vertexes(controller_log['boundary_vertexes'])
+    if animation == 'world':
+        frames = world_frames(controller_log, predictor_log, window)
+        fig, ax = world_axes('TIAGo World', region)
+        view = WorldView(ax, controller_log, frames)
+    else:
+        frames = scans_frames(controller_log, predictor_log, window)
+        fig, ax = world_axes('TIAGo Scans', region)
+        view = ScansView(ax, controller_log, frames)
+    fig.tight_layout()
+    return fig, view, frames
+
+def animate_world(controller_log, predictor_log, window=(None, None)):
+    """
+    Figure to plot world animation
+    """
+    world_fig, view, frames = build_view('world', controller_log, predictor_log, window)
+    world_animation = animate(world_fig, view, frames, 1/controller_log['frequency']*100)
+    return world_fig, world_animation
+
+def animate_scans(controller_log, predictor_log, window=(None, None)):
+    """
+    Figure to plot scans animation
+    """
+    scans_fig, view, frames = build_view('scans', controller_log, predictor_log, window)
+    scans_animation = animate(scans_fig, view, frames, 1/controller_log['frequency']*500)
+    return scans_fig, scans_animation
+
+def plot_results(filename=None, t_start=None, t_end=None):
+    """
+    Plot the logged run, optionally restricted to the window [t_start, t_end]
+    given in seconds from the first controller iteration
+    """
+    # Specify saving plots directory
+    plots_savedir = '/tmp/tiago_obst_avoidance/plots'
+    if not os.path.exists(plots_savedir):
+        os.makedirs(plots_savedir)
 
-    world_animation = FuncAnimation(world_fig, update_world,
-                                    frames=shooting_nodes,
-                                    init_func=init_world,
-                                    blit=False,
-                                    interval=1/frequency*100,
-                                    repeat=False)
-    world_fig.tight_layout()
+    # Specify saving animations directory
+    animation_savedir = '/tmp/tiago_obst_avoidance/animations'
+    if not os.path.exists(animation_savedir):
+        os.makedirs(animation_savedir)
+
+    configuration_savepath = os.path.join(plots_savedir, filename + '_configuration.png')
+    time_savepath = os.path.join(plots_savedir, filename + '_time.png')
+    scans_savepath = os.path.join(animation_savedir, filename + '_scans.mp4')
+    world_savepath = os.path.join(animation_savedir, filename + '_world.mp4')
+
+    controller_log, predictor_log = open_logs(filename)
+    window = absolute_window(controller_log, t_start, t_end)
+    frequency = controller_log['frequency']
+
+    time_fig = plot_time(controller_log, predictor_log, window)
+    time_fig.savefig(time_savepath)
 
+    config_fig = plot_configuration(controller_log, window)
     if Hparams.save_video:
-        world_animation.save(world_savepath, writer='ffmpeg', fps=frequency, dpi=80)
-        print("World animation saved")
+        config_fig.savefig(configuration_savepath)
     else:
+        # doesn't continue if the plots are open
         plt.show()
 
-    # Figure to plot scans animation
-    if n_actors > 0 and not fake_sensing:
-        scans_fig = plt.figure(figsize=(8, 8))
-        gs = gridspec.GridSpec(1,1)
-        ax = plt.subplot(gs[0, 0])
-
-        robot = Circle(np.zeros(1), np.zeros(1), facecolor='none', edgecolor='k', label='TIAGo')
-        controlled_pt = ax.scatter([], [], marker='.', color='k')
-        robot_label = ax.text(np.nan, np.nan, robot.get_label(), fontsize=8, ha='left', va='bottom')
-        robot_clearance = Circle(np.zeros(1), np.zeros(1), facecolor='none', edgecolor='r')
-        scans, = ax.plot([], [], color='magenta', marker='.', linestyle='', label='scans')
-        fov_min, = ax.plot([], [], color='cyan', alpha=0.7)
-        fov_max, = ax.plot([], [], color='cyan', alpha=0.7)
-        core_points = []
-        for i in range(n_clusters):
-            point, = ax.plot([], [], color='b', marker='.', linestyle='', label='actor')
-            core_points.append(point)
-
-        boundary_line = []
-        for i in range(n_edges - 1):
-            x_values = [boundary_vertexes[i, 0], boundary_vertexes [i + 1, 0]]
-            y_values = [boundary_vertexes[i, 1], boundary_vertexes [i + 1, 1]]
-            line, = ax.plot(x_values, y_values, color='red', linestyle='--')
-            boundary_line.append(line)
-        x_values = [boundary_vertexes[n_edges - 1, 0], boundary_vertexes [0, 0]]
-        y_values = [boundary_vertexes[n_edges - 1, 1], boundary_vertexes [0, 1]]
-        line, = ax.plot(x_values, y_values, color='red', linestyle='--')
-        boundary_line.append(line)
-
-        ax.set_title('TIAGo Scans')
-        ax.set_xlabel("$x \quad [m]$")
-        ax.set_ylabel('$y \quad [m]$')
-        ax.set_aspect('equal', adjustable='box')
-        ax.grid(True)
-
-        shooting_nodes = robot_config.shape[0]
-        robot_center = np.empty((robot_config.shape[0], 2))
-        for i in range(robot_config.shape[0]):
-            robot_center[i, 0] = robot_config[i, 0] - b * math.cos(robot_config[i, 2])
-            robot_center[i, 1] = robot_config[i, 1] - b * math.sin(robot_config[i, 2])
-
-        # init and update function for the world animation
-        def init_scans():
-            robot.set_center(robot_center[0])
-            robot.set_radius(base_radius)
-            ax.add_patch(robot)
-            controlled_pt.set_offsets(robot_config[0, :2])
-            robot_clearance.set_center(robot_config[0, :2])
-            robot_clearance.set_radius(rho_cbf)
-            ax.add_patch(robot_clearance)
-            robot_label.set_position(robot_center[0])
-        
-            return robot, robot_clearance, robot_label
-
-        def update_scans(frame):
-            if frame == shooting_nodes - 1:
-                scans_animation.event_source.stop()
-
-            robot.set_center(robot_center[frame])
-            controlled_pt.set_offsets(robot_config[frame, :2])
-            robot_clearance.set_center(robot_config[frame, :2])
-            robot_label.set_position(robot_center[frame])
-            current_scans = np.array(laser_scans[frame])
-
-            theta = robot_config[frame, 2]
-            current_laser_pos = robot_config[frame, :2] + z_rotation(theta, laser_position)
-            current_p_lr = current_laser_pos + z_rotation(theta, p_lr)
-            current_p_ur = current_laser_pos + z_rotation(theta, p_ur)
-            current_p_ll = current_laser_pos + z_rotation(theta, p_ll)
-            current_p_ul = current_laser_pos + z_rotation(theta, p_ul)
-            x_min = [current_p_lr[0], current_p_ur[0]]
-            y_min = [current_p_lr[1], current_p_ur[1]]
-            x_max = [current_p_ll[0], current_p_ul[0]]
-            y_max = [current_p_ll[1], current_p_ul[1]]
-            fov_min.set_data(x_min, y_min)
-            fov_max.set_data(x_max, y_max)
-
-            if current_scans.shape[0] > 0:
-                scans.set_data(current_scans[:, 0], current_scans[:, 1])
-                for i in range(n_clusters):
-                    actor_position = actors_position[frame, i, :]
-                    if any(coord != 0.0 for coord in actor_position):
-                        core_points[i].set_data(actor_position[0], actor_position[1])
-                    else:
-                        core_points[i].set_data([], [])
-            else:
-                scans.set_data([], [])
-                for i in range(n_clusters):
-                    core_points[i].set_data([], [])
-
-            return robot, robot_clearance, robot_label, scans, core_points
-
-        scans_animation = FuncAnimation(scans_fig, update_scans,
-                                        frames=shooting_nodes,
-                                        init_func=init_scans,
-                                        blit=False,
-                                        interval=1/frequency*500,
-                                        repeat=False)
-        scans_fig.tight_layout()
-
-        if Hparams.save_video:
-            scans_animation.save(scans_savepath, writer='ffmpeg', fps=frequency, dpi=80)
-            print("Scans animation saved")
-        
+    has_scans = predictor_log is not None and not controller_log['fake_sensing']
+    if Hparams.save_video:
+        # World and scans videos are rendered in parallel segments
+        output_paths = {'world': world_savepath}
+        if has_scans:
+            output_paths['scans'] = scans_savepath
+        export_animations(filename, window, output_paths, fps=frequency, dpi=80, n_jobs=Hparams.video_jobs)
+        return
+
+    world_fig, world_animation = animate_world(controller_log, predictor_log, window)
+    plt.show()
+
+    if has_scans:
+        scans_fig, scans_animation = animate_scans(controller_log, predictor_log, window)
         plt.show()
 
 def main():
+    # Only the ROS node needs rospy, the plotting functions can run without a ROS master
+    import rospy
+    # The parameters of plotter.launch are only read from the parameter server by an initialized node
+    rospy.init_node('tiago_plotter', anonymous=True, log_level=rospy.INFO)
+    Hparams.load()
     filename = rospy.get_param('/filename')
-    plot_results(filename)
\ No newline at end of file
+    t_start = rospy.get_param('/t_start', None) # [s] from the first controller iteration
+    t_end = rospy.get_param('/t_end', None)
+    plot_results(filename, t_start, t_end)
\ No newline at end of file
@@ -0,0 +1,122 @@
+import numpy as np
+import math
+import threading
+import rospy
+
+import tf2_msgs.msg
+
+class PoseTracker:
+    '''
+    Pose [x, y, theta] of child_frame in parent_frame, composed from the planar transforms of the /tf messages
+    at each transform update of child_frame, without a TF lookup. The latest poses are kept in a ring with their
+    stamps, theta is unwrapped so that the poses can be interpolated at any stamp
+    '''
+    def __init__(self, parent_frame, child_frame, size=64):
+        self.parent_frame = parent_frame
+        self.child_frame = child_frame
+        self.lock = threading.Lock()
+        # Stamps [s] and poses of the ring, count is the number of poses received
+        self.times = np.zeros(size)
+        self.poses = np.zeros((size, 3))
+        self.count = 0
+
+        # Latest transform (parent, x, y, yaw) of each frame of the chain from child_frame to parent_frame,
+        # the chain is discovered from the messages going up from child_frame
+        self.chain_lock = threading.Lock()
+        self.chain = {}
+        self.tracked = {child_frame}
+        for topic in ('/tf', '/tf_static'):
+            rospy.Subscriber(
+                topic,
+                tf2_msgs.msg.TFMessage,
+                self.tf_callback
+            )
+
+    def tf_callback(self, msg):
+        stamp = None
+        with self.chain_lock:
+            for transform in msg.transforms:
+                frame = transform.child_frame_id.lstrip('/')
+                if frame not in self.tracked:
+                    continue
+                parent = transform.header.frame_id.lstrip('/')
+                q = transform.transform.rotation
+                yaw = math.atan2(
+                    2.0 * (q.w * q.z + q.x * q.y),
+                    1.0 - 2.0 * (q.y * q.y + q.z * q.z)
+                )
+                self.chain[frame] = (parent, transform.transform.translation.x, transform.transform.translation.y, yaw)
+                if parent != self.parent_frame:
+                    self.tracked.add(parent)
+                if frame == self.child_frame:
+                    stamp = transform.header.stamp.to_sec()
+            if stamp is None:
+                return
+            pose = self.compose()
+        if pose is not None:
+            self.append(stamp, *pose)
+
+    def compose(self):
+        """
+        Pose of child_frame in parent_frame from the latest transforms of the chain, None if the chain is incomplete
+        """
+        x, y, theta = 0.0, 0.0, 0.0
+        frame = self.child_frame
+        for _ in range(len(self.chain)):
+            if frame not in self.chain:
+                return None
+            parent, parent_x, parent_y, parent_yaw = self.chain[frame]
+            cos_yaw = math.cos(parent_yaw)
+            sin_yaw = math.sin(parent_yaw)
+            x, y = parent_x + cos_yaw * x - sin_yaw * y, parent_y + sin_yaw * x + cos_yaw * y
+            theta += parent_yaw
+            if parent == self.parent_frame:
+                return x, y, math.remainder(theta, 2 * math.pi)
+            frame = parent
+        return None
+
+    def append(self, stamp, x, y, theta):
+        with self.lock:
+            if self.count > 0:
+                last = (self.count - 1) % self.times.shape[0]
+                # Out of order or repeated transform
+                if stamp <= self.times[last]:
+                    return
+                # Unwrap theta with respect to the previous pose
+                previous_theta = self.poses[last, 2]
+                theta = previous_theta + math.remainder(theta - previous_theta, 2 * math.pi)
+            idx = self.count % self.times.shape[0]
+            self.times[idx] = stamp
+            self.poses[idx] = (x, y, theta)
+            self.count += 1
+
+    def ordered(self):
+        """
+        Copy of the stamps and poses in the ring, from the oldest
+        """
+        with self.lock:
+            size = self.times.shape[0]
+            if self.count <= size:
+                return self.times[:self.count].copy(), self.poses[:self.count].copy()
+            start = self.count % size
+            return np.roll(self.times, -start), np.roll(self.poses, -start, axis=0)
+
+    def latest(self):
+        """
+        Latest pose and its stamp, None if no pose has been received
+        """
+        with self.lock:
+            if self.count == 0:
+                return None
+            last = (self.count - 1) % self.times.shape[0]
+            return self.poses[last].copy(), float(self.times[last])
+
+    def pose_at(self, stamp):
+        """
+        Pose interpolated at stamp, the oldest or the latest pose outside the ring.
+        None if no pose has been received
+        """
+        times, poses = self.ordered()
+        if times.shape[0] == 0:
+            return None
+        return np.array([np.interp(stamp, times, poses[:, i]) for i in range(3)])
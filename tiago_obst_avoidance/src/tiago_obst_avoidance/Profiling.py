@@ -0,0 +1,114 @@
+import os
+import time
+
+def process_age():
+    """
+    Seconds elapsed since the process started (interpreter startup and imports included),
+    None if /proc is not available
+    """
+    try:
+        with open('/proc/self/stat', 'r') as file:
+            # Fields after the executable name, the start time is field 22 of the whole line
+            fields = file.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime', 'r') as file:
+            uptime = float(file.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class StartupProfiler:
+    '''
+    Wall-clock duration of the startup phases of a node, from the process start to READY.
+    Each mark closes the phase started by the previous one
+    '''
+    def __init__(self):
+        self.phases = []
+        self.reported = False
+        age = process_age()
+        if age is not None:
+            self.phases.append(('imports', age))
+        self.last_mark = time.monotonic()
+
+    def mark(self, name):
+        now = time.monotonic()
+        self.phases.append((name, now - self.last_mark))
+        self.last_mark = now
+
+    def report(self):
+        """
+        Log the phases once and publish them in ~startup_times, in seconds
+        """
+        import rospy
+        if self.reported:
+            return
+        self.reported = True
+        total = sum(duration for _, duration in self.phases)
+        rospy.loginfo(f"Startup time {total:.3f} s: " +
+                      ", ".join(f"{name} {duration:.3f} s" for name, duration in self.phases))
+        startup_times = dict(self.phases)
+        startup_times['total'] = total
+        rospy.set_param('~startup_times', startup_times)
+
+def retained_differences(before, after, root=os.path.dirname(os.path.abspath(__file__))):
+    """
+    Lines under root whose memory differs between two tracemalloc snapshots, from the largest
+    difference, with the total size difference in bytes
+    """
+    differences = [difference for difference in after.compare_to(before, 'lineno')
+                   if difference.count_diff != 0 and
+                   difference.traceback[0].filename.startswith(root)]
+    return differences, sum(difference.size_diff for difference in differences)
+
+class AllocationTracer:
+    '''
+    Memory retained by the control cycles in steady state, measured with tracemalloc between the
+    snapshots taken after warmup cycles and after warmup + cycles cycles. Only the lines of this
+    package are reported, with the garbage collections that have run meanwhile
+    '''
+    def __init__(self, warmup=100, cycles=500, top=10):
+        self.warmup = warmup
+        self.cycles = cycles
+        self.top = top
+        self.count = 0
+        self.snapshot = None
+        self.collections = None
+        self.root = os.path.dirname(os.path.abspath(__file__))
+
+    @property
+    def done(self):
+        return self.count >= self.warmup + self.cycles
+
+    def tick(self):
+        """
+        Called once per control cycle
+        """
+        import gc
+        import tracemalloc
+        if self.done:
+            return
+        self.count += 1
+        if self.count == self.warmup:
+            tracemalloc.start()
+            self.collections = [stats['collections'] for stats in gc.get_stats()]
+            self.snapshot = tracemalloc.take_snapshot()
+        elif self.count == self.warmup + self.cycles:
+            snapshot = tracemalloc.take_snapshot()
+            collections = [stats['collections'] for stats in gc.get_stats()]
+            tracemalloc.stop()
+            self.report(*retained_differences(self.snapshot, snapshot, self.root),
+                        [after - before for before, after in zip(self.collections, collections)])
+
+    def report(self, differences, total, collections):
+        """
+        Log the package lines retaining memory, per cycle, and publish them in ~allocations
+        """
+        import rospy
+        lines = [f"{os.path.basename(difference.traceback[0].filename)}:{difference.traceback[0].lineno} "
+                 f"{difference.size_diff / self.cycles:.1f} B, {difference.count_diff / self.cycles:.2f} blocks"
+                 for difference in differences[:self.top]]
+        rospy.loginfo(f"Memory retained per cycle over {self.cycles} cycles: {total / self.cycles:.1f} B, "
+                      f"garbage collections per generation {collections}" +
+                      "".join("\n  " + line for line in lines))
+        rospy.set_param('~allocations', {'bytes_per_cycle': total / self.cycles,
+                                         'collections': collections,
+                                         'lines': lines})
@@ -0,0 +1,76 @@
+import numpy as np
+import rospy
+
+import tiago_msgs.srv
+
+from tiago_obst_avoidance.Hparams import Hparams
+from tiago_obst_avoidance.utils import piecewise_linear_trajectories, constant_velocity_trajectories, \
+    circular_trajectories, trajectories_to_message
+
+def generate_scenario(pattern, n_actors, n_steps, dt):
+    """
+    Build a synthetic crowd scenario inside the admitted region
+
+    Returns the (n_actors, n_steps, 2) positions and velocities arrays
+    """
+    vertexes = Hparams.vertexes
+    center = np.mean(vertexes, axis=0)
+    half_size = 0.5 * np.min(np.max(vertexes, axis=0) - np.min(vertexes, axis=0))
+    phases = 2 * np.pi * np.arange(n_actors) / max(n_actors, 1)
+    directions = np.stack((np.cos(phases), np.sin(phases)), axis=1)
+
+    if pattern == 'circular':
+        radii = np.linspace(0.3, 0.8, n_actors) * half_size
+        angular_velocities = 0.5 / np.maximum(radii, 1e-3)
+        return circular_trajectories(np.repeat(center[None, :], n_actors, axis=0),
+                                     radii, angular_velocities, phases, n_steps, dt)
+    elif pattern == 'constant_velocity':
+        initial_positions = center + 0.8 * half_size * directions
+        velocities = - 1.6 * half_size * directions / (n_steps * dt)
+        return constant_velocity_trajectories(initial_positions, velocities, n_steps, dt)
+    else:
+        # Back and forth crossing of the region through its center
+        waypoints = np.stack((center + 0.8 * half_size * directions,
+                              center - 0.8 * half_size * directions,
+                              center + 0.8 * half_size * directions), axis=1)
+        return piecewise_linear_trajectories(waypoints, n_steps, dt)
+
+def send_actors_trajectory(positions, velocities):
+    rospy.wait_for_service('SetActorsTrajectory')
+
+    try:
+        set_actors_trajectory_service = rospy.ServiceProxy(
+            'SetActorsTrajectory',
+            tiago_msgs.srv.SetActorsTrajectory
+        )
+
+        response = set_actors_trajectory_service(trajectories_to_message(positions, velocities))
+
+        if response.success:
+            rospy.loginfo('Actors trajectory successfully set')
+        else:
+            rospy.loginfo('Could not set actors trajectory')
+
+    except rospy.ServiceException as e:
+        print("Service call failed: %s" % e)
+
+def main():
+    rospy.init_node('tiago_send_actors_trajectory', log_level=rospy.INFO)
+    rospy.loginfo('TIAGo send actors trajectory module [OK]')
+    Hparams.load()
+
+    pattern = rospy.get_param('/pattern', 'linear') # linear, circular or constant_velocity
+    n_actors = rospy.get_param('/n_actors', Hparams.n_clusters)
+    # The object detection module only accepts one trajectory per actor of its parameters
+    if n_actors != Hparams.n_clusters:
+        rospy.logerr(f"n_actors is {n_actors} while the parameters have {Hparams.n_clusters} actors")
+        return
+    duration = rospy.get_param('/duration', 20.0) # [s]
+    # The object detection module moves to the next sample at each iteration
+    dt = 1 / Hparams.controller_frequency
+    n_steps = int(duration / dt)
+
+    positions, velocities = generate_scenario(pattern, n_actors, n_steps, dt)
+    # Service request:
+    rospy.loginfo("Sending actors trajectory")
+    send_actors_trajectory(positions, velocities)
@@ -0,0 +1,107 @@
+import numpy as np
+import math
+import time
+import rospy
+
+class NameIndex:
+    '''
+    Indices of the wanted names in the name list of the messages, resolved again only when the list changes.
+    A missing name takes its fallback index if given, -1 otherwise
+    '''
+    def __init__(self, wanted, fallback=None):
+        self.wanted = list(wanted)
+        self.fallback = fallback
+        self.names = None
+        self.indices = np.full(len(self.wanted), -1, dtype=int)
+
+    def resolve(self, names):
+        # Comparing the lists is much cheaper than searching each name in them
+        if names != self.names:
+            self.names = names
+            for i, name in enumerate(self.wanted):
+                if name in names:
+                    self.indices[i] = names.index(name)
+                elif self.fallback is not None and self.fallback[i] < len(names):
+                    self.indices[i] = self.fallback[i]
+                    rospy.logwarn(f"{name} not found in the message, using index {self.fallback[i]}")
+                else:
+                    self.indices[i] = -1
+        return self.indices
+
+class IngestionBuffer:
+    '''
+    Values of the latest accepted message written in place in two preallocated buffers:
+    a message is written in the buffer not being read, then the buffers are swapped.
+    Messages closer than 1 / max_rate to the last accepted one are dropped, max_rate = 0 accepts all
+    '''
+    def __init__(self, shape, max_rate=0.0):
+        self.buffers = np.zeros((2,) + tuple(shape))
+        self.times = np.zeros(2)
+        self.current = 0
+        self.min_period = 1.0 / max_rate if max_rate > 0 else 0.0
+
+    def next_buffer(self, now):
+        """
+        Buffer in which the message received at now is written, None if the message is dropped
+        """
+        if now - self.times[self.current] < self.min_period:
+            return None
+        return self.buffers[1 - self.current]
+
+    def commit(self, now):
+        self.times[1 - self.current] = now
+        self.current = 1 - self.current
+
+    def latest(self):
+        """
+        Values of the latest message and the time it has been received, read them before the next two messages
+        """
+        current = self.current
+        return self.buffers[current], float(self.times[current])
+
+class JointVelocities(IngestionBuffer):
+    '''
+    Velocities of the given joints from the joint_states messages
+    '''
+    def __init__(self, joint_names, fallback_indices=None, max_rate=0.0):
+        super().__init__((len(joint_names),), max_rate)
+        self.index = NameIndex(joint_names, fallback_indices)
+
+    def callback(self, msg):
+        now = time.time()
+        buffer = self.next_buffer(now)
+        if buffer is None:
+            return
+        indices = self.index.resolve(msg.name)
+        if indices.min() < 0 or indices.max() >= len(msg.velocity):
+            return
+        for i, idx in enumerate(indices):
+            buffer[i] = msg.velocity[idx]
+        self.commit(now)
+
+class ModelPoses(IngestionBuffer):
+    '''
+    Poses [x, y, theta] of the given models from the gazebo model_states messages,
+    a model missing from a message keeps its last pose
+    '''
+    def __init__(self, model_names, max_rate=0.0):
+        super().__init__((len(model_names), 3), max_rate)
+        self.index = NameIndex(model_names)
+
+    def callback(self, msg):
+        now = time.time()
+        buffer = self.next_buffer(now)
+        if buffer is None:
+            return
+        buffer[:] = self.buffers[self.current]
+        indices = self.index.resolve(msg.name)
+        for i, idx in enumerate(indices):
+            if idx < 0:
+                continue
+            p = msg.pose[idx].position
+            q = msg.pose[idx].orientation
+            buffer[i, 0] = p.x
+            buffer[i, 1] = p.y
+            buffer[i, 2] = math.atan2(2.0 * (q.w * q.z + q.x * q.y),
+                                      1.0 - 2.0 * (q.y**2 + q.z**2))
+        self.commit(now)
@@ -0,0 +1,107 @@
+import numpy as np
+import os
+import shutil
+import subprocess
+import tempfile
+import multiprocessing
+
+# Animations that can be exported, see Plotter.build_view
+ANIMATIONS = ('world', 'scans')
+
+def frame_chunks(n_frames, n_chunks):
+    """
+    Split the frames [0, n_frames) in at most n_chunks contiguous ranges
+    """
+    bounds = np.linspace(0, n_frames, max(1, n_chunks) + 1).astype(int)
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(bounds.shape[0] - 1) if bounds[i + 1] > bounds[i]]
+
+def count_frames(animation, controller_log, predictor_log, window):
+    """
+    Number of frames of an animation, without reading the data of the log
+    """
+    def n_rows(log, name):
+        start, end = log.window(log.times(name), *window)
+        return end - start
+
+    if animation == 'world':
+        return n_rows(controller_log, 'states')
+    scan_channels = ['laser_scans'] if predictor_log.has_channel('laser_scans') else ['laser_ranges', 'laser_mask']
+    return min(n_rows(predictor_log, name) for name in scan_channels + ['robot_states', 'actors_position'])
+
+def render_segment(task):
+    """
+    Render the frames [start, end) of an animation to a video segment, in a worker process
+    """
+    animation, filename, window, (start, end), segment_path, fps, dpi = task
+    # Headless figure, the worker never opens a window
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.animation import FFMpegWriter
+    from tiago_obst_avoidance import Plotter
+
+    controller_log, predictor_log = Plotter.open_logs(filename)
+    fig, view, frames = Plotter.build_view(animation, controller_log, predictor_log, window)
+
+    # Views are stateless, any frame can be drawn without the previous ones
+    writer = FFMpegWriter(fps=fps)
+    with writer.saving(fig, segment_path, dpi):
+        for frame in range(start, end):
+            view.update(frames, frame)
+            writer.grab_frame()
+    return animation, segment_path
+
+def join_segments(segment_paths, output_path):
+    """
+    Concatenate the video segments without re-encoding them
+    """
+    list_path = output_path + '.segments'
+    with open(list_path, 'w') as file:
+        for segment_path in segment_paths:
+            file.write(f"file '{segment_path}'\n")
+    try:
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                        '-i', list_path, '-c', 'copy', output_path], check=True)
+    finally:
+        os.remove(list_path)
+
+def export_animations(filename, window, output_paths, fps, dpi=80, n_jobs=None):
+    """
+    Render the animations in output_paths ({'world': path, 'scans': path}) concurrently,
+    each split in segments rendered by a pool of processes and joined with ffmpeg
+    """
+    from tiago_obst_avoidance.Plotter import open_logs
+
+    if shutil.which('ffmpeg') is None:
+        raise Exception(
+            "ffmpeg not found, cannot export the animations"
+        )
+    n_jobs = n_jobs or os.cpu_count()
+    controller_log, predictor_log = open_logs(filename)
+    segment_dir = tempfile.mkdtemp(prefix=filename + '_segments_',
+                                   dir=os.path.dirname(next(iter(output_paths.values()))))
+
+    tasks = []
+    segment_paths = {}
+    for animation, output_path in output_paths.items():
+        n_frames = count_frames(animation, controller_log, predictor_log, window)
+        if n_frames == 0:
+            print(f"No frames to export for the {animation} animation")
+            continue
+        # Chunks of all the animations share the same pool
+        segment_paths[animation] = []
+        for i, chunk in enumerate(frame_chunks(n_frames, n_jobs)):
+            segment_path = os.path.join(segment_dir, f'{animation}_{i:04d}.mp4')
+            segment_paths[animation].append(segment_path)
+            tasks.append((animation, filename, window, chunk, segment_path, fps, dpi))
+
+    # Spawned workers do not inherit the GUI backend of the caller
+    remaining = {animation: len(paths) for animation, paths in segment_paths.items()}
+    try:
+        with multiprocessing.get_context('spawn').Pool(max(1, min(n_jobs, len(tasks)))) as pool:
+            for animation, _ in pool.imap_unordered(render_segment, tasks):
+                remaining[animation] -= 1
+                if remaining[animation] == 0:
+                    join_segments(segment_paths[animation], output_paths[animation])
+                    print(f"{animation.capitalize()} animation saved")
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
@@ -1,7 +1,7 @@
 import numpy as np
 import math
-import tiago_msgs.msg
-import geometry_msgs.msg
+# The ROS messages are imported by the functions building them:
+# the offline tools (Plotter, batch_report) use this module without ROS
 
 class State:
     def __init__(self, x, y, theta, v, omega):
@@ -14,8 +14,21 @@ class State:
     def __repr__(self):
         return '({}, {}, {}, {}, {})'.format(self.x, self.y, self.theta, self.v, self.omega)
     
-    def get_state(self):
-        return np.array([self.x, self.y, self.theta, self.v, self.omega])
+    def get_state(self, out=None):
+        """
+        State as an array, written in place in out if given
+        """
+        if out is None:
+            return np.array([self.x, self.y, self.theta, self.v, self.omega])
+        out[0] = self.x
+        out[1] = self.y
+        out[2] = self.theta
+        out[3] = self.v
+        out[4] = self.omega
+        return out
+
+    def set_state(self, q):
+        self.x, self.y, self.theta, self.v, self.omega = q
 
 class Configuration:
     def __init__(self, x, y, theta):
@@ -39,6 +52,7 @@ class Position:
 
     @staticmethod
     def to_message(position):
+        import geometry_msgs.msg
         return geometry_msgs.msg.Point(position.x, position.y, 0.0)
     
     @staticmethod
@@ -55,6 +69,7 @@ class Velocity:
     
     @staticmethod
     def to_message(velocity):
+        import geometry_msgs.msg
         return geometry_msgs.msg.Vector3(velocity.x, velocity.y, 0.0)
     
     @staticmethod
@@ -68,6 +83,7 @@ class MotionPrediction:
     
     @staticmethod
     def to_message(motion_prediction):
+        import tiago_msgs.msg
         positions_msg = []
         velocities_msg = []
         for i in range(len(motion_prediction.positions)):
@@ -103,6 +119,7 @@ class CrowdMotionPrediction:
 
     @staticmethod
     def to_message(crowd_motion_prediction):
+        import tiago_msgs.msg
         crowd_motion_prediction_msg = \
             tiago_msgs.msg.CrowdMotionPrediction()
         for motion_prediction in crowd_motion_prediction.motion_predictions:
@@ -129,6 +146,7 @@ class CrowdMotionPredictionStamped:
 
     @staticmethod
     def to_message(crowd_motion_prediction_stamped):
+        import tiago_msgs.msg
         crowd_motion_prediction_stamped_msg = \
             tiago_msgs.msg.CrowdMotionPredictionStamped()
         crowd_motion_prediction_stamped_msg.header.stamp = \
@@ -200,6 +218,19 @@ def integrate(f, x0, u, dt, integration_method='RK4'):
     else:
         return Euler(f, x0, u, dt)
 
+def plan_input(plan, t, dt):
+    """
+    Input of the plan (start time, inputs) applied at time t, None without a plan or after its end.
+    A plan starting after t (solved from a predicted state) applies its first input
+    """
+    if plan is None:
+        return None
+    plan_time, plan_inputs = plan
+    k = max(0, int((t - plan_time) / dt))
+    if k >= plan_inputs.shape[0]:
+        return None
+    return plan_inputs[k]
+
 def z_rotation(angle, point2d):
     R = np.array([[math.cos(angle), - math.sin(angle), 0.0],
                   [math.sin(angle), math.cos(angle), 0.0],
@@ -208,6 +239,14 @@ def z_rotation(angle, point2d):
     rotated_point2d = np.matmul(R, point3d)[:2]
     return rotated_point2d
 
+# Batched z_rotation: angles of shape (...) broadcast against points of shape (..., 2)
+def z_rotations(angles, points2d):
+    cos = np.cos(angles)[..., np.newaxis]
+    sin = np.sin(angles)[..., np.newaxis]
+    x = points2d[..., 0:1]
+    y = points2d[..., 1:2]
+    return np.concatenate((cos * x - sin * y, sin * x + cos * y), axis=-1)
+
 # Wrap angle to [-pi, pi):
 def wrap_angle(theta):
     return math.atan2(math.sin(theta), math.cos(theta))
@@ -226,23 +265,119 @@ def linear_trajectory(p_i : Position, p_f : Position, n_steps):
                   and velocities (array of Velocity)
     """
 
-    # Calculate velocity
-    x_vel = (p_f.x - p_i.x) / (n_steps - 1)
-    y_vel = (p_f.y - p_i.y) / (n_steps - 1)
+    # Calculate velocity (displacement per step)
+    waypoints = np.array([[[p_i.x, p_i.y], [p_f.x, p_f.y]]])
+    positions_array, velocities_array = piecewise_linear_trajectories(waypoints, n_steps, 1.0)
 
     # Initialize the positions and velocities array
     positions = np.empty(n_steps, dtype=Position)
     velocities = np.empty(n_steps, dtype=Position)
+    positions[:] = [Position(x, y) for x, y in positions_array[0].tolist()]
+    velocities[:] = [Velocity(x, y) for x, y in velocities_array[0].tolist()]
+
+    return positions, velocities
+
+def piecewise_linear_trajectories(waypoints, n_steps, dt):
+    """
+    Generate constant-speed trajectories through a sequence of 2D waypoints,
+    for many actors at once.
 
-    # Generate linear trajectory
-    for i in range(n_steps):
-        alpha = i / (n_steps - 1)  # Interpolation parameter
-        positions[i] = Position((1 - alpha) * p_i.x + alpha * p_f.x, (1 - alpha) * p_i.y + alpha * p_f.y)
-        velocities[i] = Velocity(x_vel, y_vel)
-    velocities[n_steps - 1] = Velocity(0.0, 0.0)
+    Parameters:
+    - waypoints: array of shape (n_actors, n_waypoints, 2)
+    - n_steps: number of samples per trajectory (integer)
+    - dt: sampling time [s]
+
+    Returns:
+    - positions: array of shape (n_actors, n_steps, 2)
+    - velocities: array of shape (n_actors, n_steps, 2), zero at the last sample
+    """
+    waypoints = np.asarray(waypoints, dtype=float)
+    n_actors = waypoints.shape[0]
+
+    # Cumulative arc length of each path, normalized to [0, 1]
+    segments = np.diff(waypoints, axis=1)
+    lengths = np.linalg.norm(segments, axis=2)
+    cumulative = np.concatenate((np.zeros((n_actors, 1)), np.cumsum(lengths, axis=1)), axis=1)
+    total = cumulative[:, -1:]
+    cumulative = np.divide(cumulative, total, out=np.zeros_like(cumulative), where=total > 0.0)
+
+    # Locate the segment of each sample and interpolate inside it
+    s = np.linspace(0.0, 1.0, n_steps)
+    idx = np.sum(cumulative[:, None, 1:-1] <= s[None, :, None], axis=2)
+    start = np.take_along_axis(cumulative, idx, axis=1)
+    end = np.take_along_axis(cumulative, idx + 1, axis=1)
+    span = end - start
+    alpha = np.divide(s[None, :] - start, span, out=np.zeros_like(span), where=span > 0.0)
+    actor_idx = np.arange(n_actors)[:, None]
+    positions = waypoints[actor_idx, idx] + alpha[:, :, None] * segments[actor_idx, idx]
+
+    return positions, finite_difference_velocities(positions, dt)
+
+def constant_velocity_trajectories(initial_positions, velocities, n_steps, dt):
+    """
+    Generate constant-velocity trajectories for many actors at once.
 
+    Parameters:
+    - initial_positions: array of shape (n_actors, 2)
+    - velocities: array of shape (n_actors, 2) [m/s]
+    - n_steps: number of samples per trajectory (integer)
+    - dt: sampling time [s]
+
+    Returns:
+    - positions, velocities: arrays of shape (n_actors, n_steps, 2)
+    """
+    initial_positions = np.asarray(initial_positions, dtype=float)
+    velocities = np.asarray(velocities, dtype=float)
+    t = np.arange(n_steps) * dt
+    positions = initial_positions[:, None, :] + velocities[:, None, :] * t[None, :, None]
+    return positions, np.repeat(velocities[:, None, :], n_steps, axis=1)
+
+def circular_trajectories(centers, radii, angular_velocities, phases, n_steps, dt):
+    """
+    Generate circular trajectories for many actors at once.
+
+    Parameters:
+    - centers: array of shape (n_actors, 2)
+    - radii, angular_velocities [rad/s], phases [rad]: arrays of shape (n_actors,)
+    - n_steps: number of samples per trajectory (integer)
+    - dt: sampling time [s]
+
+    Returns:
+    - positions, velocities: arrays of shape (n_actors, n_steps, 2)
+    """
+    centers = np.asarray(centers, dtype=float)
+    radii = np.asarray(radii, dtype=float)[:, None]
+    angular_velocities = np.asarray(angular_velocities, dtype=float)[:, None]
+    angles = np.asarray(phases, dtype=float)[:, None] + angular_velocities * (np.arange(n_steps) * dt)[None, :]
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+    positions = centers[:, None, :] + radii[:, :, None] * np.stack((cos, sin), axis=2)
+    velocities = (radii * angular_velocities)[:, :, None] * np.stack((- sin, cos), axis=2)
     return positions, velocities
 
+def finite_difference_velocities(positions, dt):
+    velocities = np.zeros_like(positions)
+    velocities[:, :-1] = np.diff(positions, axis=1) / dt
+    return velocities
+
+def trajectories_to_message(positions, velocities):
+    """
+    Build a tiago_msgs/CrowdMotionPrediction directly from the
+    (n_actors, n_steps, 2) position and velocity arrays
+    """
+    import tiago_msgs.msg
+    import geometry_msgs.msg
+    crowd_motion_prediction_msg = tiago_msgs.msg.CrowdMotionPrediction()
+    for actor_positions, actor_velocities in zip(np.asarray(positions).tolist(),
+                                                 np.asarray(velocities).tolist()):
+        crowd_motion_prediction_msg.motion_predictions.append(
+            tiago_msgs.msg.MotionPrediction(
+                [geometry_msgs.msg.Point(x, y, 0.0) for x, y in actor_positions],
+                [geometry_msgs.msg.Vector3(x, y, 0.0) for x, y in actor_velocities]
+            )
+        )
+    return crowd_motion_prediction_msg
+
 def compute_normal_vector(p1, p2):
     x_p1 = p1[0]
     y_p1 = p1[1]
@@ -0,0 +1,181 @@
+import gc
+import time
+import threading
+import tracemalloc
+import unittest
+from unittest import mock
+
+import numpy as np
+
+try:
+    import rospy
+    from tiago_obst_avoidance.Hparams import Hparams
+    from tiago_obst_avoidance.NMPC import NMPC
+    from tiago_obst_avoidance.ControllerManager import ControllerManager
+    from tiago_obst_avoidance.RobotStatus import RobotStatus
+    from tiago_obst_avoidance.ActorsPrediction import ActorsPrediction
+    from tiago_obst_avoidance.LatencyCompensation import LatencyCompensation
+    from tiago_obst_avoidance.TopicIngestion import JointVelocities
+    from tiago_obst_avoidance.Profiling import retained_differences
+    from tiago_obst_avoidance.utils import State
+except ImportError as e:
+    import_error = e
+else:
+    import_error = None
+
+# Cycles run before measuring, and measured
+WARMUP_CYCLES = 50
+CYCLES = 500
+# Memory that may still be retained per cycle in steady state [B]:
+# the temporaries alive when the last snapshot is taken, spread over the cycles
+MAX_RETAINED_PER_CYCLE = 2.0
+# Memory allocated at most at once within a cycle, over the memory at its start [B]:
+# the small arrays returned by the fake solver and the numpy temporaries freed within the cycle
+MAX_PEAK_PER_CYCLE = 4096
+
+class FakeSolver:
+    '''
+    Stands for the acados solver: accepts the values set and returns a constant plan
+    '''
+    def __init__(self, N, nq, nu):
+        self.x = np.zeros((N + 1, nq))
+        self.u = np.full((N, nu), 0.1)
+
+    def set(self, stage, field, value):
+        pass
+
+    def cost_set(self, stage, field, value):
+        pass
+
+    def constraints_set(self, stage, field, value):
+        pass
+
+    def solve_for_x0(self, x0):
+        self.x[0] = x0
+        # acados returns a new array as well
+        return self.u[0].copy()
+
+    def get_status(self):
+        return 0
+
+    def get(self, stage, field):
+        return self.u[stage] if field == 'u' else self.x[stage]
+
+class FakePoseTracker:
+    def __init__(self):
+        self.pose = np.array([0.5, 0.2, 0.1])
+
+    def latest(self):
+        return self.pose, time.time()
+
+def fake_nmpc(hparams):
+    with mock.patch.object(NMPC, '_NMPC__create_acados_ocp_solver',
+                           lambda self, N, T: FakeSolver(N, self.nq, self.nu)):
+        return NMPC(hparams)
+
+def fake_prediction(hparams):
+    N = hparams.N_horizon
+    positions = np.zeros((hparams.n_clusters, N, 2))
+    velocities = np.zeros((hparams.n_clusters, N, 2))
+    positions[:, :, 0] = np.arange(hparams.n_clusters)[:, np.newaxis] + 2.0
+    velocities[:, :, 1] = 0.3
+    positions[:, :, 1] = 0.3 * hparams.dt * np.arange(N)
+    return ActorsPrediction(time.time(), positions, velocities, hparams.dt)
+
+def fake_controller(hparams):
+    # Only the attributes used by update, the node is not initialized
+    controller = ControllerManager.__new__(ControllerManager)
+    controller.hparams = hparams
+    controller.status = RobotStatus.MOVING
+    controller.sensing = True
+    controller.solver_status = -1
+    controller.plan = None
+    controller.data_lock = threading.Lock()
+    controller.nmpc_controller = fake_nmpc(hparams)
+    controller.init_workspaces()
+    controller.state = State(0.0, 0.0, 0.0, 0.0, 0.0)
+    controller.nmpc_controller.init(controller.state)
+    controller.state_time = time.time()
+    controller.latency_compensation = LatencyCompensation(hparams)
+    controller.wheels_vel = np.zeros(2)
+    controller.wheels_velocities = JointVelocities(hparams.wheel_joints, hparams.wheel_joints_fallback)
+    controller.pose_tracker = FakePoseTracker()
+    controller.actors_prediction = fake_prediction(hparams)
+    controller.actors_prediction_rt = controller.actors_prediction
+    controller.prediction_age = 0.0
+    controller.prediction_stale = False
+    controller.target_position = np.array([3.0, 1.0])
+    controller.control_input = controller.zero_input
+    return controller
+
+def measure_cycles(cycle):
+    """
+    Memory retained by the package per call of cycle in steady state, with the differences found,
+    the largest peak allocated within a cycle and the garbage collections run over the cycles
+    """
+    for _ in range(WARMUP_CYCLES):
+        cycle()
+    peak = 0
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        collections = sum(stats['collections'] for stats in gc.get_stats())
+        for _ in range(CYCLES):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            cycle()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+        collections = sum(stats['collections'] for stats in gc.get_stats()) - collections
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    differences, total = retained_differences(before, after)
+    return total / CYCLES, differences, peak, collections
+
+class TestSteadyStateAllocations(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if import_error is not None:
+            raise unittest.SkipTest(f"the controller cannot be imported: {import_error}")
+        # rospy.Time.now() without a node, on the wall clock
+        rospy.rostime.set_rostime_initialized(True)
+
+    def assertSteadyState(self, cycle):
+        retained, differences, peak, collections = measure_cycles(cycle)
+        self.assertLess(retained, MAX_RETAINED_PER_CYCLE,
+                        "memory retained per cycle:\n" + "\n".join(str(difference) for difference in differences[:10]))
+        self.assertLess(peak, MAX_PEAK_PER_CYCLE, "memory allocated at once within a cycle")
+        self.assertEqual(collections, 0, "garbage collections run over the cycles")
+
+    def test_nmpc_update(self):
+        hparams = Hparams
+        nmpc = fake_nmpc(hparams)
+        state = State(0.5, 0.2, 0.1, 0.0, 0.0)
+        nmpc.init(state)
+        q_ref = np.zeros((nmpc.nq, hparams.N_horizon + 1))
+        q_ref[:2] = np.array([[3.0], [1.0]])
+        u_ref = np.zeros((nmpc.nu, hparams.N_horizon))
+        prediction = fake_prediction(hparams)
+        actors_states = np.zeros((hparams.n_clusters, hparams.N_horizon, nmpc.actor_state_size))
+        times = prediction.time + hparams.dt * np.arange(hparams.N_horizon)
+
+        def cycle():
+            prediction.aligned(times, out=actors_states)
+            nmpc.update(state, q_ref, u_ref, actors_states)
+        self.assertSteadyState(cycle)
+        self.assertEqual(nmpc.status, 0)
+
+    def test_controller_update(self):
+        controller = fake_controller(Hparams)
+
+        def cycle():
+            controller.cycle_start = time.time()
+            # A fresh prediction, as received at the node rate
+            controller.actors_prediction.time = controller.cycle_start
+            controller.update()
+        self.assertSteadyState(cycle)
+        self.assertEqual(controller.status, RobotStatus.MOVING)
+        self.assertIsNotNone(controller.plan)
+
+if __name__ == '__main__':
+    unittest.main()